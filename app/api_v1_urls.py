@@ -5,4 +5,5 @@ urlpatterns = [
     path('', include('app.tenancy.urls')),
     path('', include('app.connections.urls')),
     path('', include('app.nlq.urls')),
+    path('', include('app.queries.urls')),
 ]
@@ -0,0 +1,14 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+def get_redis() -> redis.Redis:
+    """
+    Returns the process-wide Redis client used for caching and coordination.
+    The client is created lazily so forked workers don't share a socket.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
@@ -0,0 +1,28 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Records how long each stage of a request takes, in milliseconds.
+    Stages timed more than once accumulate. `stages` can be an existing dict
+    (e.g. a history entry's timings) to add to.
+    """
+    def __init__(self, stages: dict = None):
+        self.stages = stages if stages is not None else {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def add(self, name: str, ms: float):
+        self.stages[name] = round(self.stages.get(name, 0) + ms, 1)
+
+    def elapsed_ms(self) -> int:
+        """Milliseconds since the timer was created."""
+        return round((time.perf_counter() - self.started) * 1000)
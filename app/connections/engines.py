@@ -0,0 +1,201 @@
+"""
+Worker-local registry of pooled SQLAlchemy engines for source databases.
+
+Creating an engine per task throws the connection pool away, so every query
+pays a full TCP/TLS/auth handshake. Instead, each worker process keeps one
+engine per `Connection`, keyed by the connection id plus a fingerprint of its
+credentials and options. Engines are created lazily (i.e. after Celery forks
+its pool children), so no pooled sockets are ever shared across processes.
+"""
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from .models import Connection
+
+
+def get_db_url(conn: Connection) -> str:
+    """Helper function to build a SQLAlchemy URL from a Connection object."""
+    password = conn.password # Decrypts the password
+    if conn.driver == 'postgres':
+        return f"postgresql+psycopg://{conn.username}:{password}@{conn.host}:{conn.port}/{conn.database}"
+    elif conn.driver == 'mysql':
+        return f"mysql+pymysql://{conn.username}:{password}@{conn.host}:{conn.port}/{conn.database}"
+    elif conn.driver == 'mssql':
+        return f"mssql+pyodbc://{conn.username}:{password}@{conn.host}:{conn.port}/{conn.database}?driver=ODBC+Driver+17+for+SQL+Server"
+    elif conn.driver == 'sqlite':
+        return f"sqlite:///{conn.database}"
+    raise ValueError(f"Unsupported driver: {conn.driver}")
+
+
+# SQLAlchemy asyncio dialects used by the async execution worker. SQL Server
+# has no asyncio driver; its queries run on a thread there instead.
+ASYNC_DRIVER_URLS = {
+    'postgres': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def get_async_db_url(conn: Connection) -> str:
+    """Like `get_db_url`, for the connection's asyncio driver."""
+    if conn.driver not in ASYNC_DRIVER_URLS:
+        raise ValueError(f"No asyncio driver for: {conn.driver}")
+    url = get_db_url(conn)
+    return ASYNC_DRIVER_URLS[conn.driver] + url[url.index('://'):]
+
+
+def get_async_connect_args(conn: Connection) -> dict:
+    """Connect arguments for the asyncio drivers; asyncpg calls its connect timeout `timeout`."""
+    if conn.driver == 'postgres':
+        return {'timeout': settings.SOURCE_CONNECT_TIMEOUT_SEC}
+    return get_connect_args(conn)
+
+
+def get_connect_args(conn: Connection) -> dict:
+    """
+    Returns the DBAPI connect arguments for a connection's driver.
+    Each driver spells its connect timeout differently.
+    """
+    timeout_sec = settings.SOURCE_CONNECT_TIMEOUT_SEC
+    if conn.driver in ('postgres', 'mysql'):
+        return {'connect_timeout': timeout_sec}
+    if conn.driver in ('mssql', 'sqlite'):
+        return {'timeout': timeout_sec}
+    return {}
+
+
+def connection_fingerprint(conn: Connection) -> str:
+    """
+    A stable hash of everything that affects how we connect. When any of these
+    change, the cached engine for the connection is stale and must be replaced.
+    """
+    material = [
+        conn.driver, conn.host, conn.port, conn.database, conn.username,
+        conn.secret_encrypted, conn.options_json,
+    ]
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class _EngineEntry:
+    fingerprint: str
+    engine: Engine
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class EngineRegistry:
+    """
+    Caches one pooled engine per connection for the lifetime of a process.
+
+    - Engines whose fingerprint no longer matches the `Connection` row are
+      disposed and rebuilt on the next lookup.
+    - Engines unused for longer than `idle_timeout` seconds are disposed.
+    - At most `max_engines` engines are kept; the least recently used one is
+      disposed first.
+    """
+    def __init__(self, max_engines: int, idle_timeout: float):
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, conn: Connection) -> Engine:
+        fingerprint = connection_fingerprint(conn)
+        stale = []
+        with self._lock:
+            stale.extend(self._pop_idle())
+            entry = self._entries.get(conn.pk)
+            if entry is not None and entry.fingerprint != fingerprint:
+                stale.append(self._entries.pop(conn.pk))
+                entry = None
+            if entry is None:
+                entry = _EngineEntry(fingerprint=fingerprint, engine=self._create_engine(conn))
+                self._entries[conn.pk] = entry
+                stale.extend(self._pop_overflow())
+            entry.last_used = time.monotonic()
+            engine = entry.engine
+
+        # Disposal may block on the network, so do it outside the lock.
+        for old in stale:
+            self._dispose(old.engine)
+        return engine
+
+    def invalidate(self, connection_id: int):
+        """Disposes the cached engine for a connection, if there is one."""
+        with self._lock:
+            entry = self._entries.pop(connection_id, None)
+        if entry is not None:
+            self._dispose(entry.engine)
+
+    def dispose_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._dispose(entry.engine)
+
+    def __contains__(self, connection_id):
+        return connection_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _create_engine(self, conn: Connection) -> Engine:
+        options = {
+            'connect_args': get_connect_args(conn),
+            'pool_pre_ping': True,
+            'pool_recycle': settings.SOURCE_ENGINE_POOL_RECYCLE_SEC,
+        }
+        # SQLite picks its own pool class; QueuePool sizing only applies to servers.
+        if conn.driver != 'sqlite':
+            options.update(
+                pool_size=settings.SOURCE_ENGINE_POOL_SIZE,
+                max_overflow=settings.SOURCE_ENGINE_MAX_OVERFLOW,
+                pool_timeout=settings.SOURCE_ENGINE_POOL_TIMEOUT_SEC,
+            )
+        return create_engine(get_db_url(conn), **options)
+
+    def _dispose(self, engine):
+        engine.dispose()
+
+    def _pop_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [pk for pk, entry in self._entries.items() if entry.last_used < cutoff]
+        return [self._entries.pop(pk) for pk in idle]
+
+    def _pop_overflow(self):
+        overflow = len(self._entries) - self.max_engines
+        if overflow <= 0:
+            return []
+        oldest = sorted(self._entries, key=lambda pk: self._entries[pk].last_used)[:overflow]
+        return [self._entries.pop(pk) for pk in oldest]
+
+
+registry = EngineRegistry(
+    max_engines=settings.SOURCE_ENGINE_MAX_ENGINES,
+    idle_timeout=settings.SOURCE_ENGINE_IDLE_TIMEOUT_SEC,
+)
+
+
+def get_engine(conn: Connection) -> Engine:
+    """Returns the pooled engine for a connection, creating it if needed."""
+    return registry.get(conn)
+
+
+@receiver(post_save, sender=Connection)
+@receiver(post_delete, sender=Connection)
+def invalidate_connection_engine(sender, instance, **kwargs):
+    """
+    Drops the cached engine when a connection is edited or deleted in this
+    process. Other worker processes notice the change through the fingerprint.
+    """
+    registry.invalidate(instance.pk)
@@ -0,0 +1,141 @@
+"""
+Per-connection concurrency limiting and admission control.
+
+Each `Connection` gets a distributed counting semaphore in Redis, so no
+more than `max_concurrency` queries run against a customer database at once,
+across all workers. Slots are leases with an expiry: a worker that dies
+mid-query cannot hold a slot forever, and one that is still working renews
+its lease (see `LeaseKeeper`).
+
+- `conn_limiter:<id>:leases` sorted set of lease ids scored by expiry time.
+- `conn_limiter:<id>:waiting` sorted set of waiters scored by when they started waiting.
+
+The connection limit comes from `options_json["max_concurrency"]`, falling
+back to SOURCE_MAX_CONCURRENCY. Waiters give up after
+SOURCE_ADMISSION_MAX_WAIT_SEC, so older entries in the waiting set belong to
+workers that died and are dropped.
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from app.common.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionLimiter:
+    def __init__(self, connection, client=None):
+        self.connection = connection
+        self.client = client or get_redis()
+        self.leases_key = f"conn_limiter:{connection.id}:leases"
+        self.waiting_key = f"conn_limiter:{connection.id}:waiting"
+
+    @property
+    def max_concurrency(self) -> int:
+        return int(self.connection.options_json.get('max_concurrency', settings.SOURCE_MAX_CONCURRENCY))
+
+    def acquire(self, lease_id, ttl: float) -> bool:
+        """
+        Takes a slot for `lease_id` for at most `ttl` seconds. On failure the
+        caller is registered as waiting (see `queue_length` and `waited`).
+        """
+        def take_slot(pipe):
+            now = time.time()
+            pipe.zremrangebyscore(self.leases_key, '-inf', now)
+            if pipe.zcard(self.leases_key) >= self.max_concurrency:
+                pipe.multi()
+                pipe.zadd(self.waiting_key, {lease_id: now}, nx=True)
+                return False
+            pipe.multi()
+            pipe.zadd(self.leases_key, {lease_id: now + ttl})
+            return True
+
+        acquired = self.client.transaction(take_slot, self.leases_key, value_from_callable=True)
+        if acquired:
+            wait_ms = self.waited(lease_id) * 1000
+            self.client.zrem(self.waiting_key, lease_id)
+            logger.info(
+                "Connection slot acquired",
+                extra={
+                    'connection_id': self.connection.id,
+                    'wait_ms': round(wait_ms),
+                    'queue_length': self.queue_length(),
+                    'in_flight': self.in_flight(),
+                },
+            )
+        return acquired
+
+    def renew(self, lease_id, ttl: float) -> bool:
+        """Extends a held slot to `ttl` seconds from now. Returns False if the lease has already expired."""
+        return bool(self.client.zadd(self.leases_key, {lease_id: time.time() + ttl}, xx=True, ch=True))
+
+    def release(self, lease_id):
+        try:
+            self.client.zrem(self.leases_key, lease_id)
+        except redis.RedisError:
+            # The lease expires on its own.
+            logger.warning("Could not release connection slot", exc_info=True)
+
+    def abandon(self, lease_id):
+        """Stops waiting for a slot (e.g. when the request is rejected)."""
+        self.client.zrem(self.waiting_key, lease_id)
+
+    def waited(self, lease_id) -> float:
+        """Seconds `lease_id` has been waiting for a slot (0 if it isn't waiting)."""
+        since = self.client.zscore(self.waiting_key, lease_id)
+        return time.time() - since if since is not None else 0.0
+
+    def retry_after(self) -> float:
+        """Seconds until the oldest lease expires at the latest; a hint for when to retry."""
+        oldest = self.client.zrange(self.leases_key, 0, 0, withscores=True)
+        if not oldest:
+            return 0.0
+        return max(oldest[0][1] - time.time(), 0.0)
+
+    def in_flight(self) -> int:
+        return self.client.zcount(self.leases_key, time.time(), '+inf')
+
+    def queue_length(self) -> int:
+        stale = time.time() - settings.SOURCE_ADMISSION_MAX_WAIT_SEC - settings.SOURCE_ADMISSION_RETRY_SEC
+        self.client.zremrangebyscore(self.waiting_key, '-inf', stale)
+        return self.client.zcard(self.waiting_key)
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight(),
+            'queue_length': self.queue_length(),
+        }
+
+
+class LeaseKeeper:
+    """
+    Keeps leases alive for work that outlasts a single TTL, such as fetching
+    a large result or streaming an export. `tick()` is called once per unit
+    of work (a fetched chunk) and renews every lease once a third of the TTL
+    has passed since the last renewal. `leases` are `(holder, lease_id)`
+    pairs whose holder has `renew(lease_id, ttl)`.
+    """
+    def __init__(self, ttl: float, *leases):
+        self.ttl = ttl
+        self.leases = leases
+        self._renewed_at = time.monotonic()
+
+    def due(self) -> bool:
+        return time.monotonic() - self._renewed_at >= self.ttl / 3
+
+    def renew(self):
+        self._renewed_at = time.monotonic()
+        for holder, lease_id in self.leases:
+            try:
+                holder.renew(lease_id, self.ttl)
+            except redis.RedisError:
+                # The lease runs on until its current expiry.
+                logger.warning("Could not renew lease", exc_info=True)
+
+    def tick(self):
+        if self.due():
+            self.renew()
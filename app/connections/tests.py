@@ -6,6 +6,8 @@ from rest_framework.test import APIClient
 from app.tenancy.models import Tenant, Membership
 from app.accounts.models import User
 from .models import Connection
+from .engines import EngineRegistry, get_engine, registry as engine_registry
+from .limiter import ConnectionLimiter, LeaseKeeper
 from app.schema_registry.models import SchemaCache
 
 pytestmark = pytest.mark.django_db
@@ -92,3 +94,106 @@ def test_api_schema_endpoint_not_found(authenticated_client_with_tenant):
 
     assert response.status_code == status.HTTP_404_NOT_FOUND
     assert response.data['status'] == 'error'
+
+# --- Engine Registry Tests ---
+
+@pytest.fixture
+def sqlite_connection(tmp_path):
+    tenant = Tenant.objects.create(name="Engine Tenant")
+    return Connection.objects.create(
+        tenant=tenant, name="Local SQLite", driver="sqlite", database=str(tmp_path / "source.db")
+    )
+
+def test_engine_registry_reuses_engine(sqlite_connection):
+    """
+    Repeated lookups for an unchanged connection must return the same pooled engine.
+    """
+    registry = EngineRegistry(max_engines=4, idle_timeout=60)
+    assert registry.get(sqlite_connection) is registry.get(sqlite_connection)
+    assert len(registry) == 1
+
+def test_engine_registry_rebuilds_on_changed_fingerprint(sqlite_connection, tmp_path):
+    """
+    Editing the connection (even from another process) must produce a fresh engine.
+    """
+    registry = EngineRegistry(max_engines=4, idle_timeout=60)
+    first = registry.get(sqlite_connection)
+
+    sqlite_connection.database = str(tmp_path / "other.db")
+    assert registry.get(sqlite_connection) is not first
+    assert len(registry) == 1
+
+def test_engine_registry_evicts_idle_and_overflow(sqlite_connection, tmp_path):
+    registry = EngineRegistry(max_engines=1, idle_timeout=60)
+    registry.get(sqlite_connection)
+
+    other = Connection.objects.create(
+        tenant=sqlite_connection.tenant, name="Other SQLite", driver="sqlite", database=str(tmp_path / "b.db")
+    )
+    registry.get(other)
+    assert sqlite_connection.pk not in registry
+    assert other.pk in registry
+
+    registry.idle_timeout = 0
+    registry.get(sqlite_connection)
+    assert other.pk not in registry
+
+def test_connection_save_and_delete_invalidate_engine(sqlite_connection):
+    get_engine(sqlite_connection)
+    assert sqlite_connection.pk in engine_registry
+
+    sqlite_connection.save()
+    assert sqlite_connection.pk not in engine_registry
+
+    get_engine(sqlite_connection)
+    pk = sqlite_connection.pk
+    sqlite_connection.delete()
+    assert pk not in engine_registry
+
+# --- Concurrency Limiter Tests ---
+
+@pytest.fixture
+def limiter_client():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis()
+
+def test_limiter_caps_concurrent_leases(sqlite_connection, limiter_client, settings):
+    settings.SOURCE_MAX_CONCURRENCY = 2
+    limiter = ConnectionLimiter(sqlite_connection, client=limiter_client)
+
+    assert limiter.acquire(1, ttl=60)
+    assert limiter.acquire(2, ttl=60)
+    assert not limiter.acquire(3, ttl=60)
+    assert limiter.stats() == {'max_concurrency': 2, 'in_flight': 2, 'queue_length': 1}
+    assert 0 < limiter.retry_after() <= 60
+
+    # A released slot goes to the waiter, which leaves the queue
+    limiter.release(1)
+    assert limiter.acquire(3, ttl=60)
+    assert limiter.queue_length() == 0
+
+def test_lease_keeper_renews_held_slots(sqlite_connection, limiter_client):
+    limiter = ConnectionLimiter(sqlite_connection, client=limiter_client)
+    assert limiter.acquire(1, ttl=5)
+    keeper = LeaseKeeper(60, (limiter, 1))
+
+    # Nothing is renewed until a third of the TTL has passed
+    keeper.tick()
+    assert limiter.retry_after() <= 5
+    keeper._renewed_at -= 20
+    keeper.tick()
+    assert limiter.retry_after() > 55
+
+    # An expired lease is not brought back
+    limiter.release(1)
+    assert not limiter.renew(1, ttl=60)
+    assert limiter.in_flight() == 0
+
+def test_limiter_honours_connection_option_and_expired_leases(sqlite_connection, limiter_client):
+    sqlite_connection.options_json = {'max_concurrency': 1}
+    limiter = ConnectionLimiter(sqlite_connection, client=limiter_client)
+
+    # A lease held by a dead worker expires instead of blocking the connection
+    assert limiter.acquire(1, ttl=-1)
+    assert limiter.acquire(2, ttl=60)
+    assert not limiter.acquire(3, ttl=60)
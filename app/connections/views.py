@@ -2,6 +2,7 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from sqlalchemy import create_engine, text
+from .limiter import ConnectionLimiter
 from .models import Connection
 from .serializers import ConnectionSerializer
 from app.schema_registry.models import SchemaCache
@@ -58,7 +59,17 @@ class ConnectionViewSet(viewsets.ModelViewSet):
             return Response({
                 'payload': schema_cache.payload_json,
                 'graph': schema_cache.graph_json,
+                # Estimated rows and bytes per table, e.g. to size the ERD's nodes
+                'stats': schema_cache.stats_json,
                 'refreshed_at': schema_cache.refreshed_at
             })
         except SchemaCache.DoesNotExist:
             return Response({'status': 'error', 'message': 'Schema not found. Please run introspection first.'}, status=status.HTTP_404_NOT_FOUND)
+
+    @action(detail=True, methods=['get'])
+    def load(self, request, pk=None):
+        """
+        Reports the connection's concurrency limit, running queries and queue length.
+        """
+        connection = self.get_object()
+        return Response(ConnectionLimiter(connection).stats())
@@ -1,18 +1,29 @@
 import requests
 from django.conf import settings
+from app.common.timing import StageTimer
 from app.connections.models import Connection
 from app.schema_registry.models import SchemaCache
+from app.queries.local import LOCAL_TABLE, local_columns
 from app.queries.models import PromptExample
 
 class LLMOrchestrator:
     """
     This service constructs the prompt for the LLM and calls the provider.
     """
-    def __init__(self, connection: Connection, prompt: str):
+    def __init__(self, connection: Connection, prompt: str, timer: StageTimer = None, follow_up_of=None):
         self.connection = connection
         self.prompt = prompt
-        self.schema_cache = self._get_schema_cache()
-        self.few_shot_examples = self._get_few_shot_examples()
+        # A follow-up refines this QueryHistory's stored result instead of querying the source
+        self.follow_up_of = follow_up_of
+        # Records schema_load, prompt_build and llm_call times
+        self.timer = timer or StageTimer()
+        if follow_up_of is not None:
+            # The previous result is described from its own columns
+            self.schema_cache, self.few_shot_examples = None, PromptExample.objects.none()
+            return
+        with self.timer.stage('schema_load'):
+            self.schema_cache = self._get_schema_cache()
+            self.few_shot_examples = self._get_few_shot_examples()
 
     def _get_schema_cache(self):
         try:
@@ -29,6 +40,9 @@ class LLMOrchestrator:
         """
         Constructs the detailed system prompt for the LLM.
         """
+        if self.follow_up_of is not None:
+            return self._build_follow_up_prompt()
+
         dialect = self.connection.get_driver_display()
 
         system_prompt = f"You are an expert {dialect} data analyst. Your task is to write a single, safe, read-only SQL SELECT statement to answer the user's question.\n"
@@ -38,10 +52,14 @@ class LLMOrchestrator:
             system_prompt += "\n--- Database Schema ---\n"
             # In a real implementation, we would be more intelligent about which tables/columns to include
             # based on the user's prompt (e.g., using embeddings). For now, we include everything.
+            # Row estimates tell large fact tables from small lookup tables
+            stats = self.schema_cache.stats_json or {}
             for table in self.schema_cache.payload_json.get('tables', []):
                 table_name = table.get('name')
                 columns = ", ".join([col.get('name') for col in table.get('columns', [])])
-                system_prompt += f"Table {table_name}: ({columns})\n"
+                rows = (stats.get(table_name) or {}).get('rows')
+                size = f" (~{rows:,} rows)" if rows is not None else ""
+                system_prompt += f"Table {table_name}{size}: ({columns})\n"
 
         if self.few_shot_examples.exists():
             system_prompt += "\n--- Examples ---\n"
@@ -50,11 +68,27 @@ class LLMOrchestrator:
 
         return system_prompt
 
+    def _build_follow_up_prompt(self) -> str:
+        """
+        Constructs the system prompt for refining a previous result, which
+        runs on the local SQLite engine rather than the source database.
+        """
+        system_prompt = "You are an expert SQLite data analyst. Your task is to write a single, safe, read-only SQL SELECT statement that refines the result of a previous query to answer the user's question.\n"
+        system_prompt += "Do not produce any explanation, only the SQL query.\n"
+        system_prompt += f"\nThe previous result is the only table available, {LOCAL_TABLE}.\n"
+        system_prompt += f"It was produced by: {self.follow_up_of.generated_sql}\n"
+
+        columns = ", ".join(f"{name} {type_}" for name, type_ in local_columns(self.follow_up_of))
+        system_prompt += "\n--- Database Schema ---\n"
+        system_prompt += f"Table {LOCAL_TABLE}: ({columns})\n"
+        return system_prompt
+
     def generate_sql(self) -> str:
         """
         Calls the external LLM provider to generate the SQL.
         """
-        system_prompt = self._build_system_prompt()
+        with self.timer.stage('prompt_build'):
+            system_prompt = self._build_system_prompt()
 
         # This is a placeholder for a real API call.
         # In a real app, you would use a library like `requests` or the provider's SDK.
@@ -76,14 +110,17 @@ class LLMOrchestrator:
             "temperature": 0.0,
         }
 
-        # MOCK RESPONSE - In a real scenario, we would make the request.
-        # try:
-        #     response = requests.post(llm_url, json=payload, headers=headers, timeout=15)
-        #     response.raise_for_status()
-        #     return response.json()['choices'][0]['message']['content']
-        # except requests.RequestException as e:
-        #     # Handle API errors
-        #     return f"Error: Could not connect to LLM provider. {e}"
-
-        # For now, return a mock SQL statement for testing purposes.
-        return "SELECT id, name, email FROM users WHERE email LIKE '%@example.com%';"
+        with self.timer.stage('llm_call'):
+            # MOCK RESPONSE - In a real scenario, we would make the request.
+            # try:
+            #     response = requests.post(llm_url, json=payload, headers=headers, timeout=15)
+            #     response.raise_for_status()
+            #     return response.json()['choices'][0]['message']['content']
+            # except requests.RequestException as e:
+            #     # Handle API errors
+            #     return f"Error: Could not connect to LLM provider. {e}"
+
+            # For now, return a mock SQL statement for testing purposes.
+            if self.follow_up_of is not None:
+                return f"SELECT * FROM {LOCAL_TABLE};"
+            return "SELECT id, name, email FROM users WHERE email LIKE '%@example.com%';"
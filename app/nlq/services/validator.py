@@ -1,5 +1,6 @@
 import sqlglot
 from sqlglot import exp
+from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
 
 class InvalidSQLError(ValueError):
     """Custom exception for validation errors."""
@@ -9,7 +10,7 @@ class SQLValidator:
     """
     Validates a SQL query to ensure it is safe to execute.
     """
-    FORBIDDEN_DML = (exp.Insert, exp.Update, exp.Delete, exp.Truncate)
+    FORBIDDEN_DML = (exp.Insert, exp.Update, exp.Delete, exp.TruncateTable)
     FORBIDDEN_DDL = (exp.Drop, exp.Create, exp.Alter)
 
     FORBIDDEN_FUNCTIONS = (
@@ -17,17 +18,28 @@ class SQLValidator:
         'pg_sleep',
     )
 
+    # Maps Connection.driver values to sqlglot dialect names.
+    DRIVER_DIALECTS = {
+        'postgres': 'postgres',
+        'mysql': 'mysql',
+        'sqlite': 'sqlite',
+        'mssql': 'tsql',
+    }
+
     def __init__(self, sql: str, dialect: str = 'tsql'):
         self.sql = sql
-        self.dialect = dialect
+        self.dialect = self.DRIVER_DIALECTS.get(dialect, dialect)
         self.expression = self._parse()
 
     def _parse(self):
         try:
-            # We expect only a single SQL statement.
-            return sqlglot.parse_one(self.sql, read=self.dialect)
+            statements = [statement for statement in sqlglot.parse(self.sql, read=self.dialect) if statement]
         except sqlglot.errors.ParseError as e:
             raise InvalidSQLError(f"Invalid SQL syntax: {e}")
+        # We expect only a single SQL statement.
+        if len(statements) != 1:
+            raise InvalidSQLError(f"Invalid SQL syntax: expected a single statement, got {len(statements)}.")
+        return statements[0]
 
     def validate(self):
         """
@@ -35,10 +47,10 @@ class SQLValidator:
         """
         # Check for forbidden top-level statements first
         if isinstance(self.expression, self.FORBIDDEN_DML):
-             raise InvalidSQLError("DML statements are not allowed.")
+             raise InvalidSQLError("Only SELECT statements are allowed; DML statements are not allowed.")
 
         if isinstance(self.expression, self.FORBIDDEN_DDL):
-             raise InvalidSQLError("DDL statements are not allowed.")
+             raise InvalidSQLError("Only SELECT statements are allowed; DDL statements are not allowed.")
 
         # If it's not one of the forbidden types, it must be a SELECT.
         if not isinstance(self.expression, exp.Select):
@@ -46,7 +58,62 @@ class SQLValidator:
 
         # Finally, check for any forbidden functions within the query.
         for func in self.expression.find_all(exp.Func):
-            if func.this.name.lower() in self.FORBIDDEN_FUNCTIONS:
-                raise InvalidSQLError(f"Forbidden function call found: {func.this.name}")
+            # Functions sqlglot doesn't know are parsed as Anonymous, under their own name
+            name = func.name if isinstance(func, exp.Anonymous) else func.sql_name()
+            if name.lower() in self.FORBIDDEN_FUNCTIONS:
+                raise InvalidSQLError(f"Forbidden function call found: {name}")
 
         return True
+
+    def apply_row_limit(self, max_rows: int) -> str:
+        """
+        Returns the SQL with its outermost row limit capped at `max_rows`,
+        rendered in the validator's dialect (LIMIT, TOP or FETCH FIRST).
+        An existing, smaller limit is kept as is.
+        """
+        expression = self.expression.copy()
+        limit = expression.args.get('limit')
+        if isinstance(limit, exp.Limit):
+            current = limit.expression
+        elif isinstance(limit, exp.Fetch):
+            current = limit.args.get('count')
+        else:
+            current = None
+
+        if not (isinstance(current, exp.Literal) and current.is_int and int(current.name) <= max_rows):
+            expression = expression.limit(max_rows)
+        return expression.sql(dialect=self.dialect)
+
+    def apply_sampling(self, percent: float, scan_rows: int):
+        """
+        Rewrites the query to read from samples of its tables, for a quick,
+        approximate preview. Postgres and SQL Server sample pages with
+        `TABLESAMPLE SYSTEM (percent)`; other dialects read at most
+        `scan_rows` rows of each table. The rewrite replaces the parsed query,
+        so `apply_row_limit` and `normalized_sql` render the sampled version.
+        """
+        expression = self.expression.copy()
+        ctes = {cte.alias_or_name.lower() for cte in expression.find_all(exp.CTE)}
+        tables = [
+            table for table in expression.find_all(exp.Table)
+            if isinstance(table.this, exp.Identifier) and (table.db or table.name.lower() not in ctes)
+        ]
+        for table in tables:
+            if self.dialect in ('postgres', 'tsql'):
+                table.set('sample', exp.TableSample(method=exp.var('SYSTEM'), percent=exp.Literal.number(percent)))
+            else:
+                alias = table.alias_or_name
+                source = table.copy()
+                source.set('alias', None)
+                table.replace(exp.select('*').from_(source).limit(scan_rows).subquery(alias))
+        self.expression = expression
+        return self
+
+    def normalized_sql(self) -> str:
+        """
+        Returns a canonical rendering of the query: whitespace, keyword case
+        and comments don't affect it, nor does the case of identifiers the
+        dialect treats as case-insensitive (MySQL table names, for one, are not).
+        """
+        expression = normalize_identifiers(self.expression.copy(), dialect=self.dialect)
+        return expression.sql(dialect=self.dialect, comments=False)
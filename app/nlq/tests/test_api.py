@@ -1,16 +1,27 @@
+import fakeredis
 import pytest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 from app.tenancy.models import Tenant, Membership
 from app.accounts.models import User
+from app.connections.limiter import ConnectionLimiter
 from app.connections.models import Connection
 from app.schema_registry.models import SchemaCache
+from app.queries.handoff import FirstPageHandoff
+from app.queries.cost import LOW_PRIORITY, REJECT, CostEstimate
 from app.queries.models import QueryHistory
 
 pytestmark = pytest.mark.django_db
 
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    """Replaces the shared Redis client with an in-memory one."""
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr('app.common.redis._client', client)
+    return client
+
 @pytest.fixture
 def api_client_with_tenant_and_connection():
     """Fixture for an authenticated client with tenant and connection setup."""
@@ -26,9 +37,9 @@ def api_client_with_tenant_and_connection():
 
     return client, connection
 
-@patch('app.queries.tasks.execute_query_task.delay')
+@patch('app.queries.tasks.execute_query_task.apply_async')
 @patch('app.nlq.views.LLMOrchestrator')
-def test_nlq_api_flow(mock_orchestrator, mock_task_delay, api_client_with_tenant_and_connection):
+def test_nlq_api_flow(mock_orchestrator, mock_task_apply_async, settings, api_client_with_tenant_and_connection):
     """
     Integration test for the full NLQ API flow, with mocking.
     """
@@ -61,4 +72,108 @@ def test_nlq_api_flow(mock_orchestrator, mock_task_delay, api_client_with_tenant
     assert history.generated_sql == "SELECT id FROM users;"
 
     # Check that the Celery task was enqueued with the history ID
-    mock_task_delay.assert_called_once_with(history.id)
+    mock_task_apply_async.assert_called_once_with(
+        (history.id,), {'first_page': False}, priority=settings.QUERY_PRIORITY_INTERACTIVE
+    )
+
+@pytest.fixture
+def logged_in_client_and_connection():
+    user = User.objects.create_user(username='testuser', password='password123')
+    tenant = Tenant.objects.create(name="Test Tenant")
+    Membership.objects.create(user=user, tenant=tenant)
+    connection = Connection.objects.create(tenant=tenant, name="Test DB", driver="postgres")
+    client = APIClient()
+    client.force_login(user)
+    client.credentials(HTTP_X_TENANT_ID=tenant.id)
+    return client, connection
+
+@patch('app.nlq.views.LLMOrchestrator')
+def test_nlq_api_rejects_when_connection_queue_is_full(mock_orchestrator, settings, logged_in_client_and_connection):
+    """
+    Over the admission limit, the API sheds load with a retry hint before calling the LLM.
+    """
+    client, connection = logged_in_client_and_connection
+
+    settings.SOURCE_MAX_CONCURRENCY = 1
+    settings.SOURCE_ADMISSION_MAX_QUEUE = 1
+    limiter = ConnectionLimiter(connection)
+    assert limiter.acquire('running', ttl=30)
+    assert not limiter.acquire('queued', ttl=30)
+
+    response = client.post(reverse('nlq'), {'prompt': 'Show me all users', 'connection_id': connection.id}, format='json')
+
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert 0 < int(response['Retry-After']) <= 30
+    mock_orchestrator.assert_not_called()
+    assert QueryHistory.objects.count() == 0
+
+@patch('app.queries.tasks.execute_query_task.apply_async')
+@patch('app.nlq.views.assess_cost')
+@patch('app.nlq.views.LLMOrchestrator')
+def test_nlq_api_admits_by_estimated_cost(mock_orchestrator, mock_assess_cost, mock_apply_async, settings, logged_in_client_and_connection):
+    """
+    Expensive queries are routed to the low-priority queue; runaway ones are rejected without running.
+    """
+    client, connection = logged_in_client_and_connection
+    mock_orchestrator.return_value.generate_sql.return_value = "SELECT * FROM a, b"
+    mock_apply_async.return_value.id = 'task-id'
+    url = reverse('nlq')
+    data = {'prompt': 'Everything', 'connection_id': connection.id}
+
+    mock_assess_cost.return_value = (CostEstimate(rows=2e7, cost=1e6), LOW_PRIORITY)
+    response = client.post(url, data, format='json')
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert 'warning' in response.data
+    history = QueryHistory.objects.get(id=response.data['history_id'])
+    assert history.estimated_rows == 2e7
+    assert {'validate', 'cost_estimate'} <= set(history.timings)
+    mock_apply_async.assert_called_once_with((history.id,), queue=settings.QUERY_LOW_PRIORITY_QUEUE)
+
+    mock_assess_cost.return_value = (CostEstimate(rows=1e12), REJECT)
+    response = client.post(url, data, format='json')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.data['cost']['decision'] == REJECT
+    assert QueryHistory.objects.filter(status=QueryHistory.Status.ERROR).count() == 1
+    mock_apply_async.assert_called_once()
+
+@patch('app.queries.tasks.execute_query_task.apply_async')
+@patch('app.nlq.views.LLMOrchestrator')
+def test_nlq_api_returns_first_page_inline(mock_orchestrator, mock_apply_async, settings, logged_in_client_and_connection):
+    """
+    In first-page mode the API waits for the worker's first page and returns it with the generated SQL.
+    """
+    client, connection = logged_in_client_and_connection
+    settings.FIRST_PAGE_ROWS = 1
+    mock_orchestrator.return_value.generate_sql.return_value = "SELECT id FROM users"
+
+    def run_worker(args, kwargs, **options):
+        assert kwargs == {'first_page': True}
+        FirstPageHandoff(args[0]).offer(['id'], [[1], [2]])
+        return MagicMock(id='task-id')
+    mock_apply_async.side_effect = run_worker
+
+    response = client.post(reverse('nlq'), {'prompt': 'Users', 'connection_id': connection.id, 'first_page': True}, format='json')
+
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.data['first_page'] == {'complete': False, 'columns': ['id'], 'rows': [[1]]}
+
+@patch('app.queries.tasks.execute_query_task.apply_async')
+@patch('app.nlq.views.assess_cost')
+@patch('app.nlq.views.LLMOrchestrator')
+def test_nlq_api_preview_estimates_sampled_query(mock_orchestrator, mock_assess_cost, mock_apply_async, settings, logged_in_client_and_connection):
+    """
+    A preview is costed on its sampled SQL, recorded as a preview and labelled approximate.
+    """
+    settings.PREVIEW_SAMPLE_PERCENT = 2
+    client, connection = logged_in_client_and_connection
+    mock_orchestrator.return_value.generate_sql.return_value = "SELECT id FROM sales"
+    mock_assess_cost.return_value = (CostEstimate(), 'admit')
+    mock_apply_async.return_value.id = 'task-id'
+
+    response = client.post(reverse('nlq'), {'prompt': 'Sales', 'connection_id': connection.id, 'preview': True}, format='json')
+
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.data['approximate'] is True
+    assert response.data['generated_sql'] == "SELECT id FROM sales"
+    assert "TABLESAMPLE SYSTEM (2)" in mock_assess_cost.call_args.args[1]
+    assert QueryHistory.objects.get(id=response.data['history_id']).preview
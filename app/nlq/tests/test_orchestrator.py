@@ -1,5 +1,6 @@
 import pytest
 from ..services.orchestrator import LLMOrchestrator
+from app.common.timing import StageTimer
 from app.connections.models import Connection
 from app.schema_registry.models import SchemaCache
 from app.queries.models import PromptExample
@@ -55,3 +56,25 @@ def test_orchestrator_builds_prompt_correctly(connection_with_schema_and_example
     assert "--- Examples ---" in system_prompt
     assert "Question: How many users?" in system_prompt
     assert "SQL: SELECT count(*) FROM users;" in system_prompt
+
+def test_orchestrator_times_each_stage(connection_with_schema_and_examples):
+    """
+    Schema load, prompt build and the LLM call are recorded on the timer passed in.
+    """
+    timer = StageTimer()
+    orchestrator = LLMOrchestrator(connection=connection_with_schema_and_examples, prompt="Show me all users.", timer=timer)
+    orchestrator.generate_sql()
+
+    assert set(timer.stages) == {'schema_load', 'prompt_build', 'llm_call'}
+    assert all(ms >= 0 for ms in timer.stages.values())
+
+def test_orchestrator_annotates_tables_with_row_estimates(connection_with_schema_and_examples):
+    """
+    Catalog row estimates are shown next to each table, so the model can tell fact tables from lookups.
+    """
+    SchemaCache.objects.filter(connection=connection_with_schema_and_examples).update(
+        stats_json={'users': {'rows': 1200000, 'bytes': None, 'analyzed_at': None}}
+    )
+    orchestrator = LLMOrchestrator(connection=connection_with_schema_and_examples, prompt="Show me all users.")
+
+    assert "Table users (~1,200,000 rows): (id, email)" in orchestrator._build_system_prompt()
@@ -26,7 +26,64 @@ def test_validator_rejects_forbidden_function():
     with pytest.raises(InvalidSQLError, match="Forbidden function call found: pg_sleep"):
         SQLValidator(sql, dialect='postgres').validate()
 
+def test_validator_allows_unknown_function():
+    sql = "SELECT my_udf(amount) FROM invoices;"
+    assert SQLValidator(sql, dialect='postgres').validate() is True
+
+def test_validator_rejects_empty_sql():
+    with pytest.raises(InvalidSQLError, match="expected a single statement, got 0"):
+        SQLValidator("  ;  ").validate()
+
 def test_validator_allows_safe_function():
     sql = "SELECT COUNT(*) FROM users;"
     validator = SQLValidator(sql)
     assert validator.validate() is True
+
+def test_row_limit_added_to_unlimited_query():
+    sql = "SELECT limit_amount FROM invoices"
+    assert SQLValidator(sql, dialect='postgres').apply_row_limit(100) == "SELECT limit_amount FROM invoices LIMIT 100"
+
+def test_row_limit_uses_top_for_mssql():
+    sql = "SELECT id FROM users"
+    assert SQLValidator(sql, dialect='mssql').apply_row_limit(100) == "SELECT TOP 100 id FROM users"
+
+def test_row_limit_caps_larger_existing_limit():
+    validator = SQLValidator("SELECT id FROM users LIMIT 5000", dialect='mysql')
+    assert validator.apply_row_limit(100) == "SELECT id FROM users LIMIT 100"
+
+def test_row_limit_keeps_smaller_existing_limit():
+    validator = SQLValidator("SELECT TOP 10 id FROM users", dialect='mssql')
+    assert validator.apply_row_limit(100) == "SELECT TOP 10 id FROM users"
+
+def test_row_limit_caps_fetch_first():
+    sql = "SELECT id FROM users ORDER BY id OFFSET 0 ROWS FETCH FIRST 500 ROWS ONLY"
+    assert SQLValidator(sql, dialect='mssql').apply_row_limit(100).endswith("FETCH FIRST 100 ROWS ONLY")
+
+def test_sampling_uses_tablesample_on_postgres_and_mssql():
+    sql = "WITH recent AS (SELECT * FROM sales WHERE day > '2024-01-01') SELECT r.id FROM recent AS r JOIN customers c ON c.id = r.customer_id"
+    validator = SQLValidator(sql, dialect='postgres').apply_sampling(1, 10000)
+    assert validator.apply_row_limit(100) == (
+        "WITH recent AS (SELECT * FROM sales TABLESAMPLE SYSTEM (1) WHERE day > '2024-01-01') "
+        "SELECT r.id FROM recent AS r JOIN customers AS c TABLESAMPLE SYSTEM (1) ON c.id = r.customer_id LIMIT 100"
+    )
+    validator = SQLValidator("SELECT id FROM sales", dialect='mssql').apply_sampling(5, 10000)
+    assert validator.apply_row_limit(100) == "SELECT TOP 100 id FROM sales TABLESAMPLE SYSTEM (5 PERCENT)"
+
+def test_sampling_bounds_table_scans_elsewhere():
+    sql = "SELECT s.id, c.name FROM sales s JOIN customers AS c ON c.id = s.customer_id"
+    validator = SQLValidator(sql, dialect='sqlite').apply_sampling(1, 500)
+    assert validator.apply_row_limit(100) == (
+        "SELECT s.id, c.name FROM (SELECT * FROM sales LIMIT 500) AS s "
+        "JOIN (SELECT * FROM customers LIMIT 500) AS c ON c.id = s.customer_id LIMIT 100"
+    )
+
+def test_normalized_sql_ignores_case_only_where_the_dialect_does():
+    assert (
+        SQLValidator("select id from users -- recent", dialect='postgres').normalized_sql()
+        == SQLValidator("SELECT  ID FROM Users", dialect='postgres').normalized_sql()
+    )
+    # MySQL table names are case-sensitive, so these are different tables
+    assert (
+        SQLValidator("SELECT * FROM users", dialect='mysql').normalized_sql()
+        != SQLValidator("SELECT * FROM Users", dialect='mysql').normalized_sql()
+    )
@@ -1,11 +1,20 @@
+import math
+from django.conf import settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from .services.orchestrator import LLMOrchestrator
 from .services.validator import SQLValidator, InvalidSQLError
+from app.common.timing import StageTimer
+from app.connections.limiter import ConnectionLimiter
 from app.connections.models import Connection
+from app.queries.handoff import FirstPageHandoff
+from app.queries.local import ensure_loaded, run_local_query
+from app.queries.cost import LOW_PRIORITY, REJECT, WARN, assess_cost, describe
 from app.queries.models import QueryHistory
+from app.queries.results import read_result_page
 from app.queries.tasks import execute_query_task
+from app.tenancy.plans import get_plan_limits
 
 class NLQAPIView(APIView):
     """
@@ -26,14 +35,37 @@ class NLQAPIView(APIView):
         except Connection.DoesNotExist:
             return Response({'error': 'Connection not found'}, status=status.HTTP_404_NOT_FOUND)
 
+        # Follow-ups refine an earlier result locally and never reach the source
+        if request.data.get('follow_up_of'):
+            return self._follow_up(request, connection, prompt, request.data['follow_up_of'])
+
+        # Shed load before calling the LLM if the source database is backed up
+        limiter = ConnectionLimiter(connection)
+        if limiter.queue_length() >= settings.SOURCE_ADMISSION_MAX_QUEUE:
+            retry_after = max(math.ceil(limiter.retry_after()), settings.SOURCE_ADMISSION_RETRY_SEC)
+            return Response(
+                {'error': 'Too many queries are queued for this connection', 'retry_after': retry_after},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(retry_after)}
+            )
+
+        # Previews run on samples of each table and return approximate results
+        preview = bool(request.data.get('preview'))
+
+        # Per-stage latency, stored on the history entry and completed by the worker
+        timer = StageTimer()
+
         # 1. Orchestrate LLM call
-        orchestrator = LLMOrchestrator(connection=connection, prompt=prompt)
+        orchestrator = LLMOrchestrator(connection=connection, prompt=prompt, timer=timer)
         generated_sql = orchestrator.generate_sql()
 
         # 2. Validate the generated SQL
         try:
-            validator = SQLValidator(sql=generated_sql, dialect=connection.driver)
-            validator.validate()
+            with timer.stage('validate'):
+                validator = SQLValidator(sql=generated_sql, dialect=connection.driver)
+                validator.validate()
+                if preview:
+                    validator.apply_sampling(settings.PREVIEW_SAMPLE_PERCENT, settings.PREVIEW_SCAN_ROWS)
         except InvalidSQLError as e:
             # Log this failed validation for review
             QueryHistory.objects.create(
@@ -43,26 +75,181 @@ class NLQAPIView(APIView):
                 prompt=prompt,
                 generated_sql=generated_sql,
                 status=QueryHistory.Status.ERROR,
-                error_text=f"Validation Error: {e}"
+                error_text=f"Validation Error: {e}",
+                timings=timer.stages,
             )
             return Response({'error': f'Generated SQL failed validation: {e}'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 3. Create a history entry and enqueue the execution task
+        # 3. Ask the source's planner what the query will cost before running it.
+        # The row limit is applied the same way the execution worker applies it.
+        limits = get_plan_limits(request.tenant)
+        with timer.stage('cost_estimate'):
+            estimate, decision = assess_cost(connection, validator.apply_row_limit(limits['max_rows']), limits)
+        cost = {'estimated_rows': estimate.rows, 'estimated_cost': estimate.cost, 'decision': decision}
+
+        if decision == REJECT:
+            QueryHistory.objects.create(
+                tenant=request.tenant,
+                connection=connection,
+                user=request.user,
+                prompt=prompt,
+                generated_sql=generated_sql,
+                status=QueryHistory.Status.ERROR,
+                error_text=f"Cost Error: estimated {describe(estimate)} exceeds the plan's limit.",
+                estimated_rows=estimate.rows,
+                estimated_cost=estimate.cost,
+                timings=timer.stages,
+            )
+            return Response({
+                'error': f'Generated SQL is too expensive to run (estimated {describe(estimate)})',
+                'generated_sql': generated_sql,
+                'cost': cost,
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # 4. Create a history entry and enqueue the execution task
         history_entry = QueryHistory.objects.create(
             tenant=request.tenant,
             connection=connection,
             user=request.user,
             prompt=prompt,
             generated_sql=generated_sql,
-            status='PENDING' # A 'PENDING' status would be useful here
+            status='PENDING', # A 'PENDING' status would be useful here
+            estimated_rows=estimate.rows,
+            estimated_cost=estimate.cost,
+            preview=preview,
+            timings=timer.stages,
         )
 
-        task = execute_query_task.delay(history_entry.id)
+        # Optionally wait briefly for the first page, so small queries need no polling.
+        # Queries sent to the bulk workers won't start within the budget.
+        first_page = bool(request.data.get('first_page')) and decision != LOW_PRIORITY
 
-        return Response({
+        if decision == LOW_PRIORITY:
+            # Very expensive queries run on the bulk workers, away from interactive ones
+            task = execute_query_task.apply_async((history_entry.id,), queue=settings.QUERY_LOW_PRIORITY_QUEUE)
+        else:
+            # Expensive queries yield to cheaper ones on the interactive queue
+            priority = settings.QUERY_PRIORITY_EXPENSIVE if decision == WARN else settings.QUERY_PRIORITY_INTERACTIVE
+            task = execute_query_task.apply_async(
+                (history_entry.id,), {'first_page': first_page}, priority=priority
+            )
+
+        body = {
             'status': 'ok',
             'message': 'Query is being executed',
             'generated_sql': generated_sql,
             'history_id': history_entry.id,
-            'task_id': task.id
-        }, status=status.HTTP_202_ACCEPTED)
+            'task_id': task.id,
+            'cost': cost,
+            # Previews are computed from samples
+            'approximate': preview,
+        }
+        if decision in (WARN, LOW_PRIORITY):
+            body['warning'] = f'This query is expected to be expensive (estimated {describe(estimate)}).'
+
+        if first_page:
+            page = FirstPageHandoff(history_entry.id).wait(settings.FIRST_PAGE_BUDGET_MS)
+            if page is not None:
+                body['first_page'] = page
+                if page['complete']:
+                    # The whole outcome is inline; there is nothing left to poll for
+                    body['message'] = 'Query finished'
+                    return Response(body, status=status.HTTP_200_OK)
+        return Response(body, status=status.HTTP_202_ACCEPTED)
+
+    def _follow_up(self, request, connection, prompt, base_id):
+        """
+        Refines the stored result of an earlier query: the LLM writes SQLite
+        against `previous_result`, which runs in this process's local engine
+        (see app.queries.local) and returns the whole outcome inline.
+        """
+        try:
+            base = QueryHistory.objects.get(id=base_id, tenant=request.tenant, connection=connection)
+        except (QueryHistory.DoesNotExist, ValueError):
+            return Response({'error': 'Query to follow up on not found'}, status=status.HTTP_404_NOT_FOUND)
+        if base.status != QueryHistory.Status.OK or not base.result_path:
+            return Response(
+                {'error': f'Query to follow up on has no stored result (status {base.status})'},
+                status=status.HTTP_409_CONFLICT
+            )
+        if (base.result_bytes or 0) > settings.LOCAL_QUERY_MAX_RESULT_BYTES:
+            return Response(
+                {'error': 'The stored result is too large to refine locally; ask a new question instead'},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        timer = StageTimer()
+
+        # Load the previous result up front (timed as local_load), so an
+        # expired result is reported before calling the LLM
+        try:
+            ensure_loaded(base, timer)
+        except FileNotFoundError:
+            return Response({'error': 'The stored result has expired'}, status=status.HTTP_410_GONE)
+
+        orchestrator = LLMOrchestrator(connection=connection, prompt=prompt, timer=timer, follow_up_of=base)
+        generated_sql = orchestrator.generate_sql()
+
+        try:
+            with timer.stage('validate'):
+                validator = SQLValidator(sql=generated_sql, dialect='sqlite')
+                validator.validate()
+        except InvalidSQLError as e:
+            QueryHistory.objects.create(
+                tenant=request.tenant,
+                connection=connection,
+                user=request.user,
+                prompt=prompt,
+                generated_sql=generated_sql,
+                status=QueryHistory.Status.ERROR,
+                error_text=f"Validation Error: {e}",
+                follow_up_of=base,
+                timings=timer.stages,
+            )
+            return Response({'error': f'Generated SQL failed validation: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The plan's row and byte caps apply as on the source (the extra row
+        # detects truncation); run_local_query uses its own short timeout.
+        limits = get_plan_limits(request.tenant)
+        sql_to_run = validator.apply_row_limit(limits['max_rows'] + 1)
+
+        history_entry = QueryHistory.objects.create(
+            tenant=request.tenant,
+            connection=connection,
+            user=request.user,
+            prompt=prompt,
+            generated_sql=generated_sql,
+            status=QueryHistory.Status.PENDING,
+            follow_up_of=base,
+            preview=base.preview,
+            timings=timer.stages,
+        )
+        run_timer = StageTimer(stages=timer.stages)
+        run_local_query(base, history_entry, sql_to_run, limits, run_timer)
+        history_entry.duration_ms = run_timer.elapsed_ms()
+        history_entry.timings = run_timer.stages
+        history_entry.save()
+
+        page = {
+            'complete': True,
+            'status': history_entry.status,
+            'row_count': history_entry.row_count,
+            'truncated': history_entry.truncated,
+            'error_text': history_entry.error_text,
+            'columns': [],
+            'rows': [],
+        }
+        if history_entry.result_path:
+            page['columns'], page['rows'] = read_result_page(history_entry, 0, settings.FIRST_PAGE_ROWS)
+            page['complete'] = (history_entry.row_count or 0) <= settings.FIRST_PAGE_ROWS
+
+        return Response({
+            'status': 'ok',
+            'message': 'Query finished',
+            'generated_sql': generated_sql,
+            'history_id': history_entry.id,
+            'follow_up_of': base.id,
+            'first_page': page,
+            # A refinement of a sampled or truncated result is no more exact than it
+            'approximate': base.preview or base.truncated,
+        }, status=status.HTTP_200_OK)
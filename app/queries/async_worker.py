@@ -0,0 +1,338 @@
+"""
+Asyncio execution worker.
+
+A prefork Celery worker ties up a whole process for every query it runs,
+mostly waiting on the source database. This worker instead consumes the same
+`execute_query_task` messages from a Celery queue and runs up to
+ASYNC_WORKER_CONCURRENCY of them at once on one event loop, using
+SQLAlchemy's asyncio engines (asyncpg, aiomysql, aiosqlite).
+
+Executions go through the same steps as the Celery task (see
+app.queries.tasks): validation, the result cache, single-flight, admission
+control, the plan's timeouts and caps, and the first-page handoff. Only the
+source query runs on the event loop. The short ORM and Redis calls around it
+run on a small thread pool (ASYNC_WORKER_THREADS), since the Django ORM is
+synchronous, and so do encoding and writing result chunks. SQL Server has
+no asyncio driver, so its queries run on that thread pool too.
+
+Messages are acknowledged once their execution finishes, so at most
+ASYNC_WORKER_CONCURRENCY are reserved at a time. Like a Celery worker, a
+requeued message waiting out its countdown (ETA) raises the prefetch count
+by one instead of taking a slot, so delayed messages never hold up ready
+ones. Start it with `manage.py run_async_worker`.
+"""
+import asyncio
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from queue import Empty, SimpleQueue
+
+from django.conf import settings
+from kombu import Consumer
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .cancellation import (
+    BACKEND_PID_SQL, SQLITE_PROGRESS_OPCODES, QueryCancelled, is_cancel_requested, release_backend_pid,
+    sqlite_progress_handler,
+)
+from .models import QueryHistory
+from .results import attach_result, open_result_writer
+from .tasks import (
+    complete_attached, execute_query_task, finish_execution, mark_truncated, prepare_execution,
+    record_failure, run_query, store_chunk
+)
+from .timeouts import is_timeout_error, session_timeout_reset_sql, session_timeout_sql
+from app.celery import app as celery_app
+from app.connections.engines import (
+    ASYNC_DRIVER_URLS, EngineRegistry, get_async_connect_args, get_async_db_url
+)
+
+logger = logging.getLogger(__name__)
+
+# Extra time a statement gets past its server-side timeout before the worker
+# cancels it itself (e.g. when the server never enforces it).
+ASYNC_TIMEOUT_GRACE_SEC = 2
+# How often the consumer acknowledges finished executions.
+ACK_POLL_SEC = 0.05
+
+
+class AsyncEngineRegistry(EngineRegistry):
+    """An `EngineRegistry` of asyncio engines, used from the worker's event loop."""
+    def __init__(self, max_engines: int, idle_timeout: float):
+        super().__init__(max_engines, idle_timeout)
+        self._disposals = set()
+
+    def _create_engine(self, conn):
+        options = {
+            'connect_args': get_async_connect_args(conn),
+            'pool_pre_ping': True,
+            'pool_recycle': settings.SOURCE_ENGINE_POOL_RECYCLE_SEC,
+        }
+        # Queries run concurrently, so the pool is sized for the connection's
+        # own concurrency limit rather than one query per worker process.
+        if conn.driver != 'sqlite':
+            options.update(
+                pool_size=int(conn.options_json.get('max_concurrency', settings.SOURCE_MAX_CONCURRENCY)),
+                max_overflow=settings.SOURCE_ENGINE_MAX_OVERFLOW,
+                pool_timeout=settings.SOURCE_ENGINE_POOL_TIMEOUT_SEC,
+            )
+        return create_async_engine(get_async_db_url(conn), **options)
+
+    def _dispose(self, engine):
+        # Disposing an asyncio engine is itself a coroutine
+        task = asyncio.get_running_loop().create_task(engine.dispose())
+        self._disposals.add(task)
+        task.add_done_callback(self._disposals.discard)
+
+
+registry = AsyncEngineRegistry(
+    max_engines=settings.SOURCE_ENGINE_MAX_ENGINES,
+    idle_timeout=settings.SOURCE_ENGINE_IDLE_TIMEOUT_SEC,
+)
+
+
+async def execute_query(query_history_id: int, first_page: bool = False, queue: str = None) -> str:
+    """The asyncio counterpart of `execute_query_task`."""
+    execution, message = await asyncio.to_thread(prepare_execution, query_history_id, first_page, queue)
+    if execution is None:
+        return message
+
+    try:
+        if execution.admitted:
+            try:
+                await run_query_async(
+                    execution.query_history, execution.sql_to_run, execution.limits, execution.timer,
+                    execution.handoff, execution.lease,
+                )
+            finally:
+                await asyncio.to_thread(execution.limiter.release, query_history_id)
+        await asyncio.to_thread(finish_execution, execution)
+    finally:
+        await asyncio.to_thread(complete_attached, execution)
+
+    return f"Execution finished for QueryHistory id {query_history_id} with status {execution.query_history.status}"
+
+
+async def run_query_async(query_history, sql_to_run: str, limits: dict, timer, handoff=None, lease=None):
+    """
+    Runs the query on the connection's asyncio engine and stores its result,
+    recording the outcome on the history entry (without saving), like `run_query`.
+    """
+    connection_obj = query_history.connection
+    if connection_obj.driver not in ASYNC_DRIVER_URLS:
+        await asyncio.to_thread(run_query, query_history, sql_to_run, limits, timer, handoff, lease)
+        return
+
+    timeout_ms = limits['timeout_ms']
+    deadline = None
+    try:
+        engine = registry.get(connection_obj)
+
+        async with engine.connect() as connection:
+            # Record the source session running the query so it can be cancelled
+            if connection_obj.driver in BACKEND_PID_SQL:
+                pid = await connection.execute(text(BACKEND_PID_SQL[connection_obj.driver]))
+                query_history.backend_pid = str(pid.scalar())
+            try:
+                await asyncio.to_thread(_record_backend_pid, query_history)
+
+                deadline = time.monotonic() + timeout_ms / 1000
+                async with async_statement_timeout(connection, connection_obj, timeout_ms, query_history.id, deadline):
+                    # stream() fetches through a server-side cursor, like stream_results
+                    with timer.stage('execute'):
+                        result = await connection.stream(text(sql_to_run))
+
+                    writer = open_result_writer(query_history, list(result.keys()))
+                    try:
+                        reason = await _fetch_result_async(result, writer, limits, timer, handoff, lease)
+                    except BaseException as e:
+                        if writer.row_count and is_timeout_error(e, connection_obj.driver, deadline):
+                            # Keep the rows that arrived before the deadline
+                            with timer.stage('serialize'):
+                                writer.close()
+                            attach_result(query_history, writer)
+                            mark_truncated(query_history, QueryHistory.TruncatedReason.TIMEOUT)
+                        else:
+                            writer.discard()
+                        raise
+                    with timer.stage('serialize'):
+                        writer.close()
+
+                # Update history object with a reference to the stored result
+                query_history.status = QueryHistory.Status.OK
+                attach_result(query_history, writer)
+                mark_truncated(query_history, reason)
+            finally:
+                # The session goes back to the pool and may run other tenants' queries
+                await asyncio.to_thread(release_backend_pid, query_history)
+
+    except Exception as e:
+        record_failure(query_history, e, deadline, timeout_ms)
+
+
+def _record_backend_pid(query_history):
+    QueryHistory.objects.filter(id=query_history.id).update(backend_pid=query_history.backend_pid)
+    if is_cancel_requested(query_history.id):
+        raise QueryCancelled()
+
+
+@asynccontextmanager
+async def async_statement_timeout(connection, connection_obj, timeout_ms: int, history_id: int, deadline: float):
+    """
+    Applies `timeout_ms` to the statements run on an asyncio connection inside
+    the block, the same way `statement_timeout` does, and cancels them from
+    the client shortly after the deadline in case the server does not.
+    """
+    timeout_sql = session_timeout_sql(connection_obj.driver, connection.dialect, timeout_ms)
+    if timeout_sql:
+        await connection.execute(text(timeout_sql))
+
+    sqlite_connection = None
+    if connection_obj.driver == 'sqlite':
+        # aiosqlite runs the handler on its own thread, next to the statement
+        sqlite_connection = (await connection.get_raw_connection()).driver_connection
+        await sqlite_connection.set_progress_handler(
+            sqlite_progress_handler(history_id, deadline), SQLITE_PROGRESS_OPCODES
+        )
+    try:
+        async with asyncio.timeout(timeout_ms / 1000 + ASYNC_TIMEOUT_GRACE_SEC):
+            yield
+    finally:
+        if sqlite_connection is not None:
+            await sqlite_connection.set_progress_handler(None, 0)
+        reset_sql = session_timeout_reset_sql(connection_obj.driver, connection.dialect)
+        if reset_sql:
+            try:
+                await connection.execute(text(reset_sql))
+            except Exception:
+                # Never return a session with this query's timeout to the pool
+                await connection.invalidate()
+
+
+async def _fetch_result_async(result, writer, limits: dict, timer, handoff=None, lease=None) -> str:
+    """Like `_fetch_result`. Chunks are written on a thread, so encoding never blocks the event loop."""
+    chunks = result.partitions(settings.RESULT_FETCH_CHUNK_ROWS)
+    while True:
+        with timer.stage('fetch'):
+            chunk = await anext(chunks, None)
+        if chunk is None:
+            return ''
+        if lease is not None and lease.due():
+            await asyncio.to_thread(lease.renew)
+        reason = await asyncio.to_thread(store_chunk, chunk, writer, limits, timer, handoff)
+        if reason:
+            return reason
+
+
+class AsyncExecutionWorker:
+    """
+    Consumes `execute_query_task` messages from a Celery queue and runs them
+    concurrently on an event loop in a background thread. Kombu channels are
+    not thread-safe, so messages are received and acknowledged on the
+    calling thread only.
+    """
+    def __init__(self, queue: str = 'interactive', concurrency: int = None, threads: int = None):
+        self.queue = queue
+        self.concurrency = concurrency or settings.ASYNC_WORKER_CONCURRENCY
+        # Bounds the executions running at once; delayed messages don't count
+        # until their countdown is over.
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._delayed = 0
+        self._consumer = None
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=threads or settings.ASYNC_WORKER_THREADS, thread_name_prefix='async-worker')
+        )
+        self._finished = SimpleQueue()
+        self._in_flight = 0
+        self._stopping = threading.Event()
+
+    def run(self):
+        """Consumes until `stop()` is called, then waits for running executions to finish."""
+        loop_thread = threading.Thread(target=self.loop.run_forever, name='async-worker-loop', daemon=True)
+        loop_thread.start()
+        logger.info("Async execution worker started", extra={'queue': self.queue, 'concurrency': self.concurrency})
+        try:
+            with celery_app.connection_for_read() as connection:
+                consumer = Consumer(
+                    connection,
+                    queues=[celery_app.amqp.queues[self.queue]],
+                    callbacks=[self._on_message],
+                    accept=['json'],
+                    prefetch_count=self.concurrency,
+                )
+                self._consumer = consumer
+                with consumer:
+                    while not self._stopping.is_set():
+                        self._ack_finished()
+                        try:
+                            connection.drain_events(timeout=ACK_POLL_SEC)
+                        except socket.timeout:
+                            pass
+                    consumer.cancel()
+                    while self._in_flight:
+                        self._ack_finished(timeout=ACK_POLL_SEC)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            loop_thread.join()
+            self.loop.close()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _on_message(self, body, message):
+        if message.headers.get('task') != execute_query_task.name:
+            # Only executions are routed here; leave anything else to a Celery worker
+            logger.warning("Ignoring unexpected task", extra={'task': message.headers.get('task')})
+            message.reject(requeue=True)
+            return
+        args, kwargs, _embed = body
+        delay = _eta_delay(message.headers.get('eta'))
+        if delay > 0:
+            # Reserve one more message for as long as this one is held
+            self._set_delayed(self._delayed + 1)
+        future = asyncio.run_coroutine_threadsafe(self._execute(args, kwargs, delay), self.loop)
+        self._in_flight += 1
+        future.add_done_callback(lambda done: self._finished.put((message, done, delay > 0)))
+
+    async def _execute(self, args, kwargs, delay: float):
+        if delay > 0:
+            # A requeued execution waiting out its countdown, without a slot
+            await asyncio.sleep(delay)
+        async with self._slots:
+            return await execute_query(*args, queue=self.queue, **kwargs)
+
+    def _set_delayed(self, delayed: int):
+        self._delayed = delayed
+        self._consumer.qos(prefetch_count=self.concurrency + delayed)
+
+    def _ack_finished(self, timeout: float = None):
+        while True:
+            try:
+                message, future, delayed = self._finished.get(timeout=timeout) if timeout else self._finished.get_nowait()
+            except Empty:
+                return
+            timeout = None
+            self._in_flight -= 1
+            message.ack()
+            if delayed:
+                self._set_delayed(self._delayed - 1)
+            if future.exception() is not None:
+                logger.error("Execution failed", exc_info=future.exception())
+            else:
+                logger.info(future.result())
+
+
+def _eta_delay(eta: str) -> float:
+    """Seconds until a message's ETA (set by `apply_async(countdown=...)`), or 0."""
+    if not eta:
+        return 0.0
+    eta = datetime.fromisoformat(eta)
+    if eta.tzinfo is None:
+        eta = eta.replace(tzinfo=timezone.utc)
+    return (eta - datetime.now(timezone.utc)).total_seconds()
@@ -0,0 +1,129 @@
+"""
+Result cache for executed queries.
+
+Identical queries against an unchanged schema return the same rows, so a
+re-run within the cache TTL re-uses the stored result file of an earlier
+execution instead of going back to the source database.
+
+Entries live in Redis and point at result files in the result store:
+
+- `result_cache:entry:<key>` holds the stored-result reference (expires after RESULT_CACHE_TTL_SEC).
+- `result_cache:lru` is a sorted set of keys scored by last access time.
+- `result_cache:sizes` / `result_cache:bytes` track the bytes referenced by each entry and in total.
+
+Once the cache references more than RESULT_CACHE_MAX_BYTES, least recently
+used entries are dropped. Dropping an entry never deletes the file; that is
+left to the result store's own eviction.
+"""
+import hashlib
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from app.common.redis import get_redis
+from .results import result_exists
+
+ENTRY_PREFIX = 'result_cache:entry:'
+LRU_KEY = 'result_cache:lru'
+SIZES_KEY = 'result_cache:sizes'
+TOTAL_BYTES_KEY = 'result_cache:bytes'
+
+logger = logging.getLogger(__name__)
+
+# Fields copied from the cached execution onto the history entry of a hit.
+RESULT_FIELDS = (
+    'result_path', 'result_bytes', 'result_schema', 'result_batch_rows', 'row_count', 'truncated', 'truncated_reason',
+)
+
+
+def result_cache_key(connection_id: int, normalized_sql: str, schema_hash: str, limits: dict) -> str:
+    material = json.dumps(
+        [connection_id, normalized_sql, schema_hash, limits['max_rows'], limits['max_bytes']]
+    )
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def is_cache_enabled(connection) -> bool:
+    """Connections can opt out with `{"result_cache": false}` in options_json."""
+    return settings.RESULT_CACHE_ENABLED and connection.options_json.get('result_cache', True)
+
+
+class ResultCache:
+    """
+    Redis-backed index of cached results. Redis errors are logged and treated
+    as misses, so an unavailable cache never fails a query.
+    """
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+
+    def get(self, key: str):
+        """
+        Returns the cached result reference for a key, or None. Entries whose
+        file has since been evicted from the result store count as misses.
+        """
+        try:
+            return self._get(key)
+        except redis.RedisError:
+            logger.warning("Result cache lookup failed", exc_info=True)
+            return None
+
+    def _get(self, key: str):
+        raw = self.client.get(ENTRY_PREFIX + key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if not result_exists(entry['result_path']):
+            self.delete(key)
+            return None
+        self.client.zadd(LRU_KEY, {key: time.time()})
+        return entry
+
+    def put(self, key: str, query_history):
+        try:
+            self._put(key, query_history)
+        except redis.RedisError:
+            logger.warning("Result cache update failed", exc_info=True)
+
+    def _put(self, key: str, query_history):
+        entry = {field: getattr(query_history, field) for field in RESULT_FIELDS}
+        entry['history_id'] = query_history.id
+        size = query_history.result_bytes or 0
+
+        pipe = self.client.pipeline()
+        pipe.set(ENTRY_PREFIX + key, json.dumps(entry), ex=settings.RESULT_CACHE_TTL_SEC)
+        pipe.zadd(LRU_KEY, {key: time.time()})
+        pipe.hget(SIZES_KEY, key)
+        pipe.hset(SIZES_KEY, key, size)
+        previous_size = pipe.execute()[2]
+        self.client.incrby(TOTAL_BYTES_KEY, size - int(previous_size or 0))
+        self._evict()
+
+    def delete(self, key: str):
+        pipe = self.client.pipeline()
+        pipe.delete(ENTRY_PREFIX + key)
+        pipe.zrem(LRU_KEY, key)
+        pipe.hget(SIZES_KEY, key)
+        pipe.hdel(SIZES_KEY, key)
+        size = pipe.execute()[2]
+        if size is not None:
+            self.client.decrby(TOTAL_BYTES_KEY, int(size))
+
+    def _evict(self):
+        """Drops least recently used entries until the cache fits its byte budget."""
+        while int(self.client.get(TOTAL_BYTES_KEY) or 0) > settings.RESULT_CACHE_MAX_BYTES:
+            oldest = self.client.zrange(LRU_KEY, 0, 0)
+            if not oldest:
+                break
+            self.delete(oldest[0].decode())
+
+
+def apply_cached_result(query_history, entry: dict):
+    """Completes a history entry from a cached result reference (without saving)."""
+    for field in RESULT_FIELDS:
+        # Entries cached before a field existed leave its default
+        if field in entry:
+            setattr(query_history, field, entry[field])
+    query_history.cache_hit = True
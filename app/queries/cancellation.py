@@ -0,0 +1,125 @@
+"""
+Cancellation of running queries.
+
+Revoking a Celery task does not stop a statement that is already running on
+the source database. Instead, the execution worker records the backend
+session id (PID) of its source connection when a query starts, and a cancel
+request kills that statement from a separate connection:
+
+- Postgres: `pg_cancel_backend(pid)`
+- MySQL/MariaDB: `KILL QUERY pid`
+- SQL Server: `KILL spid`
+
+The PID only identifies the query while the worker holds the connection:
+once it goes back to the pool, the same session runs other queries. The
+worker therefore clears the PID before releasing the connection, and the
+cancel request kills it while holding a lock on the history row, which that
+clearing update waits for.
+
+SQLite has no server to signal, so the worker polls a Redis cancel flag from
+a progress handler and interrupts the statement itself. The same handler
+enforces the SQLite statement deadline (see app.queries.timeouts).
+"""
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from app.common.redis import get_redis
+from app.connections.engines import get_engine
+
+from .models import QueryHistory
+
+CANCEL_PREFIX = 'query_cancel:'
+# Cancel flags only matter while a query can still be running.
+CANCEL_FLAG_TTL_SEC = 24 * 60 * 60
+
+BACKEND_PID_SQL = {
+    'postgres': "SELECT pg_backend_pid()",
+    'mysql': "SELECT CONNECTION_ID()",
+    'mssql': "SELECT @@SPID",
+}
+
+CANCEL_SQL = {
+    'postgres': "SELECT pg_cancel_backend({pid})",
+    'mysql': "KILL QUERY {pid}",
+    'mssql': "KILL {pid}",
+}
+
+# The SQLite progress handler runs every this many VM instructions...
+SQLITE_PROGRESS_OPCODES = 10_000
+# ...but looks at the cancel flag at most this often.
+SQLITE_CANCEL_POLL_SEC = 0.25
+
+
+class QueryCancelled(Exception):
+    """Raised in the execution worker when a cancel was requested before the query started."""
+
+
+def request_cancel(history_id: int):
+    get_redis().set(CANCEL_PREFIX + str(history_id), 1, ex=CANCEL_FLAG_TTL_SEC)
+
+
+def is_cancel_requested(history_id: int) -> bool:
+    return bool(get_redis().exists(CANCEL_PREFIX + str(history_id)))
+
+
+def get_backend_pid(connection, driver: str) -> str:
+    """Returns the source session id of an open SQLAlchemy connection, or '' if there is none."""
+    if driver not in BACKEND_PID_SQL:
+        return ''
+    return str(connection.execute(text(BACKEND_PID_SQL[driver])).scalar())
+
+
+def release_backend_pid(query_history):
+    """
+    Forgets the source session of `query_history` before its connection goes
+    back to the pool. Blocks while a cancel request holds the history row.
+    """
+    if not query_history.backend_pid:
+        return
+    query_history.backend_pid = ''
+    QueryHistory.objects.filter(id=query_history.id).update(backend_pid='')
+
+
+def cancel_backend(connection_obj, pid: str):
+    """Cancels the statement running in a source session, using a separate pooled connection."""
+    if connection_obj.driver not in CANCEL_SQL or not pid:
+        return
+    # KILL can't run inside a transaction on MySQL/SQL Server.
+    engine = get_engine(connection_obj).execution_options(isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        connection.execute(text(CANCEL_SQL[connection_obj.driver].format(pid=int(pid))))
+
+
+@contextmanager
+def sqlite_interrupt_handler(connection, history_id: int, deadline: float = None):
+    """
+    Interrupts the SQLite statement running on `connection` once a cancel is
+    requested for `history_id` or the `time.monotonic()` deadline passes. The
+    handler is removed on exit because the DBAPI connection goes back to the pool.
+    """
+    dbapi_connection = connection.connection.dbapi_connection
+    dbapi_connection.set_progress_handler(sqlite_progress_handler(history_id, deadline), SQLITE_PROGRESS_OPCODES)
+    try:
+        yield
+    finally:
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+def sqlite_progress_handler(history_id: int, deadline: float = None):
+    """The SQLite progress handler behind `sqlite_interrupt_handler`."""
+    next_poll = time.monotonic()
+
+    def handler():
+        nonlocal next_poll
+        now = time.monotonic()
+        # A non-zero return value aborts the statement.
+        if deadline is not None and now >= deadline:
+            return 1
+        if now < next_poll:
+            return 0
+        next_poll = now + SQLITE_CANCEL_POLL_SEC
+        return 1 if is_cancel_requested(history_id) else 0
+
+    return handler
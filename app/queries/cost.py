@@ -0,0 +1,215 @@
+"""
+EXPLAIN-based cost admission for generated SQL.
+
+Before a query is enqueued, the source database's planner estimates what it
+will cost, using each driver's own EXPLAIN:
+
+- Postgres: `EXPLAIN (FORMAT JSON)`
+- MySQL: `EXPLAIN FORMAT=JSON`
+- SQL Server: the estimated plan from `SET SHOWPLAN_XML ON`
+- SQLite: `EXPLAIN QUERY PLAN`. SQLite has no cost model, so rows are
+  estimated from the table sizes `ANALYZE` records in `sqlite_stat1`.
+
+The estimated rows are the most rows any step of the plan is expected to
+produce, which catches a runaway join even when a LIMIT caps the final
+result. Costs are in each planner's own units.
+
+When the planner gives no row estimate (EXPLAIN failed, or SQLite was never
+analyzed), the catalog statistics recorded at introspection stand in: the
+query is assumed to read at least its largest table. Such a guess can send
+a query to the low-priority queue but never rejects it.
+
+The tenant plan's `cost_thresholds` then decide whether the query runs as
+usual, runs with a warning, runs on the low-priority queue, or is rejected.
+"""
+import json
+import logging
+import math
+import re
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from dataclasses import dataclass
+
+import sqlglot
+from sqlalchemy import text
+from sqlglot import exp
+
+from .timeouts import statement_timeout
+from app.connections.engines import get_engine
+from app.nlq.services.validator import SQLValidator
+from app.schema_registry.models import SchemaCache
+
+logger = logging.getLogger(__name__)
+
+ADMIT = 'admit'
+WARN = 'warn'
+LOW_PRIORITY = 'low_priority'
+REJECT = 'reject'
+# Thresholds are checked from the most to the least severe decision.
+DECISIONS = (REJECT, LOW_PRIORITY, WARN)
+
+# Planning is quick; anything slower than this is not worth waiting for.
+EXPLAIN_TIMEOUT_MS = 5000
+
+SHOWPLAN_NS = {'sp': 'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+SQLITE_SCAN_RE = re.compile(r'^SCAN (\S+)')
+
+
+@dataclass
+class CostEstimate:
+    rows: float = None
+    cost: float = None
+
+
+def explain(connection, driver: str, sql: str) -> CostEstimate:
+    """Runs the driver's EXPLAIN for `sql` on an open SQLAlchemy connection."""
+    if driver == 'postgres':
+        return _explain_postgres(connection, sql)
+    if driver == 'mysql':
+        return _explain_mysql(connection, sql)
+    if driver == 'mssql':
+        return _explain_mssql(connection, sql)
+    if driver == 'sqlite':
+        return _explain_sqlite(connection, sql)
+    return CostEstimate()
+
+
+def _explain_postgres(connection, sql):
+    plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    root = plan[0]['Plan']
+    rows, nodes = 0, [root]
+    while nodes:
+        node = nodes.pop()
+        rows = max(rows, node.get('Plan Rows', 0))
+        nodes.extend(node.get('Plans', []))
+    return CostEstimate(rows=rows, cost=root.get('Total Cost'))
+
+
+def _explain_mysql(connection, sql):
+    plan = json.loads(connection.execute(text(f"EXPLAIN FORMAT=JSON {sql}")).scalar())
+    rows, nodes = 0, [plan]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+        elif isinstance(node, dict):
+            for key in ('rows_examined_per_scan', 'rows_produced_per_join'):
+                if key in node:
+                    rows = max(rows, float(node[key]))
+            nodes.extend(node.values())
+    cost = plan.get('query_block', {}).get('cost_info', {}).get('query_cost')
+    return CostEstimate(rows=rows, cost=float(cost) if cost is not None else None)
+
+
+def _explain_mssql(connection, sql):
+    # SHOWPLAN must be the only statement in its batch. While it is on,
+    # statements return their estimated plan instead of running.
+    connection.execute(text("SET SHOWPLAN_XML ON"))
+    try:
+        plan = ET.fromstring(connection.execute(text(sql)).scalar())
+    finally:
+        connection.execute(text("SET SHOWPLAN_XML OFF"))
+    statement = plan.find('.//sp:StmtSimple', SHOWPLAN_NS)
+    rows = max((float(op.get('EstimateRows', 0)) for op in plan.iterfind('.//sp:RelOp', SHOWPLAN_NS)), default=0)
+    cost = statement.get('StatementSubTreeCost') if statement is not None else None
+    return CostEstimate(rows=rows, cost=float(cost) if cost is not None else None)
+
+
+def _explain_sqlite(connection, sql):
+    steps = connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+    try:
+        stats = connection.execute(text("SELECT tbl, stat FROM sqlite_stat1")).fetchall()
+    except Exception:
+        # The database was never analyzed
+        return CostEstimate()
+    table_rows = {table.lower(): int(stat.split()[0]) for table, stat in stats}
+
+    # The plan names tables by their alias
+    tables = {
+        table.alias_or_name.lower(): table.name.lower()
+        for table in sqlglot.parse_one(sql, read='sqlite').find_all(exp.Table)
+    }
+
+    # Full scans under the same parent are joined in a nested loop; sibling
+    # subqueries (e.g. the parts of a UNION) run one after the other.
+    loops = defaultdict(lambda: 1)
+    for _id, parent, _notused, detail in steps:
+        match = SQLITE_SCAN_RE.match(detail)
+        if not match or match.group(1) == 'CONSTANT':
+            continue
+        table = tables.get(match.group(1).lower(), match.group(1).lower())
+        if table not in table_rows:
+            return CostEstimate()
+        loops[parent] *= table_rows[table]
+    return CostEstimate(rows=sum(loops.values()))
+
+
+def estimate_cost(connection_obj, sql: str) -> CostEstimate:
+    """Asks the source database's planner for an estimate of `sql`."""
+    engine = get_engine(connection_obj)
+    with engine.connect() as connection:
+        with statement_timeout(connection, connection_obj, EXPLAIN_TIMEOUT_MS):
+            return explain(connection, connection_obj.driver, sql)
+
+
+def estimate_from_stats(connection_obj, sql: str) -> CostEstimate:
+    """The estimated rows of the largest table `sql` reads, from the connection's catalog statistics."""
+    stats = SchemaCache.objects.filter(connection=connection_obj).values_list('stats_json', flat=True).first()
+    if not stats:
+        return CostEstimate()
+    table_rows = {name.lower(): table['rows'] for name, table in stats.items() if table.get('rows') is not None}
+    dialect = SQLValidator.DRIVER_DIALECTS.get(connection_obj.driver, connection_obj.driver)
+    rows = [
+        table_rows[name]
+        for table in sqlglot.parse_one(sql, read=dialect).find_all(exp.Table)
+        # Tables outside the default schema are recorded as schema.table
+        for name in {table.name.lower(), f"{table.db}.{table.name}".lower()}
+        if name in table_rows
+    ]
+    return CostEstimate(rows=max(rows)) if rows else CostEstimate()
+
+
+def decide(estimate: CostEstimate, thresholds: dict) -> str:
+    """Returns the most severe decision whose `rows` or `cost` threshold the estimate exceeds."""
+    for decision in DECISIONS:
+        for key, limit in (thresholds.get(decision) or {}).items():
+            value = getattr(estimate, key, None)
+            if value is not None and limit is not None and value > limit:
+                return decision
+    return ADMIT
+
+
+def assess_cost(connection_obj, sql: str, limits: dict):
+    """
+    Estimates `sql` and decides how to admit it under the plan's `cost_thresholds`.
+    Returns `(estimate, decision)`. A failed EXPLAIN never blocks a query; it is admitted
+    unestimated, or on the rows of its largest table when statistics are known.
+    """
+    try:
+        estimate = estimate_cost(connection_obj, sql)
+    except Exception:
+        logger.warning("Could not estimate query cost", exc_info=True, extra={'connection_id': connection_obj.id})
+        estimate = CostEstimate()
+    if estimate.rows is None:
+        try:
+            fallback = estimate_from_stats(connection_obj, sql)
+        except Exception:
+            logger.warning("Could not estimate query cost from statistics", exc_info=True, extra={'connection_id': connection_obj.id})
+            fallback = CostEstimate()
+        if fallback.rows is not None:
+            estimate.rows = fallback.rows
+            decision = decide(estimate, limits['cost_thresholds'])
+            # A lower bound from table sizes is too rough to refuse a query on
+            return estimate, LOW_PRIORITY if decision == REJECT else decision
+    return estimate, decide(estimate, limits['cost_thresholds'])
+
+
+def describe(estimate: CostEstimate) -> str:
+    parts = []
+    if estimate.rows is not None:
+        parts.append(f"~{math.ceil(estimate.rows):,} rows")
+    if estimate.cost is not None:
+        parts.append(f"cost {estimate.cost:,.0f}")
+    return ", ".join(parts) or "unknown cost"
@@ -0,0 +1,261 @@
+"""
+Streaming export of query results as CSV, NDJSON or Parquet.
+
+Exports are encoded one record batch at a time and streamed to the client,
+so memory use is bounded by a single batch (RESULT_FETCH_CHUNK_ROWS rows)
+whatever the size of the result, and the first bytes go out as soon as the
+first batch is read. Rows come from the result store when the query's result
+is still stored, and otherwise from re-running the query on the source
+database under the same limits as the execution worker.
+
+A re-run reproduces the stored result: a truncated result is re-run for the
+rows it stored, and a complete one under the plan's row limit and byte cap.
+Since the response has started by the time the byte cap is reached, an
+export that outgrows it is aborted with ExportTooLarge rather than cut short,
+so the client sees a failed download instead of a silently truncated file.
+
+CSV re-runs on Postgres skip row-by-row fetching altogether: the query is
+wrapped in `COPY (...) TO STDOUT WITH (FORMAT csv)` and the server's CSV
+output is streamed through as is. The COPY is one statement for the whole
+download, paced by the client, so it runs under EXPORT_TIMEOUT_MS rather
+than the plan's query timeout. Other drivers and formats fetch from a
+server-side cursor.
+
+Errors after the response has started (a timeout, a dropped source
+connection, ExportTooLarge) propagate out of the stream, so the server aborts
+the response instead of ending it cleanly.
+"""
+import io
+import json
+import time
+import zlib
+from contextlib import nullcontext
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import sqlglot
+from django.conf import settings
+from sqlalchemy import text
+from sqlglot import exp
+
+from .cancellation import sqlite_interrupt_handler
+from .results import resolve_columns, rows_to_batch
+from .timeouts import statement_timeout
+from app.connections.engines import get_engine
+
+
+class ExportTooLarge(Exception):
+    """Raised mid-stream when a re-run export exceeds the plan's byte cap."""
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write-only file that hands back whatever was written since it was last drained."""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class CsvEncoder:
+    content_type = 'text/csv'
+    extension = 'csv'
+
+    def __init__(self):
+        self._header = True
+
+    def encode(self, batch) -> bytes:
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(batch, sink, pacsv.WriteOptions(include_header=self._header))
+        self._header = False
+        return sink.getvalue().to_pybytes()
+
+    def finish(self) -> bytes:
+        return b''
+
+
+class NdjsonEncoder:
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def encode(self, batch) -> bytes:
+        return ''.join(json.dumps(row, default=str) + '\n' for row in batch.to_pylist()).encode()
+
+    def finish(self) -> bytes:
+        return b''
+
+
+class ParquetEncoder:
+    """
+    Writes each batch as its own row group; the footer follows the last one.
+    A Parquet file has one schema, so batches whose columns were widened
+    after the first (see `rows_to_batch`) are cast back to it, which fails
+    the export if their values don't fit.
+    """
+    content_type = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._writer = None
+
+    def encode(self, batch) -> bytes:
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._sink, batch.schema, compression='zstd')
+        if batch.schema != self._writer.schema:
+            self._writer.write_table(pa.Table.from_batches([batch]).cast(self._writer.schema))
+        else:
+            self._writer.write_batch(batch)
+        return self._sink.drain()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+# COPY hands over one row at a time; rows are gathered into chunks of about this size.
+COPY_CHUNK_BYTES = 256 * 1024
+
+ENCODERS = {
+    'csv': CsvEncoder,
+    'ndjson': NdjsonEncoder,
+    'parquet': ParquetEncoder,
+}
+
+
+def stream_export(batches, encoder, gzip: bool = False):
+    """Encodes record batches into a stream of byte chunks, optionally gzip-compressed."""
+    chunks = _encode(batches, encoder)
+    return gzip_chunks(chunks) if gzip else chunks
+
+
+def _encode(batches, encoder):
+    for batch in batches:
+        data = encoder.encode(batch)
+        if data:
+            yield data
+    data = encoder.finish()
+    if data:
+        yield data
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for data in chunks:
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_source_export(query_history, sql: str, limits: dict, export_format: str, columns=None, gzip: bool = False):
+    """
+    Re-runs a query on its source database and streams it in `export_format`.
+    CSV exports of Postgres sources use COPY; everything else is fetched
+    from a cursor. A `max_bytes` of None in `limits` lifts the byte cap.
+    Raises KeyError for columns missing from the query's recorded result
+    schema.
+    """
+    if columns:
+        names, included = resolve_columns(query_history, columns)
+        columns = [names[i] for i in included]
+    if export_format == 'csv' and query_history.connection.driver == 'postgres':
+        chunks = _copy_source_csv(query_history, copy_statement(sql, columns), limits)
+        return gzip_chunks(chunks) if gzip else chunks
+    batches = _read_source_batches(query_history, sql, limits, columns)
+    return stream_export(batches, ENCODERS[export_format](), gzip=gzip)
+
+
+def copy_statement(sql: str, columns=None) -> str:
+    """Wraps a validated Postgres query in a COPY to STDOUT producing CSV with a header."""
+    query = sqlglot.parse_one(sql, read='postgres')
+    if columns:
+        query = exp.select(*(exp.column(name, quoted=True) for name in columns)).from_(query.subquery('export'))
+    return f"COPY ({query.sql(dialect='postgres')}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+
+def copy_csv_chunks(connection, statement: str, max_bytes: int = None, chunk_bytes: int = COPY_CHUNK_BYTES):
+    """
+    Runs a COPY ... TO STDOUT on an open SQLAlchemy connection (psycopg 3) and
+    yields its output in chunks of about `chunk_bytes`. Raises ExportTooLarge
+    once more than `max_bytes` have been produced.
+    """
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        with cursor.copy(statement) as copy:
+            buffered, size, total = [], 0, 0
+            for data in copy:
+                buffered.append(bytes(data))
+                size += len(data)
+                total += len(data)
+                if max_bytes is not None and total > max_bytes:
+                    raise ExportTooLarge(f"The export exceeds the {max_bytes} byte limit.")
+                if size >= chunk_bytes:
+                    yield b''.join(buffered)
+                    buffered, size = [], 0
+            if buffered:
+                yield b''.join(buffered)
+    finally:
+        cursor.close()
+
+
+def _copy_source_csv(query_history, statement, limits):
+    connection_obj = query_history.connection
+    engine = get_engine(connection_obj)
+    with engine.connect() as connection:
+        timeout = (
+            statement_timeout(connection, connection_obj, settings.EXPORT_TIMEOUT_MS)
+            if settings.EXPORT_TIMEOUT_MS else nullcontext()
+        )
+        with timeout:
+            yield from copy_csv_chunks(connection, statement, max_bytes=limits['max_bytes'])
+
+
+def cursor_batches(connection, sql: str, chunk_size: int):
+    """Executes `sql` on an open SQLAlchemy connection and yields its rows as record batches."""
+    result = connection.execution_options(
+        stream_results=True, max_row_buffer=chunk_size
+    ).execute(text(sql))
+    names = list(result.keys())
+    schema = None
+    for chunk in result.partitions(chunk_size):
+        batch = rows_to_batch(names, chunk, schema)
+        schema = batch.schema
+        yield batch
+    if schema is None:
+        # Empty results still carry their columns
+        yield pa.RecordBatch.from_pylist([], schema=pa.schema([pa.field(name, pa.string()) for name in names]))
+
+
+def _read_source_batches(query_history, sql, limits, columns):
+    connection_obj = query_history.connection
+    engine = get_engine(connection_obj)
+    with engine.connect() as connection:
+        deadline = time.monotonic() + limits['timeout_ms'] / 1000
+        interrupt = (
+            sqlite_interrupt_handler(connection, query_history.id, deadline)
+            if connection_obj.driver == 'sqlite' else nullcontext()
+        )
+        with statement_timeout(connection, connection_obj, limits['timeout_ms']), interrupt:
+            data_bytes = 0
+            for batch in cursor_batches(connection, sql, settings.RESULT_FETCH_CHUNK_ROWS):
+                data_bytes += batch.nbytes
+                if limits['max_bytes'] is not None and data_bytes > limits['max_bytes']:
+                    raise ExportTooLarge(f"The export exceeds the {limits['max_bytes']} byte limit.")
+                yield batch.select(columns) if columns else batch
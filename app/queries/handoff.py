@@ -0,0 +1,82 @@
+"""
+First-page handoff from the execution worker to the NLQ API.
+
+When a client asks for the first page inline, the API enqueues the
+execution and then blocks (BLPOP) on a short-lived Redis list for at most
+FIRST_PAGE_BUDGET_MS. The worker pushes the first FIRST_PAGE_ROWS rows onto
+that list as soon as it has fetched them, while the rest of the result keeps
+streaming into the result store. Executions that finish without filling a
+page (small, cached, shared or failed queries) push their complete outcome
+instead, so the client needs no further round trip.
+
+- `query_first_page:<history id>` list holding the single JSON payload.
+"""
+import json
+
+from django.conf import settings
+
+from app.common.redis import get_redis
+from .results import read_result_page
+
+FIRST_PAGE_PREFIX = 'query_first_page:'
+# Nobody waits for a first page longer than this.
+FIRST_PAGE_TTL_SEC = 60
+
+
+class FirstPageHandoff:
+    def __init__(self, history_id: int, client=None):
+        self.history_id = history_id
+        self.client = client or get_redis()
+        self.key = FIRST_PAGE_PREFIX + str(history_id)
+        self.published = False
+        self._rows = []
+
+    def offer(self, columns, rows):
+        """
+        Collects rows as the worker fetches them and publishes the first page
+        once it is full. Later calls are no-ops.
+        """
+        if self.published:
+            return
+        self._rows.extend(rows[:settings.FIRST_PAGE_ROWS - len(self._rows)])
+        if len(self._rows) >= settings.FIRST_PAGE_ROWS:
+            self._publish({
+                'complete': False,
+                'columns': list(columns),
+                'rows': [list(row) for row in self._rows],
+            })
+
+    def finish(self, query_history):
+        """Publishes the finished execution's outcome, unless a first page already went out."""
+        if self.published:
+            return
+        payload = {
+            'complete': True,
+            'status': query_history.status,
+            'row_count': query_history.row_count,
+            'truncated': query_history.truncated,
+            'error_text': query_history.error_text,
+            'columns': [],
+            'rows': [],
+        }
+        if query_history.result_path:
+            try:
+                payload['columns'], payload['rows'] = read_result_page(query_history, 0, settings.FIRST_PAGE_ROWS)
+            except FileNotFoundError:
+                pass
+            # More rows than fit on the page are fetched from the results API
+            payload['complete'] = (query_history.row_count or 0) <= settings.FIRST_PAGE_ROWS
+        self._publish(payload)
+
+    def wait(self, timeout_ms: int):
+        """Blocks until the worker publishes, for at most `timeout_ms`. Returns the payload or None."""
+        item = self.client.blpop(self.key, timeout=timeout_ms / 1000)
+        return json.loads(item[1]) if item is not None else None
+
+    def _publish(self, payload):
+        self.published = True
+        self._rows = []
+        pipe = self.client.pipeline()
+        pipe.rpush(self.key, json.dumps(payload, default=str))
+        pipe.expire(self.key, FIRST_PAGE_TTL_SEC)
+        pipe.execute()
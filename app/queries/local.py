@@ -0,0 +1,225 @@
+"""
+Local re-query of stored results.
+
+Follow-up prompts ("now sort by revenue", "only 2024") refine the result of
+an earlier query instead of asking the source database again. The earlier
+result is loaded from its stored Arrow file into an in-memory SQLite
+database as the table `previous_result`, and the refinement's SQL runs
+there, under the same row, byte and time limits as a source query.
+
+Each API process keeps the loaded databases in an LRU keyed by result file,
+bounded by LOCAL_QUERY_CACHE_MAX_BYTES of SQLite memory, so a conversation's
+follow-ups after the first only pay for the query itself. Results larger than
+LOCAL_QUERY_MAX_RESULT_BYTES on disk are not loaded.
+"""
+import datetime
+import decimal
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from .cancellation import SQLITE_PROGRESS_OPCODES, sqlite_progress_handler
+from .models import QueryHistory
+from .results import attach_result, iter_result_batches, open_result_writer
+from .tasks import mark_truncated, record_failure, store_chunk
+
+LOCAL_TABLE = 'previous_result'
+
+
+def local_columns(query_history):
+    """`(name, SQLite type)` of each column of the local table for a stored result."""
+    names, seen = [], set()
+    for column in query_history.result_schema:
+        # SQL results can repeat a column name (e.g. a.id, b.id); a table can't
+        name, suffix = column['name'], 2
+        while name.lower() in seen:
+            name, suffix = f"{column['name']}_{suffix}", suffix + 1
+        seen.add(name.lower())
+        names.append(name)
+    return [(name, _sqlite_type(column['type'])) for name, column in zip(names, query_history.result_schema)]
+
+
+def _sqlite_type(arrow_type: str) -> str:
+    if arrow_type.startswith(('int', 'uint', 'bool')):
+        return 'INTEGER'
+    if arrow_type.startswith(('float', 'double', 'halffloat')):
+        return 'REAL'
+    if arrow_type.startswith('decimal'):
+        return 'NUMERIC'
+    if 'binary' in arrow_type:
+        return 'BLOB'
+    return 'TEXT'
+
+
+def _sqlite_value(value):
+    """Values SQLite can't store natively are stored in a form that still sorts and compares correctly."""
+    if isinstance(value, decimal.Decimal):
+        # NUMERIC affinity turns it back into a number
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat(sep=' ') if isinstance(value, datetime.datetime) else value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def load_result(connection, query_history):
+    """Creates `previous_result` on a SQLite connection and fills it from a stored result, batch by batch."""
+    columns = local_columns(query_history)
+    connection.execute(
+        f"CREATE TABLE {LOCAL_TABLE} ({', '.join(f'{_quote(name)} {type_}' for name, type_ in columns)})"
+    )
+    insert = f"INSERT INTO {LOCAL_TABLE} VALUES ({', '.join('?' * len(columns))})"
+    for batch in iter_result_batches(query_history):
+        rows = zip(*(column.to_pylist() for column in batch.columns))
+        connection.executemany(insert, ([_sqlite_value(value) for value in row] for row in rows))
+    connection.commit()
+
+
+@dataclass
+class _LocalEntry:
+    connection: sqlite3.Connection
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    loaded: bool = False
+    size: int = 0
+
+
+class LocalResultCache:
+    """
+    In-memory SQLite databases holding stored results, least recently used
+    first out once they take more than `max_bytes`.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connect(self, query_history, timer=None):
+        """
+        Yields a SQLite connection with `query_history`'s result loaded as
+        `previous_result`. Loading it is timed as `local_load`.
+        """
+        key = query_history.result_path
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _LocalEntry(sqlite3.connect(':memory:', check_same_thread=False))
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+        with entry.lock:
+            if not entry.loaded:
+                try:
+                    with timer.stage('local_load') if timer is not None else nullcontext():
+                        load_result(entry.connection, query_history)
+                except BaseException:
+                    self._discard(key, entry)
+                    raise
+                # Follow-ups only read; the validator already allows nothing else
+                entry.connection.execute("PRAGMA query_only = ON")
+                entry.loaded = True
+                page_count = entry.connection.execute("PRAGMA page_count").fetchone()[0]
+                page_size = entry.connection.execute("PRAGMA page_size").fetchone()[0]
+                entry.size = page_count * page_size
+                self._evict(keep=key)
+            yield entry.connection
+
+    def __contains__(self, result_path):
+        return result_path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, keep):
+        with self._lock:
+            evicted = []
+            total = sum(entry.size for entry in self._entries.values())
+            for key in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                entry = self._entries.pop(key)
+                total -= entry.size
+                evicted.append(entry)
+        # Entries in use are closed once their query finishes
+        for entry in evicted:
+            threading.Thread(target=self._close, args=(entry,), daemon=True).start()
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.connection.close()
+
+    @staticmethod
+    def _close(entry):
+        with entry.lock:
+            entry.connection.close()
+
+
+cache = LocalResultCache(max_bytes=settings.LOCAL_QUERY_CACHE_MAX_BYTES)
+
+
+def ensure_loaded(query_history, timer=None):
+    """
+    Loads a stored result into the local engine ahead of its first query.
+    Raises FileNotFoundError if the result has expired from the store.
+    """
+    with cache.connect(query_history, timer):
+        pass
+
+
+def run_local_query(base_history, query_history, sql_to_run: str, limits: dict, timer):
+    """
+    Runs a follow-up's SQL against `base_history`'s stored result in the
+    local engine and stores its result, recording the outcome on
+    `query_history` (without saving), like the execution worker does. It
+    runs in the API request, so it is bounded by LOCAL_QUERY_TIMEOUT_MS
+    rather than the plan's source timeout.
+    """
+    timeout_ms = min(limits['timeout_ms'], settings.LOCAL_QUERY_TIMEOUT_MS)
+    deadline = None
+    try:
+        with cache.connect(base_history, timer) as connection:
+            deadline = time.monotonic() + timeout_ms / 1000
+            connection.set_progress_handler(
+                sqlite_progress_handler(query_history.id, deadline), SQLITE_PROGRESS_OPCODES
+            )
+            try:
+                with timer.stage('execute'):
+                    cursor = connection.execute(sql_to_run)
+                with open_result_writer(query_history, [column[0] for column in cursor.description]) as writer:
+                    reason = _fetch_local_result(cursor, writer, limits, timer)
+            finally:
+                connection.set_progress_handler(None, 0)
+
+        query_history.status = QueryHistory.Status.OK
+        attach_result(query_history, writer)
+        mark_truncated(query_history, reason)
+    except Exception as e:
+        record_failure(query_history, e, deadline, timeout_ms)
+
+
+def _fetch_local_result(cursor, writer, limits: dict, timer) -> str:
+    while True:
+        with timer.stage('fetch'):
+            chunk = cursor.fetchmany(settings.RESULT_FETCH_CHUNK_ROWS)
+        if not chunk:
+            return ''
+        reason = store_chunk(chunk, writer, limits, timer)
+        if reason:
+            return reason
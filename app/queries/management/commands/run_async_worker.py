@@ -0,0 +1,29 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.queries.async_worker import AsyncExecutionWorker
+
+
+class Command(BaseCommand):
+    help = "Runs query executions from a Celery queue concurrently on one asyncio event loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', default='interactive', help="Celery queue to consume (default: interactive)")
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.ASYNC_WORKER_CONCURRENCY,
+            help="Executions to run at once (default: ASYNC_WORKER_CONCURRENCY)"
+        )
+        parser.add_argument(
+            '--threads', type=int, default=settings.ASYNC_WORKER_THREADS,
+            help="Threads for ORM and Redis calls (default: ASYNC_WORKER_THREADS)"
+        )
+
+    def handle(self, *args, **options):
+        worker = AsyncExecutionWorker(options['queue'], options['concurrency'], options['threads'])
+        # Finish running executions before exiting
+        signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+        signal.signal(signal.SIGINT, lambda *_: worker.stop())
+        self.stdout.write(f"Consuming {options['queue']} with up to {options['concurrency']} concurrent executions")
+        worker.run()
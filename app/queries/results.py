@@ -0,0 +1,329 @@
+"""
+The result store: executed result sets persisted as columnar files.
+
+The execution worker never holds a full result set in memory. Rows are
+fetched from the source database in fixed-size chunks and each chunk is
+appended to a compressed Arrow IPC file as one record batch. The file is
+written through a `pyarrow.fs` filesystem, so the store can live on local
+disk or on any filesystem Arrow supports (e.g. `s3://bucket/results`).
+
+`QueryHistory` only keeps a reference to the file (plus its size, schema,
+row count and batch boundaries). Pages are served by memory-mapping the file
+and decoding only the batches and columns they cover. Files are evicted by
+age and by total store size.
+"""
+import bisect
+import datetime
+import itertools
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from pyarrow import fs
+from django.conf import settings
+from django.db.models import Max
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import QueryHistory
+
+
+def get_store():
+    """
+    Returns `(filesystem, root)` for the configured result store.
+    RESULT_STORE_URI takes precedence; otherwise RESULT_STORE_ROOT is used as a local directory.
+    """
+    if settings.RESULT_STORE_URI:
+        return fs.FileSystem.from_uri(settings.RESULT_STORE_URI)
+    return fs.LocalFileSystem(), settings.RESULT_STORE_ROOT
+
+
+def _full_path(relative_path: str) -> str:
+    _, root = get_store()
+    return f"{root.rstrip('/')}/{relative_path}"
+
+
+def _to_array(values, type=None):
+    """
+    Builds an Arrow array from Python values. Columns whose values Arrow
+    can't reconcile into one type (e.g. mixed SQLite affinities) are stored as strings.
+    """
+    try:
+        array = pa.array(values, type=type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        array = None
+    if array is None or pa.types.is_null(array.type):
+        return _to_strings(values)
+    return array
+
+
+def _to_strings(values):
+    return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _cast(values, type):
+    """
+    Builds an Arrow array of `type` from Python values. Values that don't fit
+    get a wider type instead: a decimal with more digits, float64 for
+    integers followed by floats, and otherwise strings.
+    """
+    if all(v is None for v in values):
+        return pa.nulls(len(values), type=type)
+    array = _to_array(values)
+    if array.type == type:
+        return array
+    schemas = [pa.schema([pa.field('v', type)]), pa.schema([pa.field('v', array.type)])]
+    try:
+        wider = pa.unify_schemas(schemas, promote_options='permissive').field('v').type
+        # A safe cast, so values are never silently truncated or rounded
+        return array.cast(wider)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return _to_strings(values)
+
+
+def rows_to_batch(columns, rows, schema=None) -> pa.RecordBatch:
+    """
+    Converts a chunk of rows into a record batch. Without a `schema`, column
+    types are inferred from the chunk; otherwise values are cast to it, and
+    columns whose values don't fit are widened, so the batch's schema can
+    differ from `schema`.
+    """
+    values = list(zip(*rows))
+    if schema is None:
+        arrays = [_to_array(column_values) for column_values in values]
+    else:
+        arrays = [_cast(column_values, field.type) for column_values, field in zip(values, schema)]
+    schema = pa.schema([pa.field(name, array.type) for name, array in zip(columns, arrays)])
+    return pa.record_batch(arrays, schema=schema)
+
+
+class ResultWriter:
+    """
+    Writes a result set chunk by chunk as record batches of an Arrow IPC file.
+    The schema is inferred from the first chunk; later chunks are cast to it.
+    When a chunk needs a wider column type, the batches written so far are
+    rewritten with it, since an IPC file has a single schema.
+    """
+    def __init__(self, relative_path: str, columns):
+        self.relative_path = relative_path
+        self.columns = list(columns)
+        self.schema = None
+        self.row_count = 0
+        self.byte_size = 0
+        # Uncompressed in-memory size of the rows written so far.
+        self.data_bytes = 0
+        self.batch_rows = []
+        self._sink = None
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Don't leave half-written results behind.
+            self.discard()
+        else:
+            self.close()
+
+    def write_chunk(self, rows):
+        """Writes one chunk of rows (sequences ordered like `columns`)."""
+        if not rows:
+            return
+        batch = rows_to_batch(self.columns, rows, self.schema)
+        if self.schema is None:
+            self._open(batch.schema)
+        elif batch.schema != self.schema:
+            self._widen(batch.schema)
+        self._writer.write_batch(batch)
+        self.row_count += len(rows)
+        self.data_bytes += batch.nbytes
+        self.batch_rows.append(len(rows))
+
+    def close(self):
+        if self._writer is None:
+            # Empty result: still write a file so the schema is known.
+            self._open(pa.schema([pa.field(name, pa.string()) for name in self.columns]))
+        self._writer.close()
+        self._sink.close()
+        filesystem, _ = get_store()
+        self.byte_size = filesystem.get_file_info(_full_path(self.relative_path)).size
+
+    def discard(self):
+        if self._writer is not None:
+            self._sink.close()
+        delete_result_file(self.relative_path)
+
+    def describe_schema(self):
+        return [{'name': field.name, 'type': str(field.type)} for field in self.schema]
+
+    def _open(self, schema):
+        filesystem, _ = get_store()
+        path = _full_path(self.relative_path)
+        filesystem.create_dir(path.rsplit('/', 1)[0], recursive=True)
+        self.schema = schema
+        self._sink = filesystem.open_output_stream(path)
+        options = ipc.IpcWriteOptions(compression=settings.RESULT_STORE_COMPRESSION or None)
+        self._writer = ipc.new_file(self._sink, schema, options=options)
+
+    def _widen(self, schema):
+        """Rewrites the batches written so far with `schema`, whose types are wider than theirs."""
+        self._writer.close()
+        self._sink.close()
+        filesystem, _ = get_store()
+        path = _full_path(self.relative_path)
+        narrow_path = f"{path}.narrow"
+        filesystem.move(path, narrow_path)
+        try:
+            self._open(schema)
+            self.data_bytes = 0
+            with filesystem.open_input_file(narrow_path) as source:
+                reader = ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    table = pa.Table.from_batches([reader.get_batch(index)]).cast(schema)
+                    self._writer.write_table(table)
+                    self.data_bytes += table.nbytes
+        finally:
+            filesystem.delete_file(narrow_path)
+
+
+def get_result_path(query_history) -> str:
+    """Where the stored result of a query history entry lives, relative to the store root."""
+    return f"{query_history.tenant_id}/{query_history.id}.arrow"
+
+
+def open_result_writer(query_history, columns) -> ResultWriter:
+    return ResultWriter(get_result_path(query_history), columns)
+
+
+def attach_result(query_history, writer: ResultWriter):
+    """Records a closed writer's file on its query history entry (without saving)."""
+    query_history.result_path = writer.relative_path
+    query_history.result_bytes = writer.byte_size
+    query_history.result_schema = writer.describe_schema()
+    query_history.result_batch_rows = writer.batch_rows
+    query_history.row_count = writer.row_count
+
+
+def _open_input(relative_path: str):
+    """Memory-maps local result files; other filesystems get a random-access file."""
+    filesystem, _ = get_store()
+    path = _full_path(relative_path)
+    if isinstance(filesystem, fs.LocalFileSystem):
+        return pa.memory_map(path, 'r')
+    return filesystem.open_input_file(path)
+
+
+def read_result_page(query_history, offset: int, limit: int, columns=None):
+    """
+    Reads rows [offset, offset + limit) of a stored result, optionally only
+    some of its columns. Only the record batches overlapping the range are
+    decoded, and only the buffers of the requested columns are read, so the
+    cost is independent of the total result size.
+
+    Returns `(column_names, rows)`. Raises KeyError for unknown columns.
+    """
+    names, included = resolve_columns(query_history, columns)
+
+    # Cumulative row offsets of each batch, e.g. [0, 5000, 10000, ...].
+    starts = [0, *itertools.accumulate(query_history.result_batch_rows)]
+    end = min(offset + limit, starts[-1])
+    rows = []
+    if offset < end:
+        options = ipc.IpcReadOptions(included_fields=included)
+        with _open_input(query_history.result_path) as source:
+            reader = ipc.open_file(source, options=options)
+            first = bisect.bisect_right(starts, offset) - 1
+            last = bisect.bisect_left(starts, end) - 1
+            for index in range(first, last + 1):
+                batch = reader.get_batch(index)
+                batch_start = starts[index]
+                batch = batch.slice(max(offset - batch_start, 0), end - max(offset, batch_start))
+                rows.extend(zip(*(column.to_pylist() for column in batch.columns)))
+    return [names[i] for i in included], [list(row) for row in rows]
+
+
+def resolve_columns(query_history, columns):
+    """Indices of the requested columns in file order. Raises KeyError for unknown columns."""
+    names = [column['name'] for column in query_history.result_schema]
+    if not columns:
+        return names, list(range(len(names)))
+    unknown = [name for name in columns if name not in names]
+    if unknown:
+        raise KeyError(', '.join(unknown))
+    # Arrow returns included fields in file order.
+    return names, sorted({names.index(name) for name in columns})
+
+
+def iter_result_batches(query_history, columns=None):
+    """
+    Yields the record batches of a stored result one at a time, optionally
+    only some of its columns. Memory use is bounded by a single batch.
+    Raises KeyError for unknown columns.
+    """
+    _, included = resolve_columns(query_history, columns)
+    return _read_batches(query_history.result_path, included)
+
+
+def _read_batches(relative_path: str, included):
+    options = ipc.IpcReadOptions(included_fields=included)
+    with _open_input(relative_path) as source:
+        reader = ipc.open_file(source, options=options)
+        if reader.num_record_batches == 0:
+            # Empty results still carry their columns
+            yield pa.RecordBatch.from_pylist([], schema=pa.schema([reader.schema.field(i) for i in included]))
+        for index in range(reader.num_record_batches):
+            yield reader.get_batch(index)
+
+
+def result_exists(relative_path: str) -> bool:
+    filesystem, _ = get_store()
+    return filesystem.get_file_info(_full_path(relative_path)).type != fs.FileType.NotFound
+
+
+def delete_result_file(relative_path: str):
+    filesystem, _ = get_store()
+    try:
+        filesystem.delete_file(_full_path(relative_path))
+    except FileNotFoundError:
+        pass
+
+
+def evict_results(now=None):
+    """
+    Deletes stored results last referenced more than RESULT_STORE_TTL_SEC ago,
+    then the least recently referenced ones until the store fits in
+    RESULT_STORE_MAX_BYTES. A file can be shared by several history entries
+    (see app.queries.cache), so it is judged by its most recent reference.
+    Returns the number of evicted result files.
+    """
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(seconds=settings.RESULT_STORE_TTL_SEC)
+    stored = (
+        QueryHistory.objects.exclude(result_path='')
+        .values('result_path')
+        .annotate(last_used=Max('created_at'), size=Max('result_bytes'))
+        .order_by('-last_used')
+    )
+
+    evicted = []
+    total_bytes = 0
+    for row in stored.iterator():
+        if row['last_used'] < cutoff:
+            evicted.append(row['result_path'])
+            continue
+        total_bytes += row['size'] or 0
+        if total_bytes > settings.RESULT_STORE_MAX_BYTES:
+            evicted.append(row['result_path'])
+
+    for result_path in evicted:
+        delete_result_file(result_path)
+    QueryHistory.objects.filter(result_path__in=evicted).update(result_path='', result_bytes=None)
+    return len(evicted)
+
+
+@receiver(post_delete, sender=QueryHistory)
+def delete_result_on_history_delete(sender, instance, **kwargs):
+    """Removes a history entry's result file once nothing else references it."""
+    if instance.result_path and not QueryHistory.objects.filter(result_path=instance.result_path).exists():
+        delete_result_file(instance.result_path)
@@ -0,0 +1,105 @@
+"""
+Single-flight deduplication of identical in-flight query executions.
+
+When several identical queries (same result cache fingerprint) are enqueued
+at once, only the first one to start (the leader) runs against the source
+database. The others attach to it as waiters and are completed from the
+leader's outcome, so a thundering herd costs one source query.
+
+Redis keys, all suffixed with the fingerprint:
+
+- `singleflight:leader:` the leader's history id; expires after the lease so a
+  crashed leader doesn't block the fingerprint forever. A running leader
+  renews it while fetching (see `renew`).
+- `singleflight:waiters:` list of history ids attached to the leader.
+- `singleflight:done:` the leader's outcome, kept briefly for waiters that
+  attach while the leader is finishing.
+"""
+import json
+import math
+
+from django.conf import settings
+
+from app.common.redis import get_redis
+from .cache import RESULT_FIELDS
+
+LEADER_PREFIX = 'singleflight:leader:'
+WAITERS_PREFIX = 'singleflight:waiters:'
+DONE_PREFIX = 'singleflight:done:'
+
+# Fields copied from the leader's history entry onto its waiters.
+OUTCOME_FIELDS = ('status', 'error_text') + RESULT_FIELDS
+
+
+def lease_seconds(timeout_ms: int) -> int:
+    """
+    How long an execution holds its fingerprint and connection slot between
+    renewals: the plan's query timeout plus a grace period.
+    """
+    return math.ceil(timeout_ms / 1000) + settings.SINGLE_FLIGHT_GRACE_SEC
+
+
+class SingleFlight:
+    def __init__(self, fingerprint: str, client=None):
+        self.fingerprint = fingerprint
+        self.client = client or get_redis()
+
+    def lead(self, history_id: int, ttl: int) -> bool:
+        """
+        Tries to become the leader for this fingerprint for `ttl` seconds. A
+        leader that retries (e.g. while queued for a connection slot) keeps
+        its lead and renews the lease.
+        """
+        leader_key = LEADER_PREFIX + self.fingerprint
+        if self.client.set(leader_key, history_id, nx=True, ex=ttl):
+            return True
+        return self.renew(history_id, ttl)
+
+    def renew(self, history_id: int, ttl: int) -> bool:
+        """Extends the lead by `ttl` seconds if `history_id` still holds it."""
+        leader_key = LEADER_PREFIX + self.fingerprint
+        if self.client.get(leader_key) != str(history_id).encode():
+            return False
+        pipe = self.client.pipeline()
+        pipe.expire(leader_key, ttl)
+        pipe.expire(WAITERS_PREFIX + self.fingerprint, ttl)
+        pipe.execute()
+        return True
+
+    def attach(self, history_id: int, ttl: int):
+        """
+        Registers a waiter with the running leader. Returns the leader's
+        outcome if it has already finished, otherwise None (the leader will
+        complete the waiter).
+        """
+        waiters_key = WAITERS_PREFIX + self.fingerprint
+        pipe = self.client.pipeline()
+        pipe.rpush(waiters_key, history_id)
+        pipe.expire(waiters_key, ttl)
+        pipe.get(DONE_PREFIX + self.fingerprint)
+        done = pipe.execute()[2]
+        return json.loads(done) if done is not None else None
+
+    def finish(self, outcome: dict) -> list:
+        """
+        Publishes the leader's outcome and releases the fingerprint.
+        Returns the history ids of the waiters to complete.
+        """
+        waiters_key = WAITERS_PREFIX + self.fingerprint
+        pipe = self.client.pipeline()
+        pipe.set(DONE_PREFIX + self.fingerprint, json.dumps(outcome), ex=settings.SINGLE_FLIGHT_GRACE_SEC)
+        pipe.lrange(waiters_key, 0, -1)
+        pipe.delete(waiters_key)
+        pipe.delete(LEADER_PREFIX + self.fingerprint)
+        waiters = pipe.execute()[1]
+        return [int(history_id) for history_id in waiters]
+
+
+def outcome_of(query_history) -> dict:
+    return {field: getattr(query_history, field) for field in OUTCOME_FIELDS}
+
+
+def apply_outcome(query_history, outcome: dict):
+    """Completes a history entry from a leader's outcome (without saving)."""
+    for field in OUTCOME_FIELDS:
+        setattr(query_history, field, outcome[field])
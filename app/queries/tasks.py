@@ -1,56 +1,351 @@
+import math
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
 from celery import shared_task
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from django.conf import settings
+from django.utils import timezone
+from .cancellation import (
+    QueryCancelled, get_backend_pid, is_cancel_requested, release_backend_pid, sqlite_interrupt_handler
+)
+from .cache import ResultCache, apply_cached_result, is_cache_enabled, result_cache_key
+from .handoff import FirstPageHandoff
 from .models import QueryHistory
-from app.schema_registry.tasks import get_db_url # Re-use the helper
+from .results import attach_result, evict_results, open_result_writer
+from .singleflight import SingleFlight, apply_outcome, lease_seconds, outcome_of
+from .timeouts import DeadlineExceeded, is_timeout_error, statement_timeout
+from app.common.timing import StageTimer
+from app.connections.engines import get_engine
+from app.connections.limiter import ConnectionLimiter, LeaseKeeper
+from app.nlq.services.validator import SQLValidator, InvalidSQLError
+from app.schema_registry.models import SchemaCache
+from app.tenancy.plans import get_plan_limits
+
+@dataclass
+class Execution:
+    """An execution that passed validation, the cache and single-flight, between `prepare_execution` and `finish_execution`."""
+    query_history: QueryHistory
+    sql_to_run: str
+    limits: dict
+    timer: StageTimer
+    handoff: FirstPageHandoff
+    fingerprint: str
+    use_cache: bool
+    flight: SingleFlight
+    limiter: ConnectionLimiter
+    admitted: bool
+    lease: LeaseKeeper
+
 
 @shared_task
-def execute_query_task(query_history_id: int):
+def execute_query_task(query_history_id: int, first_page: bool = False):
     """
     A Celery task to execute a validated SQL query against a user's database.
+    With `first_page`, the first page of rows is handed to the waiting API
+    as soon as it is fetched (see app.queries.handoff).
+    """
+    delivery_info = execute_query_task.request.delivery_info or {}
+    execution, message = prepare_execution(query_history_id, first_page, delivery_info.get('routing_key'))
+    if execution is None:
+        return message
+
+    try:
+        if execution.admitted:
+            try:
+                run_query(
+                    execution.query_history, execution.sql_to_run, execution.limits, execution.timer,
+                    execution.handoff, execution.lease,
+                )
+            finally:
+                execution.limiter.release(query_history_id)
+        finish_execution(execution)
+    finally:
+        complete_attached(execution)
+
+    return f"Execution finished for QueryHistory id {query_history_id} with status {execution.query_history.status}"
+
+
+def prepare_execution(query_history_id: int, first_page: bool = False, queue: str = None):
+    """
+    Everything an execution does before it runs on the source: validation,
+    the result cache, single-flight and admission control. Returns
+    `(execution, None)` when the query should run (or finish with an
+    admission error), otherwise `(None, message)` once the entry is complete
+    or has been requeued on `queue`.
     """
     try:
-        query_history = QueryHistory.objects.select_related('connection').get(id=query_history_id)
+        query_history = QueryHistory.objects.select_related('connection', 'tenant').get(id=query_history_id)
     except QueryHistory.DoesNotExist:
-        return f"QueryHistory with id {query_history_id} not found."
+        return None, f"QueryHistory with id {query_history_id} not found."
+
+    if query_history.status != QueryHistory.Status.PENDING:
+        # Already completed, e.g. by the leader of a single-flight group
+        return None, f"QueryHistory id {query_history_id} already finished with status {query_history.status}"
+
+    # Carry on from the API's timings. The entry was created just before it
+    # was enqueued, so the queue wait includes any time spent requeued.
+    timer = StageTimer(query_history.timings)
+    timer.add('queue_wait', (timezone.now() - query_history.created_at).total_seconds() * 1000)
 
     connection_obj = query_history.connection
-    db_url = get_db_url(connection_obj)
+    limits = get_plan_limits(query_history.tenant)
+    handoff = FirstPageHandoff(query_history.id) if first_page else None
+
+    try:
+        # Re-validate and cap the row count on the parsed AST, so the limit is
+        # rendered correctly for the dialect (LIMIT, TOP or FETCH FIRST).
+        with timer.stage('validate'):
+            validator = SQLValidator(query_history.generated_sql, dialect=connection_obj.driver)
+            validator.validate()
+            if query_history.preview:
+                # Read samples of each table; the preview's results are approximate
+                validator.apply_sampling(settings.PREVIEW_SAMPLE_PERCENT, settings.PREVIEW_SCAN_ROWS)
+    except InvalidSQLError as e:
+        query_history.status = QueryHistory.Status.ERROR
+        query_history.error_text = f"Validation Error: {e}"
+        _save(query_history, timer, handoff)
+        return None, f"Execution finished for QueryHistory id {query_history_id} with status {query_history.status}"
 
-    # Add a LIMIT to the query to prevent fetching too much data
-    # This is a simple implementation. A more robust one would use sqlglot to parse
-    # and safely add the limit clause.
-    sql_to_run = query_history.generated_sql
-    if "limit" not in sql_to_run.lower():
-        sql_to_run = f"{sql_to_run.rstrip(';')} LIMIT {settings.RESULT_MAX_ROWS};"
+    # Fetch one row over the cap, so a result cut short by it can be told
+    # apart from one that is exactly max_rows long.
+    sql_to_run = validator.apply_row_limit(limits['max_rows'] + 1)
 
+    # Identical queries against an unchanged schema share one fingerprint
+    schema_hash = SchemaCache.objects.filter(connection=connection_obj).values_list('hash', flat=True).first()
+    fingerprint = result_cache_key(connection_obj.id, validator.normalized_sql(), schema_hash or '', limits)
+
+    # Serve the query from the result cache if an earlier run is still stored
+    use_cache = is_cache_enabled(connection_obj)
+    if use_cache:
+        cached = ResultCache().get(fingerprint)
+        if cached is not None:
+            apply_cached_result(query_history, cached)
+            query_history.status = QueryHistory.Status.OK
+            _save(query_history, timer, handoff)
+            return None, (
+                f"Execution finished for QueryHistory id {query_history_id} with status {query_history.status} (cached)"
+            )
+
+    # Attach to an identical execution that is already running, if any. The
+    # leader renews its lease while it fetches, so it only lapses if it died.
+    ttl = lease_seconds(limits['timeout_ms'])
+    flight = SingleFlight(fingerprint)
+    if not flight.lead(query_history.id, ttl):
+        outcome = flight.attach(query_history.id, ttl)
+        if outcome is None:
+            # The leader completes this entry. Check back once its lease has
+            # expired, in case it died before doing so.
+            _requeue(query_history.id, ttl, settings.QUERY_PRIORITY_INTERACTIVE, queue)
+            return None, f"QueryHistory id {query_history_id} attached to an in-flight execution"
+        apply_outcome(query_history, outcome)
+        _save(query_history, timer, handoff)
+        return None, (
+            f"Execution finished for QueryHistory id {query_history_id} with status {query_history.status} (shared)"
+        )
+
+    # Admission control: cap the queries running at once against the source
+    limiter = ConnectionLimiter(connection_obj)
+    admitted = limiter.acquire(query_history.id, ttl)
+    if not admitted:
+        if limiter.waited(query_history.id) < settings.SOURCE_ADMISSION_MAX_WAIT_SEC:
+            # Stay queued (and the single-flight leader) and try again shortly
+            _requeue(query_history.id, settings.SOURCE_ADMISSION_RETRY_SEC, settings.QUERY_PRIORITY_RETRY, queue)
+            return None, f"QueryHistory id {query_history_id} queued for a connection slot"
+        limiter.abandon(query_history.id)
+        query_history.status = QueryHistory.Status.ERROR
+        query_history.error_text = (
+            f"The connection is busy. Retry after {max(math.ceil(limiter.retry_after()), 1)} seconds."
+        )
+
+    execution = Execution(
+        query_history=query_history,
+        sql_to_run=sql_to_run,
+        limits=limits,
+        timer=timer,
+        handoff=handoff,
+        fingerprint=fingerprint,
+        use_cache=use_cache,
+        flight=flight,
+        limiter=limiter,
+        admitted=admitted,
+        lease=LeaseKeeper(ttl, (limiter, query_history.id), (flight, query_history.id)),
+    )
+    return execution, None
+
+
+def finish_execution(execution: Execution):
+    """Saves the outcome of an execution's run and caches its result."""
+    query_history = execution.query_history
+    if is_cancel_requested(query_history.id):
+        # The cancel API has already reported this query as cancelled
+        query_history.status = QueryHistory.Status.CANCELLED
+        query_history.error_text = "Cancelled by user."
+    _save(query_history, execution.timer, execution.handoff)
+    if execution.use_cache and query_history.status == QueryHistory.Status.OK:
+        ResultCache().put(execution.fingerprint, query_history)
+
+
+def complete_attached(execution: Execution):
+    """Completes every execution that attached to this one. Runs even if the execution failed."""
+    outcome = outcome_of(execution.query_history)
+    if outcome['status'] == QueryHistory.Status.CANCELLED:
+        # Only the leader's user cancelled. Rewrite the outcome before it is
+        # published, so executions that attach late don't read it as theirs.
+        outcome.update(status=QueryHistory.Status.ERROR, error_text="The shared execution was cancelled.")
+    waiters = execution.flight.finish(outcome)
+    QueryHistory.objects.filter(id__in=waiters, status=QueryHistory.Status.PENDING).update(**outcome)
+
+
+def _save(query_history, timer, handoff=None):
+    """Saves a finished execution and hands its outcome to the API if it is waiting for one."""
+    # The worker's own time, from picking the task up to storing the result
+    query_history.duration_ms = timer.elapsed_ms()
+    query_history.save()
+    if handoff is not None:
+        handoff.finish(query_history)
+
+
+def _requeue(query_history_id: int, countdown: int, priority: int, queue: str = None):
+    """
+    Runs the execution again later on the queue it came from, so queries
+    routed to the low-priority queue stay there.
+    """
+    execute_query_task.apply_async((query_history_id,), countdown=countdown, queue=queue, priority=priority)
+
+
+def run_query(query_history, sql_to_run: str, limits: dict, timer, handoff=None, lease=None):
+    """
+    Runs the query against the source database and stores its result,
+    recording the outcome on the history entry (without saving). `lease` is
+    renewed while the result is fetched.
+    """
+    connection_obj = query_history.connection
+    timeout_ms = limits['timeout_ms']
+    deadline = None
     try:
-        # Connect with statement-level timeout
-        timeout_sec = settings.QUERY_TIMEOUT_MS / 1000
-        engine = create_engine(db_url, connect_args={'connect_timeout': timeout_sec})
+        # Re-use this worker's pooled engine for the connection
+        engine = get_engine(connection_obj)
 
         with engine.connect() as connection:
-            # For postgres, we can set a statement timeout
-            if connection_obj.driver == 'postgres':
-                connection.execute(text(f"SET statement_timeout = {settings.QUERY_TIMEOUT_MS}"))
+            # Record the source session running the query so it can be cancelled
+            query_history.backend_pid = get_backend_pid(connection, connection_obj.driver)
+            QueryHistory.objects.filter(id=query_history.id).update(backend_pid=query_history.backend_pid)
+            try:
+                if is_cancel_requested(query_history.id):
+                    raise QueryCancelled()
 
-            result = connection.execute(text(sql_to_run))
+                # Bound the statement with the driver's own timeout mechanism. SQLite
+                # has no session to kill, so it checks its deadline and cancel requests itself.
+                deadline = time.monotonic() + timeout_ms / 1000
+                interrupt = (
+                    sqlite_interrupt_handler(connection, query_history.id, deadline)
+                    if connection_obj.driver == 'sqlite' else nullcontext()
+                )
+                with statement_timeout(connection, connection_obj, timeout_ms, query_history.backend_pid), interrupt:
+                    # Use a server-side cursor where the driver supports one, so rows
+                    # are pulled from the source in chunks instead of all at once.
+                    with timer.stage('execute'):
+                        result = connection.execution_options(
+                            stream_results=True, max_row_buffer=settings.RESULT_FETCH_CHUNK_ROWS
+                        ).execute(text(sql_to_run))
 
-            # Fetch results and convert to a list of dicts
-            results_as_dict = [row._asdict() for row in result]
+                    writer = open_result_writer(query_history, result.keys())
+                    try:
+                        reason = _fetch_result(result, writer, limits, timer, handoff, deadline, lease)
+                    except Exception as e:
+                        if writer.row_count and is_timeout_error(e, connection_obj.driver, deadline):
+                            # Keep the rows that arrived before the deadline
+                            with timer.stage('serialize'):
+                                writer.close()
+                            attach_result(query_history, writer)
+                            mark_truncated(query_history, QueryHistory.TruncatedReason.TIMEOUT)
+                        else:
+                            writer.discard()
+                        raise
+                    with timer.stage('serialize'):
+                        writer.close()
 
-            # Update history object
-            query_history.status = QueryHistory.Status.OK
-            query_history.row_count = len(results_as_dict)
-            # In a real app, you'd store the results somewhere (e.g., S3, Redis)
-            # and just save a reference here. Storing large results in the DB is bad.
-            # For now, we'll just log success.
-            # query_history.results = results_as_dict
+                # Update history object with a reference to the stored result
+                query_history.status = QueryHistory.Status.OK
+                attach_result(query_history, writer)
+                mark_truncated(query_history, reason)
+            finally:
+                # The session goes back to the pool and may run other tenants' queries
+                release_backend_pid(query_history)
 
     except Exception as e:
+        record_failure(query_history, e, deadline, timeout_ms)
+
+
+def record_failure(query_history, exc: Exception, deadline: float, timeout_ms: int):
+    """Records why a run failed: its timeout (once the statement had started) or the error itself."""
+    if deadline is not None and is_timeout_error(exc, query_history.connection.driver, deadline):
+        query_history.status = QueryHistory.Status.TIMEOUT
+        query_history.error_text = f"Query exceeded the {timeout_ms} ms timeout."
+        if query_history.truncated:
+            query_history.error_text += f" Returning the {query_history.row_count} rows fetched before it."
+    else:
         query_history.status = QueryHistory.Status.ERROR
-        query_history.error_text = str(e)
+        query_history.error_text = str(exc)
 
-    query_history.save()
 
-    return f"Execution finished for QueryHistory id {query_history_id} with status {query_history.status}"
+def _fetch_result(result, writer, limits: dict, timer, handoff=None, deadline: float = None, lease=None) -> str:
+    """
+    Writes each chunk to the result store as it arrives, keeping worker memory
+    flat regardless of the result size. Stops at the row or byte cap and
+    returns the reason, or '' if the whole result was fetched. Raises
+    DeadlineExceeded once `deadline` has passed between chunks. Time spent
+    waiting on the source counts as `fetch`, time spent encoding and writing
+    as `serialize`.
+    """
+    chunks = result.partitions(settings.RESULT_FETCH_CHUNK_ROWS)
+    while True:
+        # Statement timeouts bound each fetch, not the whole result
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlineExceeded()
+        with timer.stage('fetch'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return ''
+        if lease is not None:
+            lease.tick()
+        reason = store_chunk(chunk, writer, limits, timer, handoff)
+        if reason:
+            return reason
+
+
+def store_chunk(chunk, writer, limits: dict, timer, handoff=None) -> str:
+    """
+    Writes one fetched chunk to the result store, up to the row cap. Returns
+    the reason to stop fetching, or '' to carry on.
+    """
+    remaining = limits['max_rows'] - writer.row_count
+    truncated = len(chunk) > remaining
+    if truncated:
+        # The query fetches one row over the cap, so there are more rows
+        chunk = chunk[:remaining]
+    with timer.stage('serialize'):
+        writer.write_chunk(chunk)
+    if handoff is not None:
+        handoff.offer(writer.columns, chunk)
+    if truncated:
+        return QueryHistory.TruncatedReason.ROW_LIMIT
+    # Stop fetching once the result exceeds the byte cap
+    if writer.data_bytes >= limits['max_bytes']:
+        return QueryHistory.TruncatedReason.BYTE_LIMIT
+    return ''
+
+
+def mark_truncated(query_history, reason: str):
+    query_history.truncated = bool(reason)
+    query_history.truncated_reason = reason
+
+
+@shared_task
+def evict_results_task():
+    """
+    A periodic Celery task that enforces the result store's TTL and size budget.
+    """
+    evicted = evict_results()
+    return f"Evicted {evicted} stored results"
@@ -0,0 +1,984 @@
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import threading
+import time
+from decimal import Decimal
+import fakeredis
+import pytest
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+import redis
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from app.celery import app as celery_app
+from app.common.timing import StageTimer
+from app.tenancy.models import Tenant, Membership
+from app.accounts.models import User
+from app.connections.limiter import ConnectionLimiter
+from app.connections.models import Connection
+from app.nlq.services.validator import SQLValidator
+from app.schema_registry.models import SchemaCache
+from .cache import ResultCache, result_cache_key
+from .export import ExportTooLarge, copy_csv_chunks, copy_statement, stream_source_export
+from .handoff import FirstPageHandoff
+from .local import LOCAL_TABLE, LocalResultCache, local_columns, run_local_query
+from .cost import ADMIT, LOW_PRIORITY, REJECT, WARN, CostEstimate, assess_cost, decide
+from .cancellation import cancel_backend, is_cancel_requested, request_cancel, sqlite_interrupt_handler
+from .models import QueryHistory
+from .results import ResultWriter, delete_result_file, evict_results, read_result_page
+from .tasks import _fetch_result, execute_query_task, run_query
+from .timeouts import DeadlineExceeded, is_timeout_error, statement_timeout
+
+pytestmark = pytest.mark.django_db
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    """Replaces the shared Redis client with an in-memory one."""
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr('app.common.redis._client', client)
+    return client
+
+@pytest.fixture
+def result_store(settings, tmp_path):
+    """Points the result store at a temporary directory."""
+    settings.RESULT_STORE_URI = ''
+    settings.RESULT_STORE_ROOT = str(tmp_path / "results")
+    settings.RESULT_CACHE_ENABLED = False
+    return Path(settings.RESULT_STORE_ROOT)
+
+@pytest.fixture
+def source_db(tmp_path):
+    """A small SQLite source database with a table of 10 rows."""
+    path = tmp_path / "source.db"
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE orders (id INTEGER PRIMARY KEY, amount NUMERIC, note TEXT)"))
+        for i in range(10):
+            connection.execute(text("INSERT INTO orders VALUES (:id, :amount, :note)"), {'id': i, 'amount': i * 1.5, 'note': f"order {i}"})
+    engine.dispose()
+    return path
+
+@pytest.fixture
+def history_factory(source_db):
+    tenant = Tenant.objects.create(name="Test Tenant")
+    user = User.objects.create_user(username="testuser")
+    connection = Connection.objects.create(tenant=tenant, name="Source", driver="sqlite", database=str(source_db))
+
+    def create(sql="SELECT * FROM orders", **kwargs):
+        return QueryHistory.objects.create(
+            tenant=tenant, connection=connection, user=user, prompt="orders", generated_sql=sql, **kwargs
+        )
+    return create
+
+def test_result_writer_writes_one_batch_per_chunk(result_store):
+    with ResultWriter("1/1.arrow", ['id', 'note']) as writer:
+        writer.write_chunk([(1, 'a'), (2, None)])
+        writer.write_chunk([(3, 'c')])
+
+    reader = ipc.open_file(str(result_store / "1" / "1.arrow"))
+    assert reader.num_record_batches == 2
+    assert reader.read_all().column('id').to_pylist() == [1, 2, 3]
+    assert writer.row_count == 3
+    assert writer.byte_size == (result_store / "1" / "1.arrow").stat().st_size
+    assert writer.describe_schema() == [{'name': 'id', 'type': 'int64'}, {'name': 'note', 'type': 'string'}]
+
+def test_result_writer_falls_back_to_strings_for_mixed_columns(result_store):
+    with ResultWriter("1/2.arrow", ['value']) as writer:
+        writer.write_chunk([(None,), (None,)])
+        writer.write_chunk([(1,), ('two',)])
+
+    table = ipc.open_file(str(result_store / "1" / "2.arrow")).read_all()
+    assert table.column('value').to_pylist() == [None, None, '1', 'two']
+
+def test_result_writer_widens_columns_that_outgrow_the_first_chunk(result_store):
+    """
+    Later chunks with more decimal digits, floats after integers or mixed values widen the stored column.
+    """
+    with ResultWriter("1/4.arrow", ['amount', 'n', 'mixed']) as writer:
+        writer.write_chunk([(Decimal('1.50'), 1, 1), (Decimal('2.25'), 2, 2)])
+        writer.write_chunk([(Decimal('12345.678'), 2.5, 3)])
+        writer.write_chunk([(Decimal('-0.0001'), 4, 'four')])
+
+    reader = ipc.open_file(str(result_store / "1" / "4.arrow"))
+    assert reader.num_record_batches == 3 and writer.batch_rows == [2, 1, 1]
+    table = reader.read_all()
+    assert table.schema.field('amount').type == pa.decimal128(9, 4)
+    assert table.column('amount').to_pylist() == [Decimal('1.5'), Decimal('2.25'), Decimal('12345.678'), Decimal('-0.0001')]
+    assert table.column('n').to_pylist() == [1.0, 2.0, 2.5, 4.0]
+    assert table.column('mixed').to_pylist() == ['1', '2', '3', 'four']
+    assert writer.describe_schema()[1] == {'name': 'n', 'type': 'double'}
+    assert not list(result_store.rglob('*.narrow'))
+
+def test_result_writer_removes_partial_file_on_error(result_store):
+    with pytest.raises(RuntimeError):
+        with ResultWriter("1/3.arrow", ['id']) as writer:
+            writer.write_chunk([(1,)])
+            raise RuntimeError("connection lost")
+    assert not (result_store / "1" / "3.arrow").exists()
+
+@patch('app.queries.tasks.settings.RESULT_FETCH_CHUNK_ROWS', 4)
+def test_execute_query_task_stores_result(result_store, history_factory):
+    """
+    The task streams the result in chunks into the store and records a reference on the history row.
+    """
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+
+    assert history.status == QueryHistory.Status.OK
+    assert history.row_count == 10
+    assert history.result_path == f"{history.tenant_id}/{history.id}.arrow"
+    assert history.result_bytes == (result_store / history.result_path).stat().st_size
+    assert [column['name'] for column in history.result_schema] == ['id', 'amount', 'note']
+    assert ipc.open_file(str(result_store / history.result_path)).num_record_batches == 3
+
+def test_execute_query_task_records_stage_timings(result_store, history_factory):
+    """
+    The worker adds its stages to the timings the API recorded and sets duration_ms.
+    """
+    history = history_factory()
+    QueryHistory.objects.filter(id=history.id).update(
+        timings={'llm_call': 812.5}, created_at=timezone.now() - datetime.timedelta(seconds=2)
+    )
+    execute_query_task(history.id)
+    history.refresh_from_db()
+
+    assert history.timings['llm_call'] == 812.5
+    assert history.timings['queue_wait'] >= 2000
+    assert {'validate', 'execute', 'fetch', 'serialize'} <= set(history.timings)
+    assert history.duration_ms is not None
+    assert history.duration_ms >= history.timings['execute'] + history.timings['fetch'] - 1
+
+@pytest.mark.django_db(transaction=True)
+@patch('app.queries.tasks.settings.RESULT_FETCH_CHUNK_ROWS', 4)
+def test_async_worker_executes_query_like_the_task(result_store, history_factory):
+    """
+    The asyncio worker runs the same execution on aiosqlite, with the same caps and timings.
+    """
+    pytest.importorskip('greenlet')
+    pytest.importorskip('aiosqlite')
+    from .async_worker import execute_query
+
+    history = history_factory()
+    assert asyncio.run(execute_query(history.id)).endswith("status OK")
+    history.refresh_from_db()
+
+    assert history.row_count == 10
+    assert history.result_batch_rows == [4, 4, 2]
+    assert read_result_page(history, offset=8, limit=2)[1] == [[8, 12.0, 'order 8'], [9, 13.5, 'order 9']]
+    assert {'queue_wait', 'execute', 'fetch', 'serialize'} <= set(history.timings)
+
+def test_async_worker_runs_ready_messages_while_delayed_ones_wait():
+    """
+    A message waiting out its countdown raises the prefetch count instead of holding one of the worker's slots.
+    """
+    pytest.importorskip('greenlet')
+    from .async_worker import AsyncExecutionWorker
+
+    started = []
+
+    async def fake_execute(history_id, queue=None):
+        started.append(history_id)
+        return f"done {history_id}"
+
+    worker = AsyncExecutionWorker(concurrency=1, threads=1)
+    worker._consumer = MagicMock()
+    loop_thread = threading.Thread(target=worker.loop.run_forever, daemon=True)
+    loop_thread.start()
+    eta = (timezone.now() + datetime.timedelta(seconds=0.3)).isoformat()
+    try:
+        with patch('app.queries.async_worker.execute_query', side_effect=fake_execute):
+            delayed = MagicMock(headers={'task': execute_query_task.name, 'eta': eta})
+            ready = MagicMock(headers={'task': execute_query_task.name})
+            worker._on_message([[1], {}, {}], delayed)
+            worker._consumer.qos.assert_called_with(prefetch_count=2)
+            worker._on_message([[2], {}, {}], ready)
+            while worker._in_flight:
+                worker._ack_finished(timeout=0.05)
+    finally:
+        worker.loop.call_soon_threadsafe(worker.loop.stop)
+        loop_thread.join()
+        worker.loop.close()
+
+    assert started == [2, 1]
+    delayed.ack.assert_called_once()
+    ready.ack.assert_called_once()
+    worker._consumer.qos.assert_called_with(prefetch_count=1)
+
+def test_execute_query_task_runs_previews_on_samples(settings, result_store, history_factory):
+    """
+    Previews read a bounded scan of each table on SQLite and are reported as approximate.
+    """
+    settings.PREVIEW_SCAN_ROWS = 3
+    history = history_factory(sql="SELECT o.id FROM orders AS o WHERE o.amount >= 3", preview=True)
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.OK
+    assert history.row_count == 1
+    assert read_result_page(history, offset=0, limit=10)[1] == [[2]]
+
+    Membership.objects.create(user=history.user, tenant=history.tenant)
+    client = APIClient()
+    client.force_login(history.user)
+    client.credentials(HTTP_X_TENANT_ID=history.tenant.id)
+    response = client.get(reverse('query-results', kwargs={'history_id': history.id}))
+    assert response.data['approximate'] is True
+
+@pytest.fixture
+def local_cache(monkeypatch):
+    """A fresh local engine cache for each test."""
+    cache = LocalResultCache(max_bytes=64 * 1024 ** 2)
+    monkeypatch.setattr('app.queries.local.cache', cache)
+    return cache
+
+def test_run_local_query_refines_stored_result(result_store, history_factory, local_cache):
+    """
+    A follow-up runs on the stored result in SQLite, loading it once, and stores its own result.
+    """
+    base = history_factory(sql="SELECT o.id, o.amount, p.id FROM orders AS o JOIN orders AS p ON p.id = o.id")
+    execute_query_task(base.id)
+    base.refresh_from_db()
+    assert local_columns(base) == [('id', 'INTEGER'), ('amount', 'REAL'), ('id_2', 'INTEGER')]
+
+    limits = {'max_rows': 100, 'max_bytes': 10 ** 6, 'timeout_ms': 5000}
+    pages, timers = [], []
+    for sql in (
+        f"SELECT id FROM {LOCAL_TABLE} WHERE amount >= 9 ORDER BY id DESC",
+        f"SELECT count(*) AS n FROM {LOCAL_TABLE} WHERE id_2 < 3",
+    ):
+        follow_up = history_factory(sql=sql, follow_up_of=base, status=QueryHistory.Status.PENDING)
+        timers.append(StageTimer())
+        run_local_query(base, follow_up, sql, limits, timers[-1])
+        assert follow_up.status == QueryHistory.Status.OK
+        pages.append(read_result_page(follow_up, offset=0, limit=10))
+
+    assert pages == [(['id'], [[9], [8], [7], [6]]), (['n'], [[3]])]
+    assert 'local_load' in timers[0].stages and 'local_load' not in timers[1].stages
+    assert base.result_path in local_cache
+
+def test_run_local_query_uses_local_timeout(settings, result_store, history_factory, local_cache):
+    settings.LOCAL_QUERY_TIMEOUT_MS = 50
+    base = history_factory()
+    execute_query_task(base.id)
+    base.refresh_from_db()
+
+    sql = "WITH RECURSIVE n AS (SELECT 1 AS i UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    follow_up = history_factory(sql=sql, follow_up_of=base, status=QueryHistory.Status.PENDING)
+    run_local_query(base, follow_up, sql, {'max_rows': 100, 'max_bytes': 10 ** 6, 'timeout_ms': 30000}, StageTimer())
+    assert follow_up.status == QueryHistory.Status.TIMEOUT
+    assert follow_up.error_text == "Query exceeded the 50 ms timeout."
+
+@patch('app.queries.tasks.execute_query_task.apply_async')
+@patch('app.nlq.services.orchestrator.LLMOrchestrator.generate_sql')
+def test_nlq_follow_up_refines_previous_result_locally(mock_generate_sql, mock_apply_async, result_store, history_factory, local_cache):
+    """
+    A follow-up prompt returns its outcome inline from the local engine, without enqueuing anything.
+    """
+    base = history_factory(preview=True)
+    execute_query_task(base.id)
+    base.refresh_from_db()
+    Membership.objects.create(user=base.user, tenant=base.tenant)
+    client = APIClient()
+    client.force_login(base.user)
+    client.credentials(HTTP_X_TENANT_ID=base.tenant.id)
+    mock_generate_sql.return_value = f"SELECT note FROM {LOCAL_TABLE} WHERE id = 3"
+
+    data = {'prompt': 'Just order 3', 'connection_id': base.connection_id, 'follow_up_of': base.id}
+    response = client.post(reverse('nlq'), data, format='json')
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data['first_page']['rows'] == [['order 3']]
+    assert response.data['approximate'] is True
+    history = QueryHistory.objects.get(id=response.data['history_id'])
+    assert history.follow_up_of == base
+    assert {'local_load', 'validate', 'execute'} <= set(history.timings)
+    mock_apply_async.assert_not_called()
+
+    delete_result_file(base.result_path)
+    local_cache._entries.clear()
+    response = client.post(reverse('nlq'), data, format='json')
+    assert response.status_code == status.HTTP_410_GONE
+
+def test_local_result_cache_evicts_least_recently_used(result_store, history_factory):
+    """
+    Loaded results beyond the byte budget are closed, least recently used first.
+    """
+    histories = [history_factory(sql=f"SELECT id, {i} AS n FROM orders") for i in range(3)]
+    for history in histories:
+        execute_query_task(history.id)
+        history.refresh_from_db()
+
+    cache = LocalResultCache(max_bytes=1)
+    with cache.connect(histories[0]):
+        pass
+    with cache.connect(histories[1]) as connection:
+        assert connection.execute(f"SELECT sum(n) FROM {LOCAL_TABLE}").fetchone() == (10,)
+    assert histories[0].result_path not in cache
+    with cache.connect(histories[2]):
+        pass
+    assert len(cache) == 1 and histories[2].result_path in cache
+
+def test_execute_query_task_applies_plan_limits(settings, result_store, history_factory):
+    """
+    The row cap is injected into the SQL and the byte cap stops fetching early.
+    """
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 6, 'max_bytes': 1}}
+    settings.RESULT_FETCH_CHUNK_ROWS = 2
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.OK
+    assert history.row_count == 2
+    assert history.truncated and history.truncated_reason == QueryHistory.TruncatedReason.BYTE_LIMIT
+
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 6}}
+    history = history_factory(sql="SELECT id AS limit_amount FROM orders")
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.row_count == 6
+    assert history.truncated and history.truncated_reason == QueryHistory.TruncatedReason.ROW_LIMIT
+
+    # A result exactly as long as the cap is complete
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 10}}
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.row_count == 10
+    assert not history.truncated and history.truncated_reason == ''
+
+def test_evict_results_by_ttl_and_size(settings, result_store, history_factory):
+    settings.RESULT_STORE_TTL_SEC = 3600
+    old, recent, newest = (history_factory() for _ in range(3))
+    for history in (old, recent, newest):
+        execute_query_task(history.id)
+    QueryHistory.objects.filter(id=old.id).update(created_at=timezone.now() - datetime.timedelta(hours=2))
+    QueryHistory.objects.filter(id=recent.id).update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+    newest.refresh_from_db()
+    settings.RESULT_STORE_MAX_BYTES = newest.result_bytes
+
+    assert evict_results() == 2
+
+    assert list(QueryHistory.objects.exclude(result_path='').values_list('id', flat=True)) == [newest.id]
+    assert sorted(p.name for p in result_store.rglob('*.arrow')) == [f"{newest.id}.arrow"]
+
+@patch('app.queries.tasks.settings.RESULT_FETCH_CHUNK_ROWS', 4)
+def test_read_result_page_spans_batches(result_store, history_factory):
+    """
+    A page crossing batch boundaries only returns the requested rows and columns.
+    """
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.result_batch_rows == [4, 4, 2]
+
+    columns, rows = read_result_page(history, offset=3, limit=6, columns=['note', 'id'])
+    assert columns == ['id', 'note']
+    assert rows == [[i, f"order {i}"] for i in range(3, 9)]
+
+    assert read_result_page(history, offset=8, limit=100)[1] == [[8, 12.0, 'order 8'], [9, 13.5, 'order 9']]
+    assert read_result_page(history, offset=50, limit=10)[1] == []
+
+def test_query_results_api(result_store, history_factory):
+    history = history_factory()
+    execute_query_task(history.id)
+    Membership.objects.create(user=history.user, tenant=history.tenant)
+
+    client = APIClient()
+    client.force_login(history.user)
+    client.credentials(HTTP_X_TENANT_ID=history.tenant.id)
+    url = reverse('query-results', kwargs={'history_id': history.id})
+
+    response = client.get(url, {'offset': 2, 'limit': 3, 'columns': 'id'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data['total_rows'] == 10
+    assert response.data['columns'] == ['id']
+    assert response.data['rows'] == [[2], [3], [4]]
+
+    response = client.get(url, {'columns': 'missing'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    response = client.get(url, {'limit': 0})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+def test_query_export_api_streams_each_format(settings, result_store, history_factory):
+    settings.RESULT_FETCH_CHUNK_ROWS = 4
+    history = history_factory()
+    execute_query_task(history.id)
+    Membership.objects.create(user=history.user, tenant=history.tenant)
+
+    client = APIClient()
+    client.force_login(history.user)
+    client.credentials(HTTP_X_TENANT_ID=history.tenant.id)
+    url = reverse('query-export', kwargs={'history_id': history.id})
+
+    response = client.get(url, {'format': 'csv', 'columns': 'id,note'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Content-Disposition'] == f'attachment; filename="query-{history.id}.csv"'
+    # One chunk per stored batch of 4 rows
+    chunks = list(response.streaming_content)
+    assert len(chunks) == 3
+    lines = b''.join(chunks).decode().splitlines()
+    assert lines[0] == '"id","note"'
+    assert lines[1:3] == ['0,"order 0"', '1,"order 1"']
+    assert len(lines) == 11
+
+    response = client.get(url, {'format': 'ndjson', 'compression': 'gzip'})
+    assert response['Content-Type'] == 'application/gzip'
+    rows = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+    assert rows[9] == {'id': 9, 'amount': 13.5, 'note': 'order 9'}
+
+    response = client.get(url, {'format': 'parquet'})
+    table = pq.read_table(io.BytesIO(b''.join(response.streaming_content)))
+    assert table.num_rows == 10
+    assert table.column('note').to_pylist()[0] == 'order 0'
+
+    response = client.get(url, {'format': 'xlsx'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+def test_query_export_api_reruns_evicted_result_on_source(result_store, history_factory):
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    delete_result_file(history.result_path)
+    Membership.objects.create(user=history.user, tenant=history.tenant)
+
+    client = APIClient()
+    client.force_login(history.user)
+    client.credentials(HTTP_X_TENANT_ID=history.tenant.id)
+    response = client.get(reverse('query-export', kwargs={'history_id': history.id}), {'format': 'csv', 'columns': 'note'})
+
+    assert response.status_code == status.HTTP_200_OK
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert lines[0] == '"note"' and len(lines) == 11
+    # The connection slot is released once the stream is consumed
+    assert ConnectionLimiter(history.connection).in_flight() == 0
+
+def test_query_export_api_signals_truncated_results(settings, result_store, history_factory):
+    """
+    Truncated results are exported with their reason in a header, also when re-run; re-runs over the byte cap fail.
+    """
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 4}}
+    truncated, complete = history_factory(), history_factory(sql="SELECT id FROM orders")
+    execute_query_task(truncated.id)
+    truncated.refresh_from_db()
+    Membership.objects.create(user=truncated.user, tenant=truncated.tenant)
+
+    client = APIClient()
+    client.force_login(truncated.user)
+    client.credentials(HTTP_X_TENANT_ID=truncated.tenant.id)
+    url = reverse('query-export', kwargs={'history_id': truncated.id})
+
+    response = client.get(url, {'format': 'csv'})
+    assert response['X-Result-Truncated'] == QueryHistory.TruncatedReason.ROW_LIMIT
+    assert len(b''.join(response.streaming_content).decode().splitlines()) == 5
+
+    # The re-run reproduces the stored rows, whatever the plan's limits are now
+    delete_result_file(truncated.result_path)
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 100, 'max_bytes': 1}}
+    response = client.get(url, {'format': 'csv'})
+    assert response['X-Result-Truncated'] == QueryHistory.TruncatedReason.ROW_LIMIT
+    assert len(b''.join(response.streaming_content).decode().splitlines()) == 5
+
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 100}}
+    execute_query_task(complete.id)
+    complete.refresh_from_db()
+    delete_result_file(complete.result_path)
+    settings.TENANT_PLAN_LIMITS = {'free': {'max_rows': 100, 'max_bytes': 1}}
+    response = client.get(reverse('query-export', kwargs={'history_id': complete.id}), {'format': 'csv'})
+    assert response.status_code == status.HTTP_200_OK and not response.has_header('X-Result-Truncated')
+    with pytest.raises(ExportTooLarge):
+        b''.join(response.streaming_content)
+    assert ConnectionLimiter(complete.connection).in_flight() == 0
+
+def test_copy_statement_wraps_validated_query():
+    assert copy_statement("SELECT id, note FROM orders LIMIT 10") == (
+        "COPY (SELECT id, note FROM orders LIMIT 10) TO STDOUT WITH (FORMAT csv, HEADER)"
+    )
+    assert copy_statement("SELECT * FROM orders", columns=['note']) == (
+        'COPY (SELECT "note" FROM (SELECT * FROM orders) AS export) TO STDOUT WITH (FORMAT csv, HEADER)'
+    )
+
+def test_copy_csv_chunks_coalesces_rows_and_honours_byte_cap():
+    rows = [f"{i},order {i}\n".encode() for i in range(100)]
+    connection = MagicMock()
+    copy = connection.connection.dbapi_connection.cursor.return_value.copy
+    copy.return_value.__enter__.return_value = iter(rows)
+
+    chunks = list(copy_csv_chunks(connection, "COPY (SELECT 1) TO STDOUT", chunk_bytes=100))
+    assert b''.join(chunks) == b''.join(rows)
+    assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+    connection.connection.dbapi_connection.cursor.return_value.close.assert_called_once()
+
+    # Outgrowing the byte cap fails the stream instead of cutting it short
+    copy.return_value.__enter__.return_value = iter(rows)
+    chunks = []
+    with pytest.raises(ExportTooLarge):
+        for chunk in copy_csv_chunks(connection, "COPY (SELECT 1) TO STDOUT", max_bytes=250, chunk_bytes=100):
+            chunks.append(chunk)
+    assert 0 < sum(map(len, chunks)) <= 250
+
+@patch('app.queries.export.get_engine')
+def test_copy_exports_run_under_the_export_timeout(mock_get_engine, settings, history_factory):
+    """
+    A COPY lasts as long as the download, so it gets the export timeout instead of the plan's query timeout.
+    """
+    connection = mock_get_engine.return_value.connect.return_value.__enter__.return_value
+    connection.connection.dbapi_connection.cursor.return_value.copy.return_value.__enter__.return_value = iter([b'id\n'])
+    history = history_factory()
+    history.connection.driver = 'postgres'
+    settings.EXPORT_TIMEOUT_MS = 3_600_000
+
+    chunks = stream_source_export(history, "SELECT id FROM orders", {'timeout_ms': 30_000, 'max_bytes': 100}, 'csv')
+    assert b''.join(chunks) == b'id\n'
+    assert [str(call.args[0]) for call in connection.execute.call_args_list] == [
+        "SET LOCAL statement_timeout = 3600000"
+    ]
+
+def test_execute_query_task_hands_off_first_page(settings, result_store, history_factory):
+    """
+    The first page is published as soon as it is fetched; small or failed
+    executions publish their complete outcome instead.
+    """
+    settings.FIRST_PAGE_ROWS = 3
+    settings.RESULT_FETCH_CHUNK_ROWS = 2
+    history = history_factory()
+    execute_query_task(history.id, first_page=True)
+    page = FirstPageHandoff(history.id).wait(100)
+    assert page == {'complete': False, 'columns': ['id', 'amount', 'note'], 'rows': [
+        [0, 0, 'order 0'], [1, 1.5, 'order 1'], [2, 3, 'order 2'],
+    ]}
+
+    history = history_factory(sql="SELECT id FROM orders WHERE id < 2")
+    execute_query_task(history.id, first_page=True)
+    page = FirstPageHandoff(history.id).wait(100)
+    assert page['complete'] and page['status'] == QueryHistory.Status.OK
+    assert page['rows'] == [[0], [1]] and page['row_count'] == 2
+
+    history = history_factory(sql="DELETE FROM orders")
+    execute_query_task(history.id, first_page=True)
+    page = FirstPageHandoff(history.id).wait(100)
+    assert page['complete'] and page['status'] == QueryHistory.Status.ERROR
+
+    # Nothing is published unless the API asked for it
+    history = history_factory()
+    execute_query_task(history.id)
+    assert FirstPageHandoff(history.id).wait(10) is None
+
+@pytest.fixture
+def result_cache(settings, result_store):
+    settings.RESULT_CACHE_ENABLED = True
+
+def test_result_cache_serves_repeated_query(result_store, history_factory, result_cache):
+    """
+    A re-run of the same (normalized) SQL re-uses the stored result instead of querying the source.
+    """
+    first = history_factory(sql="SELECT id, note FROM orders")
+    execute_query_task(first.id)
+    first.refresh_from_db()
+    assert not first.cache_hit
+
+    second = history_factory(sql="select id,  note from ORDERS")
+    with patch('app.queries.tasks.get_engine') as mock_get_engine:
+        execute_query_task(second.id)
+    mock_get_engine.assert_not_called()
+
+    second.refresh_from_db()
+    assert second.cache_hit
+    assert second.status == QueryHistory.Status.OK
+    assert second.result_path == first.result_path
+    assert second.row_count == 10
+
+    # Deleting the original entry keeps the shared file for the cache hit
+    first.delete()
+    assert (result_store / second.result_path).exists()
+
+def test_result_cache_keys_keep_mysql_table_case():
+    """
+    MySQL table names are case-sensitive, so `users` and `Users` never share a cached result or an execution.
+    """
+    limits = {'max_rows': 100, 'max_bytes': 10 ** 6}
+    keys = {
+        result_cache_key(1, SQLValidator(sql, dialect='mysql').normalized_sql(), 'schema', limits)
+        for sql in ("SELECT * FROM users", "SELECT * FROM Users")
+    }
+    assert len(keys) == 2
+
+def test_result_cache_respects_connection_opt_out(result_store, history_factory, result_cache):
+    first = history_factory()
+    first.connection.options_json = {'result_cache': False}
+    first.connection.save()
+    execute_query_task(first.id)
+
+    second = history_factory()
+    execute_query_task(second.id)
+    second.refresh_from_db()
+    assert not second.cache_hit
+    assert second.result_path != first.result_path
+
+def test_result_cache_evicts_least_recently_used(settings, result_store, history_factory, result_cache):
+    for history in (history_factory(), history_factory()):
+        execute_query_task(history.id)
+    history.refresh_from_db()
+    settings.RESULT_CACHE_MAX_BYTES = history.result_bytes
+
+    cache = ResultCache()
+    cache.put('a', history)
+    cache.put('b', history)
+    assert cache.get('a') is None
+    assert cache.get('b')['history_id'] == history.id
+
+def test_result_cache_lookup_treats_redis_errors_as_misses(result_store, history_factory, result_cache):
+    history = history_factory()
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    cache = ResultCache()
+    cache.put('a', history)
+
+    with patch.object(cache.client, 'zadd', side_effect=redis.ConnectionError):
+        assert cache.get('a') is None
+
+def test_single_flight_completes_attached_executions(result_store, history_factory):
+    """
+    While a leader runs, identical executions attach to it and are completed from its result.
+    """
+    leader, follower = history_factory(), history_factory(sql="select * from orders")
+
+    def run_with_concurrent_follower(*args):
+        with patch('app.queries.tasks.execute_query_task.apply_async') as mock_recheck:
+            assert "attached" in execute_query_task(follower.id)
+        mock_recheck.assert_called_once()
+        run_query(*args)
+
+    with patch('app.queries.tasks.run_query', side_effect=run_with_concurrent_follower):
+        execute_query_task(leader.id)
+
+    leader.refresh_from_db()
+    follower.refresh_from_db()
+    assert follower.status == QueryHistory.Status.OK
+    assert follower.result_path == leader.result_path
+    assert follower.row_count == 10
+
+    # The follower's delayed recheck is a no-op
+    assert "already finished" in execute_query_task(follower.id)
+
+def test_single_flight_late_attacher_is_not_reported_cancelled(result_store, history_factory):
+    """
+    An execution that attaches just after a cancelled leader finished fails instead of reading as cancelled.
+    """
+    leader, late = history_factory(), history_factory()
+
+    def cancel_and_run(query_history, *args):
+        request_cancel(query_history.id)
+        run_query(query_history, *args)
+
+    with patch('app.queries.tasks.run_query', side_effect=cancel_and_run):
+        execute_query_task(leader.id)
+    # It lost the race for the lead, then found the leader's published outcome
+    with patch('app.queries.tasks.SingleFlight.lead', return_value=False):
+        assert "(shared)" in execute_query_task(late.id)
+
+    leader.refresh_from_db()
+    late.refresh_from_db()
+    assert leader.status == QueryHistory.Status.CANCELLED
+    assert late.status == QueryHistory.Status.ERROR
+    assert late.error_text == "The shared execution was cancelled."
+
+def test_execute_query_task_queues_then_rejects_over_connection_limit(settings, result_store, history_factory):
+    """
+    Executions over the connection's concurrency limit are requeued, and fail
+    with a retry hint once they have waited too long.
+    """
+    history = history_factory()
+    connection = history.connection
+    connection.options_json = {'max_concurrency': 1}
+    connection.save()
+    assert ConnectionLimiter(connection).acquire('running', ttl=30)
+
+    with patch('app.queries.tasks.execute_query_task.apply_async') as mock_retry:
+        assert "queued" in execute_query_task(history.id)
+    mock_retry.assert_called_once_with(
+        (history.id,), countdown=settings.SOURCE_ADMISSION_RETRY_SEC, queue=None, priority=settings.QUERY_PRIORITY_RETRY
+    )
+    assert ConnectionLimiter(connection).queue_length() == 1
+
+    settings.SOURCE_ADMISSION_MAX_WAIT_SEC = 0
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.ERROR
+    assert "busy" in history.error_text
+    assert ConnectionLimiter(connection).queue_length() == 0
+
+    # The slot is free again once the running query finishes
+    ConnectionLimiter(connection).release('running')
+    retried = history_factory()
+    execute_query_task(retried.id)
+    retried.refresh_from_db()
+    assert retried.status == QueryHistory.Status.OK
+    assert ConnectionLimiter(connection).in_flight() == 0
+
+def test_execution_leases_follow_the_plan_timeout(settings, result_store, history_factory):
+    """
+    The connection slot and single-flight lead last for the plan's timeout, and are renewed while fetching.
+    """
+    settings.TENANT_PLAN_LIMITS = {'free': {'timeout_ms': 600000}}
+    settings.SINGLE_FLIGHT_GRACE_SEC = 30
+    history = history_factory()
+    limiter = ConnectionLimiter(history.connection)
+
+    def run_and_check_lease(query_history, sql, limits, timer, handoff, lease):
+        assert lease.ttl == 630
+        assert limiter.retry_after() > 600
+        lease.renew()
+        assert limiter.retry_after() > 625
+        run_query(query_history, sql, limits, timer, handoff, lease)
+
+    with patch('app.queries.tasks.run_query', side_effect=run_and_check_lease) as mock_run:
+        execute_query_task(history.id)
+    mock_run.assert_called_once()
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.OK
+    assert limiter.in_flight() == 0
+
+def test_cancel_api_marks_pending_query_cancelled(result_store, history_factory):
+    history = history_factory()
+    Membership.objects.create(user=history.user, tenant=history.tenant)
+    client = APIClient()
+    client.force_login(history.user)
+    client.credentials(HTTP_X_TENANT_ID=history.tenant.id)
+    url = reverse('query-cancel', kwargs={'history_id': history.id})
+
+    response = client.post(url)
+    assert response.status_code == status.HTTP_200_OK
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.CANCELLED
+    assert is_cancel_requested(history.id)
+
+    # The queued task no longer runs, and a second cancel is rejected
+    assert "already finished" in execute_query_task(history.id)
+    assert client.post(url).status_code == status.HTTP_409_CONFLICT
+
+@patch('app.queries.cancellation.get_engine')
+def test_cancel_api_kills_only_a_recorded_session(mock_get_engine, result_store, history_factory):
+    running = history_factory()
+    running.connection.driver = 'postgres'
+    running.connection.save()
+    QueryHistory.objects.filter(id=running.id).update(backend_pid='123')
+    released = history_factory()
+    Membership.objects.create(user=running.user, tenant=running.tenant)
+    client = APIClient()
+    client.force_login(running.user)
+    client.credentials(HTTP_X_TENANT_ID=running.tenant.id)
+    executed = mock_get_engine.return_value.execution_options.return_value.connect.return_value.__enter__.return_value.execute
+
+    client.post(reverse('query-cancel', kwargs={'history_id': running.id}))
+    assert str(executed.call_args.args[0]) == "SELECT pg_cancel_backend(123)"
+
+    # Once the worker has released its session there is nothing on the source to kill
+    client.post(reverse('query-cancel', kwargs={'history_id': released.id}))
+    assert executed.call_count == 1
+
+@patch('app.queries.tasks.get_backend_pid', return_value='123')
+def test_backend_pid_is_cleared_before_the_connection_is_released(mock_get_backend_pid, result_store, history_factory):
+    history = history_factory()
+    recorded = []
+
+    def fetch_and_check(*args):
+        recorded.append(QueryHistory.objects.get(id=history.id).backend_pid)
+        return _fetch_result(*args)
+
+    with patch('app.queries.tasks._fetch_result', side_effect=fetch_and_check):
+        execute_query_task(history.id)
+    history.refresh_from_db()
+    assert recorded == ['123']
+    assert history.status == QueryHistory.Status.OK
+    assert history.backend_pid == ''
+
+def test_sqlite_interrupt_handler_interrupts_running_statement(source_db):
+    engine = create_engine(f"sqlite:///{source_db}")
+    request_cancel(42)
+    slow_sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    with engine.connect() as connection:
+        with sqlite_interrupt_handler(connection, 42):
+            with pytest.raises(OperationalError, match="interrupted"):
+                connection.execute(text(slow_sql)).scalar()
+        # The handler is removed before the connection goes back to the pool
+        assert connection.execute(text("SELECT count(*) FROM orders")).scalar() == 10
+
+@patch('app.queries.cancellation.get_engine')
+def test_cancel_backend_issues_driver_specific_kill(mock_get_engine, history_factory):
+    connection_obj = history_factory().connection
+    executed = mock_get_engine.return_value.execution_options.return_value.connect.return_value.__enter__.return_value.execute
+
+    for driver, expected in [('postgres', "SELECT pg_cancel_backend(123)"), ('mysql', "KILL QUERY 123"), ('mssql', "KILL 123")]:
+        connection_obj.driver = driver
+        cancel_backend(connection_obj, '123')
+        assert str(executed.call_args.args[0]) == expected
+
+def test_execute_query_task_records_sqlite_timeout(settings, result_store, history_factory):
+    settings.TENANT_PLAN_LIMITS = {'free': {'timeout_ms': 50}}
+    history = history_factory(
+        sql="WITH RECURSIVE n AS (SELECT 1 AS i UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    )
+    execute_query_task(history.id)
+    history.refresh_from_db()
+    assert history.status == QueryHistory.Status.TIMEOUT
+    assert history.error_text == "Query exceeded the 50 ms timeout."
+    assert not list(result_store.rglob('*.arrow'))
+
+def test_execute_query_task_keeps_rows_fetched_before_timeout(settings, result_store, history_factory):
+    settings.TENANT_PLAN_LIMITS = {'free': {'timeout_ms': 200, 'max_rows': 10 ** 9, 'max_bytes': 10 ** 12}}
+    settings.RESULT_FETCH_CHUNK_ROWS = 1000
+    history = history_factory(
+        sql="WITH RECURSIVE n AS (SELECT 1 AS i UNION ALL SELECT i + 1 FROM n) SELECT i FROM n"
+    )
+    execute_query_task(history.id)
+    history.refresh_from_db()
+
+    assert history.status == QueryHistory.Status.TIMEOUT
+    assert history.truncated and history.truncated_reason == QueryHistory.TruncatedReason.TIMEOUT
+    assert history.row_count >= 1000
+    assert history.error_text == f"Query exceeded the 200 ms timeout. Returning the {history.row_count} rows fetched before it."
+    columns, rows = read_result_page(history, offset=0, limit=3)
+    assert columns == ['i'] and rows == [[1], [2], [3]]
+
+def test_fetch_result_stops_at_the_overall_deadline(result_store):
+    """
+    Each fetch from a server-side cursor is bounded on its own, so the deadline is checked between chunks.
+    """
+    class SlowResult:
+        def partitions(self, size):
+            yield [(1,)]
+            time.sleep(0.1)
+            yield [(2,)]
+            yield [(3,)]
+
+    limits = {'max_rows': 100, 'max_bytes': 10 ** 6}
+    with ResultWriter("1/deadline.arrow", ['i']) as writer:
+        with pytest.raises(DeadlineExceeded):
+            _fetch_result(SlowResult(), writer, limits, StageTimer(), deadline=time.monotonic() + 0.05)
+    assert writer.row_count == 2
+
+def test_session_timeouts_are_reset_before_the_connection_is_reused():
+    """
+    MySQL and SQL Server timeouts are set on the session, so they are put back once the query is done.
+    """
+    connection = MagicMock()
+    connection.dialect.is_mariadb = False
+    with statement_timeout(connection, Connection(driver='mysql'), 5000):
+        pass
+    assert [str(call.args[0]) for call in connection.execute.call_args_list] == [
+        "SET SESSION max_execution_time = 5000", "SET SESSION max_execution_time = DEFAULT",
+    ]
+
+    connection = MagicMock()
+    with pytest.raises(OperationalError):
+        with statement_timeout(connection, Connection(driver='mssql'), 5000, '51'):
+            connection.execute.side_effect = OperationalError('KILL', {}, Exception())
+            raise connection.execute.side_effect
+    assert [str(call.args[0]) for call in connection.execute.call_args_list] == [
+        "SET LOCK_TIMEOUT 5000", "SET LOCK_TIMEOUT -1",
+    ]
+    # The reset failed, so the session is discarded instead of pooled
+    connection.invalidate.assert_called_once()
+    assert connection.connection.dbapi_connection.timeout == 0
+
+@patch('app.queries.timeouts.cancel_backend')
+def test_mssql_watchdog_kills_the_session_it_looked_up(mock_cancel_backend):
+    """
+    Callers that don't record a session id (exports, EXPLAIN) still get a watchdog that can kill their statement.
+    """
+    connection = MagicMock()
+    connection.execute.return_value.scalar.return_value = 77
+    connection_obj = Connection(driver='mssql')
+    with patch('app.queries.timeouts.MSSQL_WATCHDOG_GRACE_SEC', 0):
+        with statement_timeout(connection, connection_obj, 10):
+            time.sleep(0.2)
+    assert "SELECT @@SPID" in [str(call.args[0]) for call in connection.execute.call_args_list]
+    mock_cancel_backend.assert_called_once_with(connection_obj, '77')
+
+def test_timeout_errors_recognized_by_driver_code():
+    deadline = time.monotonic() + 60
+
+    class DriverError(Exception):
+        pass
+
+    assert is_timeout_error(DriverError(3024, "maximum statement execution time exceeded"), 'mysql', deadline)
+    assert is_timeout_error(DriverError('HYT00', "Query timeout expired"), 'mssql', deadline)
+    assert not is_timeout_error(DriverError(1146, "Table doesn't exist"), 'mysql', deadline)
+    assert is_timeout_error(DriverError(1146, "Table doesn't exist"), 'mysql', time.monotonic())
+
+
+def test_assess_cost_estimates_sqlite_joins_from_table_stats(history_factory, source_db):
+    """
+    SQLite has no cost model: rows come from ANALYZE statistics, multiplied across a nested-loop join.
+    """
+    history = history_factory()
+    thresholds = {'cost_thresholds': {'warn': {'rows': 50}, 'reject': {'rows': 1000}}}
+
+    # Without statistics the query is admitted unestimated
+    estimate, decision = assess_cost(history.connection, "SELECT * FROM orders", thresholds)
+    assert estimate == CostEstimate() and decision == ADMIT
+
+    engine = create_engine(f"sqlite:///{source_db}")
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    engine.dispose()
+
+    estimate, decision = assess_cost(history.connection, "SELECT * FROM orders LIMIT 5", thresholds)
+    assert estimate.rows == 10 and decision == ADMIT
+
+    estimate, decision = assess_cost(history.connection, "SELECT * FROM orders a, orders b", thresholds)
+    assert estimate.rows == 100 and decision == WARN
+
+def test_assess_cost_falls_back_to_catalog_statistics(history_factory):
+    """
+    Without a planner estimate, the largest table's catalog row count stands in, but never rejects a query.
+    """
+    history = history_factory()
+    thresholds = {'cost_thresholds': {'warn': {'rows': 50}, 'reject': {'rows': 1000}}}
+    SchemaCache.objects.create(
+        connection=history.connection, tenant=history.tenant, payload_json={}, graph_json={}, hash='h',
+        stats_json={'orders': {'rows': 80, 'bytes': 8192, 'analyzed_at': None}, 'customers': {'rows': 5000}},
+    )
+
+    estimate, decision = assess_cost(history.connection, "SELECT * FROM orders LIMIT 5", thresholds)
+    assert estimate.rows == 80 and decision == WARN
+
+    estimate, decision = assess_cost(history.connection, "SELECT * FROM orders JOIN Customers ON 1 = 1", thresholds)
+    assert estimate.rows == 5000 and decision == LOW_PRIORITY
+
+def test_cost_decision_uses_most_severe_threshold():
+    thresholds = {
+        'warn': {'rows': 10},
+        'low_priority': {'rows': 100, 'cost': 5.0},
+        'reject': {'rows': 1000},
+    }
+    assert decide(CostEstimate(rows=5), thresholds) == ADMIT
+    assert decide(CostEstimate(rows=50), thresholds) == WARN
+    assert decide(CostEstimate(rows=50, cost=10.0), thresholds) == LOW_PRIORITY
+    assert decide(CostEstimate(rows=5000, cost=1.0), thresholds) == REJECT
+    assert decide(CostEstimate(), thresholds) == ADMIT
+
+
+def test_tasks_are_routed_to_separate_queues():
+    """
+    Interactive execution, introspection and background work each have their own queue.
+    """
+    router = celery_app.amqp.router
+
+    def queue_of(task_name):
+        return router.route({}, task_name)['queue'].name
+
+    assert queue_of('app.queries.tasks.execute_query_task') == 'interactive'
+    assert queue_of('app.schema_registry.tasks.introspect_connection_task') == 'introspection'
+    assert queue_of('app.queries.tasks.evict_results_task') == 'bulk'
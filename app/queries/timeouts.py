@@ -0,0 +1,119 @@
+"""
+Statement timeout enforcement for every supported driver.
+
+A connect timeout does nothing once a query is running, so each driver gets
+its own server- or client-side deadline:
+
+- Postgres: `SET LOCAL statement_timeout`, scoped to the query's transaction.
+- MySQL: `max_execution_time` (MariaDB: `max_statement_time`) on the session.
+- SQL Server: `SET LOCK_TIMEOUT` and the ODBC query timeout, backed by a
+  watchdog thread that kills the session shortly after the deadline.
+- SQLite: a progress-handler deadline (see app.queries.cancellation).
+
+Session settings are put back to the server default after the query, so they
+don't carry over to whatever uses the pooled connection next (introspection,
+statistics, EXPLAIN); a connection that can't be reset is invalidated.
+
+Those bound each statement, and with a server-side cursor every fetch is a
+statement of its own, so the execution worker also checks the query's
+overall deadline between fetched chunks.
+
+Failures caused by any of these are reported as `QueryHistory.Status.TIMEOUT`.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from .cancellation import cancel_backend, get_backend_pid
+
+# Error codes drivers raise when a statement hits its timeout.
+TIMEOUT_ERROR_CODES = {
+    'postgres': {'57014'},  # query_canceled
+    'mysql': {3024, 1969},  # ER_QUERY_TIMEOUT (MySQL), ER_STATEMENT_TIMEOUT (MariaDB)
+    'mssql': {'HYT00', 'HYT01'},  # ODBC query / connection timeout expired
+}
+
+class DeadlineExceeded(Exception):
+    """Raised in the execution worker when fetching a result runs past the query's deadline."""
+
+
+# Extra time the SQL Server watchdog gives the server-side timeouts before killing the session.
+MSSQL_WATCHDOG_GRACE_SEC = 2
+
+
+@contextmanager
+def statement_timeout(connection, connection_obj, timeout_ms: int, backend_pid: str = ''):
+    """
+    Applies `timeout_ms` to the statements executed on `connection` inside
+    the block. `backend_pid` is the session the SQL Server watchdog kills;
+    it is looked up if the caller hasn't recorded it.
+    """
+    driver = connection_obj.driver
+    watchdog = None
+    timeout_sql = session_timeout_sql(driver, connection.dialect, timeout_ms)
+    if timeout_sql:
+        connection.execute(text(timeout_sql))
+    elif driver == 'mssql':
+        connection.execute(text(f"SET LOCK_TIMEOUT {int(timeout_ms)}"))
+        connection.connection.dbapi_connection.timeout = math.ceil(timeout_ms / 1000)
+        backend_pid = backend_pid or get_backend_pid(connection, driver)
+        watchdog = threading.Timer(
+            timeout_ms / 1000 + MSSQL_WATCHDOG_GRACE_SEC, cancel_backend, (connection_obj, backend_pid)
+        )
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        yield
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+            connection.connection.dbapi_connection.timeout = 0
+        reset_sql = session_timeout_reset_sql(driver, connection.dialect)
+        if reset_sql:
+            try:
+                connection.execute(text(reset_sql))
+            except Exception:
+                # Never return a session with this query's timeout to the pool
+                connection.invalidate()
+
+
+def session_timeout_sql(driver: str, dialect, timeout_ms: int) -> str:
+    """The statement that sets a server-side timeout for Postgres and MySQL, or '' for other drivers."""
+    if driver == 'postgres':
+        return f"SET LOCAL statement_timeout = {int(timeout_ms)}"
+    if driver == 'mysql':
+        # Session variables outlive the query; session_timeout_reset_sql undoes them
+        if dialect.is_mariadb:
+            return f"SET SESSION max_statement_time = {timeout_ms / 1000}"
+        return f"SET SESSION max_execution_time = {int(timeout_ms)}"
+    return ''
+
+
+def session_timeout_reset_sql(driver: str, dialect) -> str:
+    """
+    The statement that puts a session's timeout back to the server default,
+    or '' for drivers whose timeout ends with the query (Postgres's SET LOCAL).
+    """
+    if driver == 'mysql':
+        variable = 'max_statement_time' if dialect.is_mariadb else 'max_execution_time'
+        return f"SET SESSION {variable} = DEFAULT"
+    if driver == 'mssql':
+        return "SET LOCK_TIMEOUT -1"
+    return ''
+
+
+def is_timeout_error(exc: Exception, driver: str, deadline: float) -> bool:
+    """
+    Whether a query failure was caused by its timeout: either the driver
+    reported a timeout, or the statement was interrupted after its deadline.
+    """
+    if time.monotonic() >= deadline:
+        return True
+    orig = getattr(exc, 'orig', exc)
+    code = getattr(orig, 'sqlstate', None)
+    if code is None and getattr(orig, 'args', None):
+        code = orig.args[0]
+    return code in TIMEOUT_ERROR_CODES.get(driver, ())
@@ -0,0 +1,8 @@
+from django.urls import path
+from .views import QueryCancelAPIView, QueryExportAPIView, QueryResultsAPIView
+
+urlpatterns = [
+    path('queries/<int:history_id>/results/', QueryResultsAPIView.as_view(), name='query-results'),
+    path('queries/<int:history_id>/cancel/', QueryCancelAPIView.as_view(), name='query-cancel'),
+    path('queries/<int:history_id>/export/', QueryExportAPIView.as_view(), name='query-export'),
+]
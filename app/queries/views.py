@@ -0,0 +1,228 @@
+import logging
+import math
+import uuid
+from rest_framework.negotiation import BaseContentNegotiation
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status, permissions
+from django.conf import settings
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from .cancellation import cancel_backend, request_cancel
+from .export import ENCODERS, stream_export, stream_source_export
+from .models import QueryHistory
+from .results import iter_result_batches, read_result_page, result_exists
+from .singleflight import lease_seconds
+from app.connections.limiter import ConnectionLimiter, LeaseKeeper
+from app.nlq.services.validator import SQLValidator
+from app.tenancy.plans import get_plan_limits
+
+logger = logging.getLogger(__name__)
+
+class QueryResultsAPIView(APIView):
+    """
+    Serves one page of a stored query result.
+    Query params: `offset`, `limit` and an optional comma-separated `columns` list.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, history_id, *args, **kwargs):
+        try:
+            # Ensure the history entry belongs to the current tenant
+            history = QueryHistory.objects.get(id=history_id, tenant=request.tenant)
+        except QueryHistory.DoesNotExist:
+            return Response({'error': 'Query not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        if not history.result_path:
+            return Response({'error': 'No stored result is available for this query'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            offset = int(request.query_params.get('offset', 0))
+            limit = int(request.query_params.get('limit', settings.REST_FRAMEWORK['PAGE_SIZE']))
+        except ValueError:
+            return Response({'error': 'offset and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if offset < 0 or not 0 < limit <= settings.RESULT_PAGE_MAX_ROWS:
+            return Response(
+                {'error': f'offset must be >= 0 and limit between 1 and {settings.RESULT_PAGE_MAX_ROWS}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        columns = [name for name in request.query_params.get('columns', '').split(',') if name]
+
+        try:
+            column_names, rows = read_result_page(history, offset, limit, columns)
+        except KeyError as e:
+            return Response({'error': f'Unknown columns: {e.args[0]}'}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError:
+            return Response({'error': 'The stored result has expired'}, status=status.HTTP_410_GONE)
+
+        return Response({
+            'history_id': history.id,
+            'offset': offset,
+            'limit': limit,
+            'total_rows': history.row_count,
+            'truncated': history.truncated,
+            'truncated_reason': history.truncated_reason,
+            'approximate': history.preview,
+            'columns': column_names,
+            'rows': rows,
+        })
+
+
+class QueryCancelAPIView(APIView):
+    """
+    Cancels a pending or running query, killing its statement on the source database.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, history_id, *args, **kwargs):
+        try:
+            # Ensure the history entry belongs to the current tenant
+            history = QueryHistory.objects.select_related('connection').get(id=history_id, tenant=request.tenant)
+        except QueryHistory.DoesNotExist:
+            return Response({'error': 'Query not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        if history.status != QueryHistory.Status.PENDING:
+            return Response(
+                {'error': f'Query has already finished with status {history.status}'},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        # Flag the cancel first: a worker that hasn't reached the source yet
+        # (or runs on SQLite) checks the flag and stops by itself.
+        request_cancel(history.id)
+        response = {'status': 'ok', 'message': 'Query cancelled', 'history_id': history.id}
+        with transaction.atomic():
+            cancelled = QueryHistory.objects.filter(id=history.id, status=QueryHistory.Status.PENDING).update(
+                status=QueryHistory.Status.CANCELLED, error_text="Cancelled by user."
+            )
+            if not cancelled:
+                return Response(
+                    {'error': 'Query has already finished'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            # Read the session under the row lock: the worker clears it before
+            # its connection goes back to the pool, and that update waits for
+            # this transaction, so the pid can't belong to another query yet.
+            backend_pid = QueryHistory.objects.select_for_update().values_list(
+                'backend_pid', flat=True
+            ).get(id=history.id)
+            try:
+                cancel_backend(history.connection, backend_pid)
+            except Exception as e:
+                # The query is still marked cancelled; the statement runs until its timeout.
+                response['warning'] = f'Could not cancel the statement on the source database: {e}'
+        return Response(response)
+
+
+class IgnoreFormatContentNegotiation(BaseContentNegotiation):
+    """
+    The export's `format` query parameter names the file format, not a DRF
+    renderer, so it must not take part in content negotiation.
+    """
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+class QueryExportAPIView(APIView):
+    """
+    Streams the full result of a query as a file download.
+    Query params: `format` (csv, ndjson or parquet), an optional comma-separated
+    `columns` list and `compression=gzip`. A truncated result carries its
+    reason in the `X-Result-Truncated` header.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    content_negotiation_class = IgnoreFormatContentNegotiation
+
+    def get(self, request, history_id, *args, **kwargs):
+        try:
+            # Ensure the history entry belongs to the current tenant
+            history = QueryHistory.objects.select_related('connection').get(id=history_id, tenant=request.tenant)
+        except QueryHistory.DoesNotExist:
+            return Response({'error': 'Query not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        export_format = request.query_params.get('format', 'csv')
+        if export_format not in ENCODERS:
+            return Response(
+                {'error': f'format must be one of: {", ".join(ENCODERS)}'}, status=status.HTTP_400_BAD_REQUEST
+            )
+        compression = request.query_params.get('compression', '')
+        if compression not in ('', 'gzip'):
+            return Response({'error': 'compression must be gzip'}, status=status.HTTP_400_BAD_REQUEST)
+        # Partial results of timed-out queries can be exported too
+        if history.status != QueryHistory.Status.OK and not history.truncated:
+            return Response(
+                {'error': f'Query has not finished successfully (status {history.status})'},
+                status=status.HTTP_409_CONFLICT
+            )
+        columns = [name for name in request.query_params.get('columns', '').split(',') if name]
+
+        gzip = compression == 'gzip'
+        encoder = ENCODERS[export_format]()
+        limiter = None
+        try:
+            if history.result_path and result_exists(history.result_path):
+                chunks = stream_export(iter_result_batches(history, columns), encoder, gzip=gzip)
+            else:
+                # The stored result has been evicted: re-run the query on the
+                # source, within the connection's concurrency limit.
+                limits = get_plan_limits(request.tenant)
+                validator = SQLValidator(history.generated_sql, dialect=history.connection.driver)
+                if history.preview:
+                    # A preview is re-run on samples too; it stays approximate
+                    validator.apply_sampling(settings.PREVIEW_SAMPLE_PERCENT, settings.PREVIEW_SCAN_ROWS)
+                if history.truncated:
+                    # Reproduce the stored result: the rows it kept, whatever capped them
+                    sql = validator.apply_row_limit(history.row_count)
+                    limits = {**limits, 'max_bytes': None}
+                else:
+                    sql = validator.apply_row_limit(limits['max_rows'])
+                chunks = stream_source_export(history, sql, limits, export_format, columns, gzip=gzip)
+                limiter = ConnectionLimiter(history.connection)
+                lease_id = f"export:{history.id}:{uuid.uuid4().hex}"
+                ttl = lease_seconds(limits['timeout_ms'])
+                if not limiter.acquire(lease_id, ttl):
+                    limiter.abandon(lease_id)
+                    retry_after = max(math.ceil(limiter.retry_after()), settings.SOURCE_ADMISSION_RETRY_SEC)
+                    return Response(
+                        {'error': 'Too many queries are running on this connection', 'retry_after': retry_after},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': str(retry_after)}
+                    )
+        except KeyError as e:
+            return Response({'error': f'Unknown columns: {e.args[0]}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if limiter is not None:
+            chunks = _release_after(chunks, limiter, lease_id, ttl)
+
+        filename = f"query-{history.id}.{encoder.extension}"
+        content_type = encoder.content_type
+        if gzip:
+            filename += '.gz'
+            content_type = 'application/gzip'
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        if history.truncated:
+            # The export holds the same rows as the stored result, cut short for this reason
+            response['X-Result-Truncated'] = history.truncated_reason
+        # Let the reverse proxy pass chunks through as they are produced
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def _release_after(chunks, limiter, lease_id, ttl: int):
+    """Holds a connection slot, renewing it, until the export stream is exhausted or closed."""
+    lease = LeaseKeeper(ttl, (limiter, lease_id))
+    try:
+        for chunk in chunks:
+            lease.tick()
+            yield chunk
+    except Exception:
+        # The headers are out: re-raising makes the server abort the response,
+        # so the client sees a failed download rather than a complete one.
+        logger.warning("Export failed mid-stream", exc_info=True, extra={'lease_id': lease_id})
+        raise
+    finally:
+        limiter.release(lease_id)
@@ -0,0 +1,324 @@
+"""
+Bulk catalog reflection.
+
+Reflecting a schema table by table costs at least three catalog round trips
+per table (columns, primary key, foreign keys), which adds up to minutes on
+a warehouse with thousands of tables behind a slow link. Instead, each kind
+of metadata is read for every table of the schema at once:
+
+- Postgres: SQLAlchemy's `get_multi_*` reflection, which the dialect
+  implements as one catalog query per kind.
+- MySQL/MariaDB: set-based `information_schema` queries, since SQLAlchemy's
+  MySQL dialect still reflects `get_multi_*` one table at a time.
+- SQLite: `pragma_table_info` / `pragma_foreign_key_list` joined to
+  `sqlite_master`, likewise.
+- Anything else (SQL Server): `get_multi_*`, at whatever granularity the
+  dialect provides.
+
+Every path returns the same shape: a list of tables sorted by name, each
+`{'name', 'columns', 'primary_keys', 'foreign_keys'}`. Tables outside the
+default schema are named `schema.table`, and so are the tables their
+foreign keys refer to. Reflection can be limited to some tables of a schema,
+so that a large schema can be reflected in batches (see
+app.schema_registry.tasks), or only the tables whose cheap change
+signature (`table_signatures`) moved since the last introspection.
+"""
+import hashlib
+from collections import defaultdict
+
+from sqlalchemy import bindparam, inspect, text
+
+
+def list_tables(connection, schema: str = None) -> list:
+    """Names of the tables of a schema (the default one if None), in one catalog query."""
+    return inspect(connection).get_table_names(schema=schema)
+
+
+def reflect_tables(connection, driver: str, schema: str = None, table_names: list = None) -> list:
+    """
+    Reflects the tables of a schema (the default one if None), or only
+    `table_names` of them, in a handful of catalog queries.
+    """
+    reflector = BULK_REFLECTORS.get(driver, _reflect_multi)
+    return reflector(connection, schema, table_names)
+
+
+def qualified_name(schema, name) -> str:
+    """How tables are named in the payload: `schema.table` outside the default schema."""
+    return f"{schema}.{name}" if schema else name
+
+
+def _table(name, columns, primary_keys, foreign_keys) -> dict:
+    return {
+        'name': name,
+        'columns': columns,
+        'primary_keys': primary_keys,
+        'foreign_keys': foreign_keys,
+    }
+
+
+def _column(name, type_, nullable, default) -> dict:
+    return {'name': name, 'type': type_, 'nullable': nullable, 'default': default}
+
+
+def _foreign_key(constrained_columns, referred_table, referred_columns) -> dict:
+    return {
+        'constrained_columns': constrained_columns,
+        'referred_table': referred_table,
+        'referred_columns': referred_columns,
+    }
+
+
+def _reflect_multi(connection, schema=None, table_names=None) -> list:
+    inspector = inspect(connection)
+    # Keyed by (schema, table); the schema is None for the default schema
+    columns = inspector.get_multi_columns(schema=schema, filter_names=table_names)
+    primary_keys = inspector.get_multi_pk_constraint(schema=schema, filter_names=table_names)
+    foreign_keys = inspector.get_multi_foreign_keys(schema=schema, filter_names=table_names)
+
+    tables = []
+    for key in sorted(columns, key=lambda key: key[1]):
+        tables.append(_table(
+            qualified_name(schema, key[1]),
+            [
+                _column(col['name'], str(col['type']), col['nullable'], col.get('default'))
+                for col in columns[key]
+            ],
+            (primary_keys.get(key) or {}).get('constrained_columns', []),
+            [
+                _foreign_key(
+                    fk['constrained_columns'],
+                    qualified_name(fk.get('referred_schema'), fk['referred_table']),
+                    fk['referred_columns'],
+                )
+                for fk in foreign_keys.get(key, [])
+            ],
+        ))
+    return tables
+
+
+# Same filter as SQLAlchemy's `get_table_names`: internal sqlite_* tables are skipped
+SQLITE_TABLE_FILTER = "type = 'table' AND name NOT LIKE 'sqlite~_%' ESCAPE '~'"
+
+
+def _sqlite_tables(schema, table_names) -> str:
+    sql = f"SELECT name FROM {sqlite_quote(schema or 'main')}.sqlite_master WHERE {SQLITE_TABLE_FILTER}"
+    if table_names is not None:
+        sql += " AND name IN :names"
+    return sql
+
+
+def sqlite_quote(name: str) -> str:
+    """Quotes a SQLite identifier (e.g. an attached database's name)."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _catalog_query(sql: str, schema, table_names):
+    """A catalog query, bound to the schema and, when reflecting a batch, its table names."""
+    statement = text(sql)
+    params = {'schema': schema}
+    if table_names is not None:
+        statement = statement.bindparams(bindparam('names', expanding=True))
+        params['names'] = list(table_names)
+    return statement, params
+
+
+def _reflect_sqlite(connection, schema=None, table_names=None) -> list:
+    if table_names is not None and not table_names:
+        return []
+    tables_sql = _sqlite_tables(schema, table_names)
+    columns, primary_keys = defaultdict(list), defaultdict(list)
+    rows = connection.execute(*_catalog_query(
+        f"SELECT t.name, c.name, c.type, c.\"notnull\", c.dflt_value, c.pk "
+        f"FROM ({tables_sql}) AS t JOIN pragma_table_info(t.name, coalesce(:schema, 'main')) AS c "
+        f"ORDER BY t.name, c.cid",
+        schema, table_names,
+    ))
+    for table_name, name, type_, notnull, default, pk in rows:
+        columns[table_name].append(_column(name, type_, not notnull, default))
+        if pk:
+            # pk is the column's position in the primary key
+            primary_keys[table_name].append((pk, name))
+
+    foreign_keys = defaultdict(dict)
+    rows = connection.execute(*_catalog_query(
+        f"SELECT t.name, f.id, f.\"table\", f.\"from\", f.\"to\" "
+        f"FROM ({tables_sql}) AS t JOIN pragma_foreign_key_list(t.name, coalesce(:schema, 'main')) AS f "
+        f"ORDER BY t.name, f.id, f.seq",
+        schema, table_names,
+    ))
+    for table_name, fk_id, referred_table, constrained, referred in rows:
+        fk = foreign_keys[table_name].setdefault(fk_id, _foreign_key([], referred_table, []))
+        fk['constrained_columns'].append(constrained)
+        fk['referred_columns'].append(referred)
+
+    pk_columns = {name: [column for _, column in sorted(pks)] for name, pks in primary_keys.items()}
+    tables = []
+    for table_name in sorted(columns):
+        table_fks = list(foreign_keys[table_name].values()) if table_name in foreign_keys else []
+        for fk in table_fks:
+            if None in fk['referred_columns']:
+                # REFERENCES t without a column list refers to t's primary key,
+                # which may belong to another batch
+                fk['referred_columns'] = pk_columns.get(fk['referred_table']) or _sqlite_primary_key(
+                    connection, schema, fk['referred_table']
+                )
+            # SQLite foreign keys never leave their database
+            fk['referred_table'] = qualified_name(schema, fk['referred_table'])
+        tables.append(_table(
+            qualified_name(schema, table_name), columns[table_name], pk_columns.get(table_name, []), table_fks
+        ))
+    return tables
+
+
+def _sqlite_primary_key(connection, schema, table_name) -> list:
+    rows = connection.execute(
+        text("SELECT name FROM pragma_table_info(:table, coalesce(:schema, 'main')) WHERE pk > 0 ORDER BY pk"),
+        {'table': table_name, 'schema': schema},
+    )
+    return [name for name, in rows]
+
+
+def _reflect_mysql(connection, schema=None, table_names=None) -> list:
+    if table_names is not None and not table_names:
+        return []
+    names_filter = " AND c.TABLE_NAME IN :names" if table_names is not None else ""
+    columns = defaultdict(list)
+    rows = connection.execute(*_catalog_query(
+        "SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_DEFAULT "
+        "FROM information_schema.COLUMNS AS c "
+        "JOIN information_schema.TABLES AS t "
+        "ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME "
+        "WHERE c.TABLE_SCHEMA = COALESCE(:schema, DATABASE()) AND t.TABLE_TYPE = 'BASE TABLE'"
+        f"{names_filter} "
+        "ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION",
+        schema, table_names,
+    ))
+    for table_name, name, type_, nullable, default in rows:
+        # COLUMN_TYPE is kept as is: ENUM and SET literals are case-sensitive values
+        columns[table_name].append(_column(name, type_, nullable == 'YES', default))
+
+    primary_keys, foreign_keys = defaultdict(list), defaultdict(dict)
+    rows = connection.execute(*_catalog_query(
+        "SELECT c.TABLE_NAME, c.CONSTRAINT_NAME, c.COLUMN_NAME, "
+        "c.REFERENCED_TABLE_SCHEMA, c.REFERENCED_TABLE_NAME, c.REFERENCED_COLUMN_NAME "
+        "FROM information_schema.KEY_COLUMN_USAGE AS c "
+        "WHERE c.TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+        "AND (c.CONSTRAINT_NAME = 'PRIMARY' OR c.REFERENCED_TABLE_NAME IS NOT NULL)"
+        f"{names_filter} "
+        "ORDER BY c.TABLE_NAME, c.CONSTRAINT_NAME, c.ORDINAL_POSITION",
+        schema, table_names,
+    ))
+    for table_name, constraint, name, referred_schema, referred_table, referred in rows:
+        if referred_table is None:
+            primary_keys[table_name].append(name)
+            continue
+        if schema is not None:
+            referred_table = qualified_name(referred_schema, referred_table)
+        fk = foreign_keys[table_name].setdefault(constraint, _foreign_key([], referred_table, []))
+        fk['constrained_columns'].append(name)
+        fk['referred_columns'].append(referred)
+
+    return [
+        _table(
+            qualified_name(schema, table_name),
+            columns[table_name],
+            primary_keys.get(table_name, []),
+            list(foreign_keys[table_name].values()) if table_name in foreign_keys else [],
+        )
+        for table_name in sorted(columns)
+    ]
+
+
+def _postgres_signatures(schema) -> str:
+    # A checksum of each table's columns, defaults and keys, straight from the catalog
+    return (
+        "SELECT c.relname, md5("
+        "coalesce((SELECT string_agg(concat_ws(':', a.attnum, a.attname, format_type(a.atttypid, a.atttypmod), "
+        "a.attnotnull, pg_get_expr(d.adbin, d.adrelid)), ',' ORDER BY a.attnum) "
+        "FROM pg_attribute AS a "
+        "LEFT JOIN pg_attrdef AS d ON d.adrelid = a.attrelid AND d.adnum = a.attnum "
+        "WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped), '') "
+        "|| '|' || "
+        "coalesce((SELECT string_agg(pg_get_constraintdef(k.oid), ',' ORDER BY k.conname) "
+        "FROM pg_constraint AS k WHERE k.conrelid = c.oid AND k.contype IN ('p', 'f')), '')) "
+        "FROM pg_class AS c JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+        "WHERE c.relkind IN ('r', 'p') AND n.nspname = coalesce(:schema, current_schema())"
+    )
+
+
+def _mysql_signatures(schema) -> str:
+    # CREATE_TIME moves when a table is rebuilt; instant ALTERs don't rebuild,
+    # so checksums of its columns and keys are added. UPDATE_TIME moves on
+    # every write and says nothing about the schema.
+    return (
+        "SELECT t.TABLE_NAME, CONCAT_WS(':', t.CREATE_TIME, c.checksum, k.checksum) "
+        "FROM information_schema.TABLES AS t "
+        "JOIN (SELECT TABLE_NAME, SUM(CRC32(CONCAT_WS(':', ORDINAL_POSITION, COLUMN_NAME, COLUMN_TYPE, "
+        "IS_NULLABLE, COLUMN_DEFAULT))) AS checksum "
+        "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+        "GROUP BY TABLE_NAME) AS c ON c.TABLE_NAME = t.TABLE_NAME "
+        "LEFT JOIN (SELECT TABLE_NAME, SUM(CRC32(CONCAT_WS(':', CONSTRAINT_NAME, ORDINAL_POSITION, COLUMN_NAME, "
+        "REFERENCED_TABLE_SCHEMA, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME))) AS checksum "
+        "FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+        "AND (CONSTRAINT_NAME = 'PRIMARY' OR REFERENCED_TABLE_NAME IS NOT NULL) "
+        "GROUP BY TABLE_NAME) AS k ON k.TABLE_NAME = t.TABLE_NAME "
+        "WHERE t.TABLE_SCHEMA = COALESCE(:schema, DATABASE()) AND t.TABLE_TYPE = 'BASE TABLE'"
+    )
+
+
+def _mssql_signatures(schema) -> str:
+    # modify_date moves on every ALTER TABLE, including added or dropped keys
+    return (
+        "SELECT t.name, CONVERT(varchar(33), t.modify_date, 126) FROM sys.tables AS t "
+        "WHERE t.schema_id = SCHEMA_ID(COALESCE(:schema, SCHEMA_NAME()))"
+    )
+
+
+def _sqlite_signatures(schema) -> str:
+    # The CREATE statement is rewritten by every ALTER TABLE, including
+    # renames of the tables its foreign keys refer to
+    return _sqlite_tables(schema, None).replace("SELECT name", "SELECT name, sql", 1)
+
+
+# Cheap per-table change signals, used to re-reflect only changed tables
+SIGNATURE_QUERIES = {
+    'postgres': _postgres_signatures,
+    'mysql': _mysql_signatures,
+    'mssql': _mssql_signatures,
+    'sqlite': _sqlite_signatures,
+}
+
+
+def table_signatures(connection, driver: str, schema: str = None):
+    """
+    `{table name: signature}` for the tables of a schema, named as
+    `reflect_tables` names them, in one catalog query. A table's signature
+    changes whenever its definition does. None if the driver has no cheap
+    change signal.
+    """
+    if driver not in SIGNATURE_QUERIES:
+        return None
+    rows = connection.execute(text(SIGNATURE_QUERIES[driver](schema)), {'schema': schema})
+    return {
+        qualified_name(schema, name): hashlib.md5(str(signature).encode()).hexdigest()
+        for name, signature in rows
+    }
+
+
+def schema_version(connection, driver: str):
+    """
+    A database-wide counter that changes with any schema change, where the
+    database keeps one (SQLite's `PRAGMA schema_version`), else None.
+    When it is unchanged there is nothing to re-reflect at all.
+    """
+    if driver == 'sqlite':
+        return connection.execute(text("PRAGMA schema_version")).scalar()
+    return None
+
+
+# Drivers whose SQLAlchemy dialect reflects one table at a time
+BULK_REFLECTORS = {
+    'sqlite': _reflect_sqlite,
+    'mysql': _reflect_mysql,
+}
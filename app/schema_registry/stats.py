@@ -0,0 +1,120 @@
+"""
+Table statistics from the source's catalog.
+
+Introspection records, per table, the estimated row count, the on-disk size
+in bytes and when the table was last analyzed, as far as each database keeps
+them, without scanning any table:
+
+- Postgres: `pg_class.reltuples`, `pg_total_relation_size` and
+  `pg_stat_all_tables.last_analyze` / `last_autoanalyze`.
+- MySQL/MariaDB: `information_schema.TABLES` (`TABLE_ROWS`, data plus index
+  length). MySQL keeps no analyze time there.
+- SQL Server: `sys.partitions` rows, `sys.allocation_units` pages and
+  `STATS_DATE` of the table's statistics.
+- SQLite: `sqlite_stat1` (only after ANALYZE) and the `dbstat` virtual table.
+
+Statistics are stored apart from the schema payload (`SchemaCache.stats_json`),
+so their routine drift never changes the schema hash. They feed cost
+admission, the LLM prompt and ERD sizing.
+"""
+import logging
+
+from sqlalchemy import text
+
+from .reflection import SQLITE_TABLE_FILTER, sqlite_quote, qualified_name
+
+logger = logging.getLogger(__name__)
+
+
+def _stats(rows=None, bytes_=None, analyzed_at=None) -> dict:
+    return {
+        'rows': int(rows) if rows is not None and rows >= 0 else None,
+        'bytes': int(bytes_) if bytes_ is not None else None,
+        'analyzed_at': analyzed_at.isoformat() if hasattr(analyzed_at, 'isoformat') else analyzed_at,
+    }
+
+
+def _collect_postgres(connection, schema):
+    rows = connection.execute(text(
+        "SELECT c.relname, c.reltuples, pg_total_relation_size(c.oid), "
+        "greatest(s.last_analyze, s.last_autoanalyze) "
+        "FROM pg_class AS c JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+        "LEFT JOIN pg_stat_all_tables AS s ON s.relid = c.oid "
+        "WHERE c.relkind IN ('r', 'p') AND n.nspname = coalesce(:schema, current_schema())"
+    ), {'schema': schema})
+    # reltuples is -1 until the table is first vacuumed or analyzed
+    return {name: _stats(reltuples, size, analyzed_at) for name, reltuples, size, analyzed_at in rows}
+
+
+def _collect_mysql(connection, schema):
+    rows = connection.execute(text(
+        "SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) AND TABLE_TYPE = 'BASE TABLE'"
+    ), {'schema': schema})
+    return {name: _stats(table_rows, size) for name, table_rows, size in rows}
+
+
+def _collect_mssql(connection, schema):
+    rows = connection.execute(text(
+        "SELECT t.name, "
+        "(SELECT SUM(p.rows) FROM sys.partitions AS p WHERE p.object_id = t.object_id AND p.index_id IN (0, 1)), "
+        "(SELECT SUM(a.total_pages) * 8192 FROM sys.partitions AS p "
+        "JOIN sys.allocation_units AS a ON a.container_id = p.partition_id WHERE p.object_id = t.object_id), "
+        "(SELECT MAX(STATS_DATE(st.object_id, st.stats_id)) FROM sys.stats AS st WHERE st.object_id = t.object_id) "
+        "FROM sys.tables AS t WHERE t.schema_id = SCHEMA_ID(COALESCE(:schema, SCHEMA_NAME()))"
+    ), {'schema': schema})
+    return {name: _stats(row_count, size, analyzed_at) for name, row_count, size, analyzed_at in rows}
+
+
+def _collect_sqlite(connection, schema):
+    database = schema or 'main'
+    quoted = sqlite_quote(database)
+    stats = {
+        name: _stats() for name, in connection.execute(text(
+            f"SELECT name FROM {quoted}.sqlite_master WHERE {SQLITE_TABLE_FILTER}"
+        ))
+    }
+    try:
+        # The first number of each entry is the table's row count at the last ANALYZE
+        for name, stat in connection.execute(text(f"SELECT tbl, stat FROM {quoted}.sqlite_stat1")):
+            if name in stats:
+                stats[name]['rows'] = int(stat.split()[0])
+    except Exception:
+        # The database was never analyzed
+        pass
+    try:
+        sizes = connection.execute(
+            text("SELECT name, SUM(pgsize) FROM dbstat WHERE schema = :schema GROUP BY name"), {'schema': database}
+        )
+        for name, size in sizes:
+            if name in stats:
+                stats[name]['bytes'] = int(size)
+    except Exception:
+        # SQLite was built without the dbstat table
+        pass
+    return stats
+
+
+COLLECTORS = {
+    'postgres': _collect_postgres,
+    'mysql': _collect_mysql,
+    'mssql': _collect_mssql,
+    'sqlite': _collect_sqlite,
+}
+
+
+def collect_stats(connection, driver: str, schema: str = None) -> dict:
+    """
+    `{table name: {'rows', 'bytes', 'analyzed_at'}}` for the tables of a
+    schema, named as `reflect_tables` names them; values the database
+    doesn't know are None. Statistics are best effort: a failure is logged
+    and yields no statistics rather than failing the introspection.
+    """
+    if driver not in COLLECTORS:
+        return {}
+    try:
+        stats = COLLECTORS[driver](connection, schema)
+    except Exception:
+        logger.warning("Could not collect table statistics", exc_info=True, extra={'driver': driver})
+        return {}
+    return {qualified_name(schema, name): table_stats for name, table_stats in stats.items()}
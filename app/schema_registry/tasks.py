@@ -1,26 +1,31 @@
+import json
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from celery import shared_task
-from sqlalchemy import create_engine, inspect, text
+from django.conf import settings
+from django.utils import timezone
 from app.connections.models import Connection
+from app.connections.engines import get_engine
+from app.connections.limiter import ConnectionLimiter
 from .models import SchemaCache
+from .reflection import list_tables, qualified_name, reflect_tables, schema_version, table_signatures
+from .stats import collect_stats
 import hashlib
 
-def get_db_url(conn: Connection) -> str:
-    """Helper function to build a SQLAlchemy URL from a Connection object."""
-    password = conn.password # Decrypts the password
-    if conn.driver == 'postgres':
-        return f"postgresql+psycopg://{conn.username}:{password}@{conn.host}:{conn.port}/{conn.database}"
-    elif conn.driver == 'mysql':
-        return f"mysql+pymysql://{conn.username}:{password}@{conn.host}:{conn.port}/{conn.database}"
-    elif conn.driver == 'mssql':
-        return f"mssql+pyodbc://{conn.username}:{password}@{conn.host}:{port}/{conn.database}?driver=ODBC+Driver+17+for+SQL+Server"
-    elif conn.driver == 'sqlite':
-        return f"sqlite:///{conn.database}"
-    raise ValueError(f"Unsupported driver: {conn.driver}")
+# How long an introspection batch may hold a slot of the connection's limit
+INTROSPECTION_LEASE_SEC = 15 * 60
 
 @shared_task
-def introspect_connection_task(connection_id: int):
+def introspect_connection_task(connection_id: int, full: bool = False):
     """
     A Celery task to perform schema introspection on a given database connection.
+
+    Unless `full` is set, only the tables whose change signature moved since
+    the last introspection are re-reflected and patched into the stored
+    payload; added and dropped tables are picked up the same way. Drivers
+    without a change signal, and connections without a previous
+    introspection, are always reflected in full.
     """
     try:
         connection_obj = Connection.objects.get(id=connection_id)
@@ -28,55 +33,68 @@ def introspect_connection_task(connection_id: int):
         # Handle case where connection might have been deleted
         return f"Connection with id {connection_id} not found."
 
-    db_url = get_db_url(connection_obj)
-    engine = create_engine(db_url, connect_args={'connect_timeout': 10})
-    inspector = inspect(engine)
+    cache = SchemaCache.objects.filter(connection=connection_obj).first()
+    previous = cache.signatures_json if cache is not None and not full else {}
+
+    # Signatures are read before reflecting, so a change made meanwhile is
+    # still caught by the next run
+    with get_engine(connection_obj).connect() as connection:
+        signatures, by_schema = read_signatures(connection, connection_obj, previous)
+        # Row and size estimates drift with every write, so they are read on
+        # every run, from the catalog only
+        stats = {}
+        for schema in connection_obj.options_json.get('schemas') or [None]:
+            stats.update(collect_stats(connection, connection_obj.driver, schema))
+
+    if by_schema is None:
+        tables = list(cache.payload_json.get('tables', []))
+    elif previous.get('tables') is not None and signatures['schemas'] == previous.get('schemas'):
+        # New tables have no previous signature, so they count as changed
+        changed = {
+            schema: [name for name, signature in names.items() if previous['tables'].get(qualified_name(schema, name)) != signature]
+            for schema, names in by_schema.items()
+        }
+        changed = {schema: names for schema, names in changed.items() if names}
+        # Dropped tables have no current signature
+        unchanged = set(signatures['tables']).difference(
+            qualified_name(schema, name) for schema, names in changed.items() for name in names
+        )
+        tables = [table for table in cache.payload_json.get('tables', []) if table['name'] in unchanged]
+        if changed:
+            tables += reflect_connection(connection_obj, changed)
+    else:
+        tables = reflect_connection(connection_obj)
+    tables.sort(key=lambda table: table['name'])
 
     schema_payload = {
-        'tables': []
+        'tables': tables
     }
     graph_nodes = []
     graph_edges = []
 
-    table_names = inspector.get_table_names()
-
-    for table_name in table_names:
-        columns = []
-        for col in inspector.get_columns(table_name):
-            columns.append({
-                'name': col['name'],
-                'type': str(col['type']),
-                'nullable': col['nullable'],
-                'default': col.get('default'),
-            })
-
-        primary_keys = inspector.get_pk_constraint(table_name).get('constrained_columns', [])
-        foreign_keys = []
-        for fk in inspector.get_foreign_keys(table_name):
-            foreign_keys.append({
-                'constrained_columns': fk['constrained_columns'],
-                'referred_table': fk['referred_table'],
-                'referred_columns': fk['referred_columns'],
-            })
-            # Add edge for the ERD graph
+    for table in tables:
+        # Add node and edges for the ERD graph
+        graph_nodes.append({'id': table['name'], 'label': table['name']})
+        for fk in table['foreign_keys']:
             graph_edges.append({
-                'source': table_name,
+                'source': table['name'],
                 'target': fk['referred_table'],
                 'label': f"{','.join(fk['constrained_columns'])} -> {','.join(fk['referred_columns'])}"
             })
 
-        schema_payload['tables'].append({
-            'name': table_name,
-            'columns': columns,
-            'primary_keys': primary_keys,
-            'foreign_keys': foreign_keys,
-        })
-        # Add node for the ERD graph
-        graph_nodes.append({'id': table_name, 'label': table_name})
-
     # Create a hash of the payload to detect changes
-    payload_str = str(schema_payload)
-    schema_hash = hashlib.sha256(payload_str.encode()).hexdigest()
+    schema_hash = hash_schema(schema_payload)
+
+    # An unchanged schema keeps its payload (and hash) as is; only the refresh
+    # time, statistics and signatures (when e.g. only an index changed) move
+    unchanged = SchemaCache.objects.filter(connection=connection_obj, hash=schema_hash)
+    updates = {'refreshed_at': timezone.now()}
+    if cache is None or signatures != cache.signatures_json:
+        updates['signatures_json'] = signatures
+    if cache is None or stats != cache.stats_json:
+        updates['stats_json'] = stats
+    if unchanged.update(**updates):
+        return f"Introspection complete for connection: {connection_obj.name} (schema unchanged)"
 
     # Update or create the cache
     SchemaCache.objects.update_or_create(
@@ -86,7 +104,131 @@ def introspect_connection_task(connection_id: int):
             'payload_json': schema_payload,
             'graph_json': {'nodes': graph_nodes, 'edges': graph_edges},
             'hash': schema_hash,
+            'signatures_json': signatures,
+            'stats_json': stats,
         }
     )
 
     return f"Introspection complete for connection: {connection_obj.name}"
+
+
+def read_signatures(connection, connection_obj, previous: dict):
+    """
+    Reads the change signatures of every table of the connection's schemas.
+    Returns what is stored on the SchemaCache (`{'schemas', 'version',
+    'tables'}`, with 'tables' None for drivers without a change signal) and
+    the same signatures by schema and unqualified table name, or None when
+    the database's schema version shows nothing has changed.
+    """
+    schemas = connection_obj.options_json.get('schemas') or [None]
+    version = schema_version(connection, connection_obj.driver)
+    if version is not None and previous.get('version') == version and previous.get('schemas') == schemas:
+        # Nothing in the database has changed since the previous introspection
+        return previous, None
+
+    by_schema = {}
+    for schema in schemas:
+        tables = table_signatures(connection, connection_obj.driver, schema)
+        if tables is None:
+            return {'schemas': schemas, 'version': None, 'tables': None}, {}
+        prefix = f"{schema}." if schema else ''
+        by_schema[schema] = {name[len(prefix):]: signature for name, signature in tables.items()}
+    tables = {
+        qualified_name(schema, name): signature
+        for schema, names in by_schema.items() for name, signature in names.items()
+    }
+    return {'schemas': schemas, 'version': version, 'tables': tables}, by_schema
+
+
+def reflect_connection(connection_obj, tables_by_schema: dict = None) -> list:
+    """
+    Reflects the connection's schemas (`options_json["schemas"]`, or the
+    default schema), or only the given `{schema: [table names]}`, in batches
+    of INTROSPECTION_BATCH_TABLES tables. Batches run in parallel on their
+    own pooled connections, each holding a slot of the connection's
+    concurrency limit, and are merged in order.
+    """
+    engine = get_engine(connection_obj)
+    schemas = connection_obj.options_json.get('schemas') or [None]
+    size = settings.INTROSPECTION_BATCH_TABLES
+
+    with engine.connect() as connection:
+        if tables_by_schema is None:
+            tables_by_schema = {schema: list_tables(connection, schema) for schema in schemas}
+        batches = []
+        for schema, names in tables_by_schema.items():
+            batches.extend((schema, names[i:i + size]) for i in range(0, len(names), size))
+        if len(batches) <= 1:
+            # Nothing to parallelise; reflect on the connection we already hold
+            return [
+                table for schema, names in batches
+                for table in reflect_tables(connection, connection_obj.driver, schema, names)
+            ]
+
+    # Never more batches at once than free slots of the connection's limit,
+    # nor than the engine's pool can hand out. One batch always runs, as a
+    # serial introspection would.
+    limiter = ConnectionLimiter(connection_obj)
+    parallelism = min(
+        settings.INTROSPECTION_PARALLELISM,
+        settings.SOURCE_ENGINE_POOL_SIZE + settings.SOURCE_ENGINE_MAX_OVERFLOW,
+        len(batches),
+    )
+    leases = []
+    for _ in range(parallelism):
+        lease_id = f"introspect:{uuid.uuid4().hex}"
+        if not limiter.acquire(lease_id, INTROSPECTION_LEASE_SEC):
+            limiter.abandon(lease_id)
+            break
+        leases.append(lease_id)
+
+    def reflect_batch(batch):
+        schema, names = batch
+        with engine.connect() as batch_connection:
+            return reflect_tables(batch_connection, connection_obj.driver, schema, names)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(len(leases), 1), thread_name_prefix='introspect') as pool:
+            parts = list(pool.map(reflect_batch, batches))
+    finally:
+        for lease_id in leases:
+            limiter.release(lease_id)
+    return [table for part in parts for table in part]
+
+
+def canonical_payload(schema_payload: dict) -> str:
+    """
+    A serialization of a schema payload that only changes when the schema
+    does: tables and foreign keys are sorted, type strings normalized (case
+    and spacing) and keys sorted. Column order is kept, since it is part of
+    the schema.
+    """
+    tables = []
+    for table in sorted(schema_payload.get('tables', []), key=lambda table: table['name']):
+        tables.append({
+            **table,
+            'columns': [{**column, 'type': normalize_type(column.get('type'))} for column in table['columns']],
+            'foreign_keys': sorted(
+                table['foreign_keys'],
+                key=lambda fk: (fk['referred_table'], fk['constrained_columns'], fk['referred_columns']),
+            ),
+        })
+    return json.dumps({**schema_payload, 'tables': tables}, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def normalize_type(type_) -> str:
+    """
+    E.g. `varchar( 255 )` and `VARCHAR(255)` are the same type. Quoted
+    literals, such as ENUM values, keep their case and spacing.
+    """
+    if type_ is None:
+        return None
+    parts = re.split(r"('(?:[^']|'')*')", str(type_).strip())
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'\s+', ' ', parts[i].upper())
+        parts[i] = re.sub(r'\s*([(),])\s*', r'\1', part)
+    return ''.join(parts)
+
+
+def hash_schema(schema_payload: dict) -> str:
+    return hashlib.sha256(canonical_payload(schema_payload).encode()).hexdigest()
@@ -1,13 +1,24 @@
+import fakeredis
 import pytest
 from unittest.mock import patch, MagicMock
-from .tasks import introspect_connection_task
+from sqlalchemy import create_engine, text
+from .reflection import BULK_REFLECTORS, _reflect_multi, _reflect_mysql, reflect_tables
+from .tasks import hash_schema, introspect_connection_task, normalize_type, reflect_connection
 from .models import SchemaCache
 from app.connections.models import Connection
+from app.connections.limiter import ConnectionLimiter
 from app.tenancy.models import Tenant
 from app.accounts.models import User
 
 pytestmark = pytest.mark.django_db
 
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    """Replaces the shared Redis client with an in-memory one."""
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr('app.common.redis._client', client)
+    return client
+
 @pytest.fixture
 def connection_obj():
     """Fixture for a Connection object."""
@@ -21,9 +32,9 @@ def connection_obj():
     )
     return connection
 
-@patch('app.schema_registry.tasks.inspect')
-@patch('app.schema_registry.tasks.create_engine')
-def test_introspect_connection_task(mock_create_engine, mock_sqlalchemy_inspect, connection_obj):
+@patch('app.schema_registry.reflection.inspect')
+@patch('app.schema_registry.tasks.get_engine')
+def test_introspect_connection_task(mock_get_engine, mock_sqlalchemy_inspect, connection_obj):
     """
     Unit test the introspection task with mocked database interactions.
     """
@@ -31,12 +42,12 @@ def test_introspect_connection_task(mock_create_engine, mock_sqlalchemy_inspect,
     # Mock the SQLAlchemy Inspector to return a predefined schema
     mock_inspector = MagicMock()
     mock_inspector.get_table_names.return_value = ['users']
-    mock_inspector.get_columns.return_value = [
+    mock_inspector.get_multi_columns.return_value = {(None, 'users'): [
         {'name': 'id', 'type': 'INTEGER', 'nullable': False},
         {'name': 'email', 'type': 'VARCHAR(255)', 'nullable': False},
-    ]
-    mock_inspector.get_pk_constraint.return_value = {'constrained_columns': ['id']}
-    mock_inspector.get_foreign_keys.return_value = []
+    ]}
+    mock_inspector.get_multi_pk_constraint.return_value = {(None, 'users'): {'constrained_columns': ['id']}}
+    mock_inspector.get_multi_foreign_keys.return_value = {(None, 'users'): []}
     mock_sqlalchemy_inspect.return_value = mock_inspector
 
     # --- Task Execution ---
@@ -60,3 +71,199 @@ def test_introspect_connection_task(mock_create_engine, mock_sqlalchemy_inspect,
 
     # Check that the hash is not empty
     assert cache.hash is not None
+
+    # The whole schema is reflected in one go, not table by table
+    mock_inspector.get_columns.assert_not_called()
+
+def test_bulk_sqlite_reflection_matches_per_table_reflection(tmp_path):
+    """
+    The set-based SQLite reflection returns exactly what SQLAlchemy's per-table reflection does.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE customers (id INTEGER PRIMARY KEY, region VARCHAR(20) NOT NULL DEFAULT 'eu')"))
+        connection.execute(text("CREATE TABLE items (sku TEXT, version INTEGER, PRIMARY KEY (version, sku))"))
+        connection.execute(text(
+            "CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers, "
+            "sku TEXT, version INTEGER, amount NUMERIC, "
+            "FOREIGN KEY (sku, version) REFERENCES items (sku, version))"
+        ))
+        connection.execute(text("CREATE VIEW big_orders AS SELECT * FROM orders WHERE amount > 100"))
+
+    with engine.connect() as connection:
+        bulk = reflect_tables(connection, 'sqlite')
+        assert bulk == _reflect_multi(connection)
+
+    assert 'sqlite' in BULK_REFLECTORS
+    assert [table['name'] for table in bulk] == ['customers', 'items', 'orders']
+    orders = bulk[2]
+    assert orders['foreign_keys'] == [
+        {'constrained_columns': ['sku', 'version'], 'referred_table': 'items', 'referred_columns': ['sku', 'version']},
+        {'constrained_columns': ['customer_id'], 'referred_table': 'customers', 'referred_columns': ['id']},
+    ]
+    engine.dispose()
+
+def test_parallel_introspection_merges_batches_within_connection_limit(settings, tmp_path):
+    """
+    Batches are reflected concurrently, never holding more slots than the connection allows,
+    and merge into the same payload as a single pass.
+    """
+    path = tmp_path / 'source.db'
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE t0 (id INTEGER PRIMARY KEY)"))
+        for i in range(1, 7):
+            connection.execute(text(f"CREATE TABLE t{i} (id INTEGER PRIMARY KEY, parent_id INTEGER REFERENCES t{i - 1})"))
+    with engine.connect() as connection:
+        expected = reflect_tables(connection, 'sqlite')
+    engine.dispose()
+
+    tenant = Tenant.objects.create(name="Test Tenant")
+    source = Connection.objects.create(
+        tenant=tenant, name="Source", driver="sqlite", database=str(path), options_json={'max_concurrency': 3}
+    )
+    limiter = ConnectionLimiter(source)
+    assert limiter.acquire('running-query', ttl=30)
+    settings.INTROSPECTION_BATCH_TABLES = 2
+    settings.INTROSPECTION_PARALLELISM = 4
+
+    in_flight = []
+    def reflect_batch(connection, driver, schema, names):
+        in_flight.append(limiter.in_flight())
+        return reflect_tables(connection, driver, schema, names)
+
+    with patch('app.schema_registry.tasks.reflect_tables', side_effect=reflect_batch) as mock_reflect:
+        tables = reflect_connection(source)
+
+    assert tables == expected
+    assert mock_reflect.call_count == 4
+    assert set(in_flight) == {3}
+    assert limiter.in_flight() == 1
+
+def test_schema_hash_ignores_order_and_type_spelling():
+    """
+    Table and foreign key order and type spelling don't change the hash; a real change does.
+    """
+    def table(name, type_, fks=()):
+        return {
+            'name': name,
+            'columns': [{'name': 'id', 'type': type_, 'nullable': False, 'default': None}],
+            'primary_keys': ['id'],
+            'foreign_keys': [{'constrained_columns': [c], 'referred_table': t, 'referred_columns': ['id']} for c, t in fks],
+        }
+
+    payload = {'tables': [table('a', 'NUMERIC(12,2)', [('x', 'b'), ('y', 'c')]), table('b', 'INTEGER')]}
+    reordered = {'tables': [table('b', 'integer'), table('a', 'numeric( 12, 2 )', [('y', 'c'), ('x', 'b')])]}
+    changed = {'tables': [table('a', 'NUMERIC(12,2)', [('x', 'b'), ('y', 'c')]), table('b', 'BIGINT')]}
+
+    assert hash_schema(payload) == hash_schema(reordered)
+    assert hash_schema(payload) != hash_schema(changed)
+
+def test_mysql_reflection_keeps_enum_literals():
+    """
+    ENUM values reach the prompt as stored; only the hash ignores type spelling, and not literal case.
+    """
+    connection = MagicMock()
+    connection.execute.side_effect = [
+        [('users', 'status', "enum('active','Inactive')", 'NO', 'active')],
+        [('users', 'PRIMARY', 'status', None, None, None)],
+    ]
+    [table] = _reflect_mysql(connection)
+    assert table['columns'][0]['type'] == "enum('active','Inactive')"
+
+    assert normalize_type("enum( 'active', 'Inactive' )") == "ENUM('active','Inactive')"
+    assert normalize_type("enum('active','inactive')") != normalize_type("enum('active','Inactive')")
+
+@patch('app.schema_registry.reflection.inspect')
+@patch('app.schema_registry.tasks.get_engine')
+def test_introspection_skips_write_for_unchanged_schema(mock_get_engine, mock_sqlalchemy_inspect, connection_obj):
+    """
+    Re-introspecting an unchanged schema keeps the cached row and hash, and only moves refreshed_at.
+    """
+    mock_inspector = mock_sqlalchemy_inspect.return_value
+    mock_inspector.get_table_names.return_value = ['users']
+    mock_inspector.get_multi_columns.return_value = {(None, 'users'): [{'name': 'id', 'type': 'INTEGER', 'nullable': False}]}
+    mock_inspector.get_multi_pk_constraint.return_value = {}
+    mock_inspector.get_multi_foreign_keys.return_value = {}
+
+    introspect_connection_task(connection_obj.id)
+    first = SchemaCache.objects.get(connection=connection_obj)
+
+    with patch('app.schema_registry.tasks.SchemaCache.objects.update_or_create') as mock_write:
+        assert introspect_connection_task(connection_obj.id, full=True).endswith("(schema unchanged)")
+    mock_write.assert_not_called()
+    second = SchemaCache.objects.get(connection=connection_obj)
+    assert second.hash == first.hash
+    assert second.refreshed_at > first.refreshed_at
+
+def test_incremental_introspection_reflects_only_changed_tables(tmp_path):
+    """
+    Only added and altered tables are re-reflected, dropped ones removed, and the
+    patched payload matches a full introspection. An unchanged database is not reflected at all.
+    """
+    path = tmp_path / 'source.db'
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        for name in ('a', 'b', 'c'):
+            connection.execute(text(f"CREATE TABLE {name} (id INTEGER PRIMARY KEY)"))
+
+    tenant = Tenant.objects.create(name="Test Tenant")
+    source = Connection.objects.create(tenant=tenant, name="Source", driver="sqlite", database=str(path))
+    introspect_connection_task(source.id)
+
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE b ADD COLUMN a_id INTEGER REFERENCES a (id)"))
+        connection.execute(text("DROP TABLE c"))
+        connection.execute(text("CREATE TABLE d (id INTEGER PRIMARY KEY, note TEXT)"))
+    engine.dispose()
+
+    with patch('app.schema_registry.tasks.reflect_tables', wraps=reflect_tables) as mock_reflect:
+        introspect_connection_task(source.id)
+    assert [call.args[3] for call in mock_reflect.call_args_list] == [['b', 'd']]
+
+    cache = SchemaCache.objects.get(connection=source)
+    incremental = (cache.payload_json, cache.hash)
+    introspect_connection_task(source.id, full=True)
+    cache.refresh_from_db()
+    assert (cache.payload_json, cache.hash) == incremental
+    assert [table['name'] for table in cache.payload_json['tables']] == ['a', 'b', 'd']
+    assert cache.graph_json['edges'][0]['target'] == 'a'
+
+    with patch('app.schema_registry.tasks.table_signatures') as mock_signatures, \
+            patch('app.schema_registry.tasks.reflect_tables') as mock_reflect:
+        assert introspect_connection_task(source.id).endswith("(schema unchanged)")
+    mock_signatures.assert_not_called()
+    mock_reflect.assert_not_called()
+
+def test_introspection_records_catalog_statistics_outside_the_hash(tmp_path):
+    """
+    Row estimates and sizes come from the catalog, and their drift updates the statistics without changing the hash.
+    """
+    path = tmp_path / 'source.db'
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE events (id INTEGER PRIMARY KEY, kind TEXT)"))
+        connection.execute(text("CREATE INDEX events_kind ON events (kind)"))
+        connection.execute(text("CREATE TABLE kinds (name TEXT)"))
+        for i in range(20):
+            connection.execute(text("INSERT INTO events (kind) VALUES (:kind)"), {'kind': f"k{i % 3}"})
+        connection.execute(text("ANALYZE"))
+
+    tenant = Tenant.objects.create(name="Test Tenant")
+    source = Connection.objects.create(tenant=tenant, name="Source", driver="sqlite", database=str(path))
+    introspect_connection_task(source.id)
+    cache = SchemaCache.objects.get(connection=source)
+    assert cache.stats_json['events']['rows'] == 20
+    assert cache.stats_json['events']['bytes'] > 0
+    # Empty tables get no sqlite_stat1 entry
+    assert cache.stats_json['kinds']['rows'] is None
+
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO events (kind) VALUES ('k0')"))
+        connection.execute(text("ANALYZE"))
+    engine.dispose()
+
+    assert introspect_connection_task(source.id).endswith("(schema unchanged)")
+    refreshed = SchemaCache.objects.get(connection=source)
+    assert refreshed.hash == cache.hash
+    assert refreshed.stats_json['events']['rows'] == 21
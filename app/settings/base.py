@@ -162,15 +162,154 @@ CORS_ALLOWED_ORIGINS = os.environ.get('FRONTEND_URL', 'http://localhost:3000,htt
 CORS_ALLOW_CREDENTIALS = True
 
 
+# --- Redis ---
+# Used as the Celery broker and for caching and coordination (see app.common.redis).
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+
 # --- Celery ---
-CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
-CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Each kind of work has its own queue and workers (see docker/docker-compose.yml),
+# so slow introspections or exports never hold up interactive queries.
+CELERY_TASK_DEFAULT_QUEUE = 'bulk'
+CELERY_TASK_ROUTES = {
+    'app.queries.tasks.execute_query_task': {'queue': 'interactive'},
+    'app.schema_registry.tasks.introspect_connection_task': {'queue': 'introspection'},
+}
+# Priorities within a queue: the Redis broker keeps a list per priority step
+# and serves lower numbers first.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+}
+CELERY_TASK_DEFAULT_PRIORITY = 5
+# Workers only reserve the task they are about to run, so a high-priority
+# task is never stuck behind tasks prefetched by a busy worker.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Executions retried for a connection slot have already waited; they go first.
+QUERY_PRIORITY_RETRY = 0
+QUERY_PRIORITY_INTERACTIVE = 3
+# Queries the cost check warned about yield to cheaper ones.
+QUERY_PRIORITY_EXPENSIVE = 6
+# The asyncio execution worker (app.queries.async_worker) runs up to this many
+# queries at once in one process, with this many threads for ORM and Redis calls.
+ASYNC_WORKER_CONCURRENCY = int(os.environ.get('ASYNC_WORKER_CONCURRENCY', 200))
+ASYNC_WORKER_THREADS = int(os.environ.get('ASYNC_WORKER_THREADS', 16))
+CELERY_BEAT_SCHEDULE = {
+    'evict-stored-results': {
+        'task': 'app.queries.tasks.evict_results_task',
+        'schedule': 15 * 60,
+    },
+}
+
 
 # --- Custom App Settings ---
 # Header used to identify the tenant for a request
 TENANT_HEADER = 'X-Tenant-ID'
+
+# --- NLQ Provider ---
+LLM_PROVIDER_URL = os.environ.get('LLM_PROVIDER_URL', '')
+LLM_API_KEY = os.environ.get('LLM_API_KEY', '')
+
+# --- Query Execution ---
+# Safety caps applied by the execution worker.
+RESULT_MAX_BYTES = int(os.environ.get('RESULT_MAX_BYTES', 100 * 1024 * 1024))
+RESULT_MAX_ROWS = int(os.environ.get('RESULT_MAX_ROWS', 1_000_000))
+QUERY_TIMEOUT_MS = int(os.environ.get('QUERY_TIMEOUT_MS', 30_000))
+# A Postgres CSV export runs as a single COPY statement for the whole
+# download, so it is bounded by this instead of the query timeout, which would
+# also cap how fast the client reads. 0 disables it.
+EXPORT_TIMEOUT_MS = int(os.environ.get('EXPORT_TIMEOUT_MS', 60 * 60 * 1000))
+
+# Planner estimates above which a query runs with a warning, runs on the
+# low-priority queue, or is rejected before execution (see app.queries.cost).
+# `rows` is the most rows any step of the plan is expected to produce; `cost`
+# is in the driver's own planner units, so it is best set per plan.
+QUERY_COST_THRESHOLDS = {
+    'warn': {'rows': 10_000_000},
+    'low_priority': {'rows': 100_000_000},
+    'reject': {'rows': 10_000_000_000},
+}
+QUERY_LOW_PRIORITY_QUEUE = os.environ.get('QUERY_LOW_PRIORITY_QUEUE', 'bulk')
+
+# Per-plan overrides of the execution limits above (see app.tenancy.plans).
+TENANT_PLAN_LIMITS = {
+    'free': {
+        'max_rows': 100_000,
+        'max_bytes': 25 * 1024 * 1024,
+        'cost_thresholds': {
+            'warn': {'rows': 1_000_000},
+            'low_priority': {'rows': 10_000_000},
+            'reject': {'rows': 500_000_000},
+        },
+    },
+}
+
+# --- Source Database Engines ---
+# Each worker process keeps one pooled engine per connection (see app.connections.engines).
+SOURCE_CONNECT_TIMEOUT_SEC = int(os.environ.get('SOURCE_CONNECT_TIMEOUT_SEC', 10))
+SOURCE_ENGINE_POOL_SIZE = int(os.environ.get('SOURCE_ENGINE_POOL_SIZE', 2))
+SOURCE_ENGINE_MAX_OVERFLOW = int(os.environ.get('SOURCE_ENGINE_MAX_OVERFLOW', 2))
+SOURCE_ENGINE_POOL_TIMEOUT_SEC = int(os.environ.get('SOURCE_ENGINE_POOL_TIMEOUT_SEC', 30))
+SOURCE_ENGINE_POOL_RECYCLE_SEC = int(os.environ.get('SOURCE_ENGINE_POOL_RECYCLE_SEC', 1800))
+# Engines unused for this long are disposed, closing their pooled connections.
+SOURCE_ENGINE_IDLE_TIMEOUT_SEC = int(os.environ.get('SOURCE_ENGINE_IDLE_TIMEOUT_SEC', 600))
+SOURCE_ENGINE_MAX_ENGINES = int(os.environ.get('SOURCE_ENGINE_MAX_ENGINES', 32))
+# Queries running at once against one source database, across all workers
+# (see app.connections.limiter). Connections can override it with
+# {"max_concurrency": N} in their options.
+SOURCE_MAX_CONCURRENCY = int(os.environ.get('SOURCE_MAX_CONCURRENCY', 4))
+# Queued executions retry for a slot this often...
+SOURCE_ADMISSION_RETRY_SEC = int(os.environ.get('SOURCE_ADMISSION_RETRY_SEC', 2))
+# ...and fail once they have waited this long.
+SOURCE_ADMISSION_MAX_WAIT_SEC = int(os.environ.get('SOURCE_ADMISSION_MAX_WAIT_SEC', 60))
+# New queries are rejected with 429 while this many are queued for a connection.
+SOURCE_ADMISSION_MAX_QUEUE = int(os.environ.get('SOURCE_ADMISSION_MAX_QUEUE', 50))
+# Schema introspection reflects tables in batches of this many, up to
+# INTROSPECTION_PARALLELISM batches at once, each on its own pooled connection
+# and holding a slot of the connection's concurrency limit.
+INTROSPECTION_BATCH_TABLES = int(os.environ.get('INTROSPECTION_BATCH_TABLES', 500))
+INTROSPECTION_PARALLELISM = int(os.environ.get('INTROSPECTION_PARALLELISM', 4))
+
+# --- Result Store ---
+# Executed result sets are stored as Arrow IPC files (see app.queries.results).
+# RESULT_STORE_URI selects any pyarrow filesystem (e.g. s3://bucket/results);
+# when empty, RESULT_STORE_ROOT is used as a local directory.
+RESULT_STORE_URI = os.environ.get('RESULT_STORE_URI', '')
+RESULT_STORE_ROOT = os.environ.get('RESULT_STORE_ROOT', str(BASE_DIR / 'var' / 'results'))
+RESULT_STORE_COMPRESSION = os.environ.get('RESULT_STORE_COMPRESSION', 'zstd')
+RESULT_STORE_TTL_SEC = int(os.environ.get('RESULT_STORE_TTL_SEC', 24 * 60 * 60))
+RESULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_BYTES', 10 * 1024 ** 3))
+# Number of rows fetched from the source database per round trip.
+RESULT_FETCH_CHUNK_ROWS = int(os.environ.get('RESULT_FETCH_CHUNK_ROWS', 5000))
+# Re-use stored results of identical queries (see app.queries.cache).
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'True').lower() in ('true', '1')
+RESULT_CACHE_TTL_SEC = int(os.environ.get('RESULT_CACHE_TTL_SEC', 15 * 60))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 ** 3))
+# Identical in-flight executions share one source query (see app.queries.singleflight).
+# Leaders hold a fingerprint for the query timeout plus this grace period.
+SINGLE_FLIGHT_GRACE_SEC = int(os.environ.get('SINGLE_FLIGHT_GRACE_SEC', 30))
+# Largest page the results API will serve in one response.
+RESULT_PAGE_MAX_ROWS = int(os.environ.get('RESULT_PAGE_MAX_ROWS', 1000))
+# The NLQ API can wait this long for the first FIRST_PAGE_ROWS rows of a
+# query and return them inline (see app.queries.handoff).
+FIRST_PAGE_BUDGET_MS = int(os.environ.get('FIRST_PAGE_BUDGET_MS', 300))
+FIRST_PAGE_ROWS = int(os.environ.get('FIRST_PAGE_ROWS', 100))
+# Preview runs ({"preview": true}) read samples of each table: this percentage
+# of pages on Postgres and SQL Server (TABLESAMPLE SYSTEM), and at most
+# PREVIEW_SCAN_ROWS rows per table elsewhere.
+PREVIEW_SAMPLE_PERCENT = float(os.environ.get('PREVIEW_SAMPLE_PERCENT', 1))
+PREVIEW_SCAN_ROWS = int(os.environ.get('PREVIEW_SCAN_ROWS', 10000))
+# Follow-ups ({"follow_up_of": <history id>}) re-query an earlier stored result
+# in an in-memory SQLite database (see app.queries.local). Each API process
+# keeps up to LOCAL_QUERY_CACHE_MAX_BYTES of them; results larger than
+# LOCAL_QUERY_MAX_RESULT_BYTES on disk are not loaded. They run inside the
+# API request, so they time out after LOCAL_QUERY_TIMEOUT_MS.
+LOCAL_QUERY_TIMEOUT_MS = int(os.environ.get('LOCAL_QUERY_TIMEOUT_MS', 2000))
+LOCAL_QUERY_CACHE_MAX_BYTES = int(os.environ.get('LOCAL_QUERY_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+LOCAL_QUERY_MAX_RESULT_BYTES = int(os.environ.get('LOCAL_QUERY_MAX_RESULT_BYTES', 64 * 1024 ** 2))
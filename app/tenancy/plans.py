@@ -0,0 +1,15 @@
+from django.conf import settings
+
+def get_plan_limits(tenant) -> dict:
+    """
+    Returns the execution limits for a tenant's plan.
+    Limits not overridden in TENANT_PLAN_LIMITS fall back to the global defaults.
+    """
+    limits = {
+        'max_rows': settings.RESULT_MAX_ROWS,
+        'max_bytes': settings.RESULT_MAX_BYTES,
+        'timeout_ms': settings.QUERY_TIMEOUT_MS,
+        'cost_thresholds': settings.QUERY_COST_THRESHOLDS,
+    }
+    limits.update(settings.TENANT_PLAN_LIMITS.get(tenant.plan, {}))
+    return limits
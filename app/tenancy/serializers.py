@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Tenant, Membership
+from app.accounts.models import User
 from app.accounts.serializers import UserSerializer
 
 class TenantSerializer(serializers.ModelSerializer):
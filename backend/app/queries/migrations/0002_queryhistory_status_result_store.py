@@ -0,0 +1,62 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="queryhistory",
+            old_name="exec_status",
+            new_name="status",
+        ),
+        migrations.AlterField(
+            model_name="queryhistory",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("PENDING", "Pending"),
+                    ("OK", "OK"),
+                    ("ERROR", "Error"),
+                    ("TIMEOUT", "Timeout"),
+                ],
+                default="PENDING",
+                max_length=10,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="queryhistory",
+            name="duration_ms",
+            field=models.PositiveIntegerField(
+                blank=True, help_text="Execution duration in milliseconds.", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="queryhistory",
+            name="result_path",
+            field=models.CharField(
+                blank=True,
+                help_text="Path of the stored result file, relative to the result store root.",
+                max_length=500,
+            ),
+        ),
+        migrations.AddField(
+            model_name="queryhistory",
+            name="result_bytes",
+            field=models.PositiveBigIntegerField(
+                blank=True, help_text="Size of the stored result file in bytes.", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="queryhistory",
+            name="result_schema",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text="Column names and Arrow types of the stored result.",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0002_queryhistory_status_result_store"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="result_batch_rows",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text="Row count of each record batch in the stored result, used to seek to a page.",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0003_queryhistory_result_batch_rows"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="cache_hit",
+            field=models.BooleanField(
+                default=False,
+                help_text="Whether the result was served from the result cache instead of the source database.",
+            ),
+        ),
+    ]
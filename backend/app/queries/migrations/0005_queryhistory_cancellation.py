@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0004_queryhistory_cache_hit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="backend_pid",
+            field=models.CharField(
+                blank=True,
+                help_text="Source database session id running the query, used to cancel it.",
+                max_length=32,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="queryhistory",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("PENDING", "Pending"),
+                    ("OK", "OK"),
+                    ("ERROR", "Error"),
+                    ("TIMEOUT", "Timeout"),
+                    ("CANCELLED", "Cancelled"),
+                ],
+                default="PENDING",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0005_queryhistory_cancellation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="estimated_rows",
+            field=models.FloatField(
+                blank=True,
+                help_text="Planner estimate of the most rows any step of the query produces.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="queryhistory",
+            name="estimated_cost",
+            field=models.FloatField(
+                blank=True,
+                help_text="Planner cost estimate, in the source database's own units.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0006_queryhistory_cost_estimate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="truncated",
+            field=models.BooleanField(
+                default=False,
+                help_text="Whether the stored result holds only the rows fetched before a timeout or cap; row_count is the number delivered.",
+            ),
+        ),
+        migrations.AddField(
+            model_name="queryhistory",
+            name="truncated_reason",
+            field=models.CharField(
+                blank=True,
+                choices=[("timeout", "Timeout"), ("row_limit", "Row limit"), ("byte_limit", "Byte limit")],
+                help_text="What stopped the result short.",
+                max_length=10,
+            ),
+        ),
+    ]
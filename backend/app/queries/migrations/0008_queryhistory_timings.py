@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0007_queryhistory_truncated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="timings",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="Milliseconds spent in each stage, from schema load and the LLM call to fetching and storing the result.",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0008_queryhistory_timings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="preview",
+            field=models.BooleanField(
+                default=False,
+                help_text="Whether the query ran on samples of its tables, so its results are approximate.",
+            ),
+        ),
+    ]
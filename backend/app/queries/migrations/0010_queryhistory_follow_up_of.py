@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0009_queryhistory_preview"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="queryhistory",
+            name="follow_up_of",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="The earlier query whose stored result this one refined locally, instead of querying the source.",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="follow_ups",
+                to="queries.queryhistory",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("queries", "0010_queryhistory_follow_up_of"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="queryhistory",
+            name="backend_pid",
+            field=models.CharField(
+                blank=True,
+                help_text="Source database session id running the query, used to cancel it. Cleared once the session goes back to the pool.",
+                max_length=32,
+            ),
+        ),
+    ]
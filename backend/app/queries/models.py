@@ -9,18 +9,93 @@ class QueryHistory(TenantModel):
     SQL execution for a user.
     """
     class Status(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
         OK = 'OK', 'OK'
         ERROR = 'ERROR', 'Error'
         TIMEOUT = 'TIMEOUT', 'Timeout'
+        CANCELLED = 'CANCELLED', 'Cancelled'
+
+    class TruncatedReason(models.TextChoices):
+        TIMEOUT = 'timeout', 'Timeout'
+        ROW_LIMIT = 'row_limit', 'Row limit'
+        BYTE_LIMIT = 'byte_limit', 'Byte limit'
 
     connection = models.ForeignKey(Connection, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
     prompt = models.TextField()
     generated_sql = models.TextField(blank=True)
-    exec_status = models.CharField(max_length=10, choices=Status.choices)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
     row_count = models.PositiveIntegerField(null=True, blank=True)
-    duration_ms = models.PositiveIntegerField(help_text="Execution duration in milliseconds.")
+    duration_ms = models.PositiveIntegerField(null=True, blank=True, help_text="Execution duration in milliseconds.")
     error_text = models.TextField(blank=True, null=True)
+    estimated_rows = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Planner estimate of the most rows any step of the query produces."
+    )
+    estimated_cost = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Planner cost estimate, in the source database's own units."
+    )
+    backend_pid = models.CharField(
+        max_length=32,
+        blank=True,
+        help_text="Source database session id running the query, used to cancel it. Cleared once the session goes back to the pool."
+    )
+
+    # The result set itself lives in the result store (see app.queries.results).
+    result_path = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text="Path of the stored result file, relative to the result store root."
+    )
+    result_bytes = models.PositiveBigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Size of the stored result file in bytes."
+    )
+    result_schema = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Column names and Arrow types of the stored result."
+    )
+    result_batch_rows = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Row count of each record batch in the stored result, used to seek to a page."
+    )
+    truncated = models.BooleanField(
+        default=False,
+        help_text="Whether the stored result holds only the rows fetched before a timeout or cap; row_count is the number delivered."
+    )
+    truncated_reason = models.CharField(
+        max_length=10,
+        choices=TruncatedReason.choices,
+        blank=True,
+        help_text="What stopped the result short."
+    )
+    follow_up_of = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='follow_ups',
+        help_text="The earlier query whose stored result this one refined locally, instead of querying the source."
+    )
+    preview = models.BooleanField(
+        default=False,
+        help_text="Whether the query ran on samples of its tables, so its results are approximate."
+    )
+    timings = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Milliseconds spent in each stage, from schema load and the LLM call to fetching and storing the result."
+    )
+    cache_hit = models.BooleanField(
+        default=False,
+        help_text="Whether the result was served from the result cache instead of the source database."
+    )
 
     # created_at is inherited from TenantModel
 
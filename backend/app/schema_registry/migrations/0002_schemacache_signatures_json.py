@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("schema_registry", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schemacache",
+            name="signatures_json",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="Per-table change signatures from the last introspection, so the next one re-reflects only changed tables.",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("schema_registry", "0002_schemacache_signatures_json"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schemacache",
+            name="stats_json",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="Catalog statistics per table (estimated rows, bytes on disk, last analyze time). Not part of the hash.",
+            ),
+        ),
+    ]
@@ -27,6 +27,18 @@ class SchemaCache(TenantModel):
         help_text="A hash of the schema content to detect changes."
     )
 
+    signatures_json = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Per-table change signatures from the last introspection, so the next one re-reflects only changed tables."
+    )
+
+    stats_json = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Catalog statistics per table (estimated rows, bytes on disk, last analyze time). Not part of the hash."
+    )
+
     refreshed_at = models.DateTimeField(
         auto_now=True,
         help_text="The timestamp of the last successful introspection."